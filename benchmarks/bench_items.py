@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""Offline benchmarks for items on their way from a callback to the database.
+
+Builds sold and comp items from the saved pages in ``benchmarks/fixtures``,
+turns them into INSERT rows and writes them through ``HemnetPipeline`` to a
+scratch SQLite database, and reports items/sec and the memory held per
+item: the item object and the containers of its values, from
+``sys.getsizeof``. The values themselves are left out, they are the same
+objects whatever holds them.
+
+    python benchmarks/bench_items.py
+    python benchmarks/bench_items.py --save baseline.json
+    python benchmarks/bench_items.py --compare baseline.json
+
+With ``--compare`` the exit status is 1 when the items/sec of any benchmark
+dropped below the baseline by more than ``--max-regression``.
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer as clock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from scrapy.http import HtmlResponse
+
+from hemnet import extractors
+from hemnet.items import HemnetItem
+from hemnet.models import HemnetItem as HemnetSQL
+from hemnet.models import HemnetCompItem as HemnetCompSQL
+from hemnet.pipelines import HemnetPipeline, _row
+
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+
+SOLD_URL = ('https://www.hemnet.se/salda/'
+            'lagenhet-2rum-guldheden-goteborgs-kommun-9436617')
+LISTING_URL = ('https://www.hemnet.se/bostad/'
+               'lagenhet-2rum-guldheden-goteborgs-kommun-11956472')
+
+
+def _response(url, fixture):
+    with open(os.path.join(FIXTURES, fixture), 'rb') as f:
+        return HtmlResponse(url, body=f.read(), encoding='utf-8')
+
+
+def item_factories():
+    """Return ``(name, make)`` building a fresh item of each class."""
+    sold = extractors.extract_sold_page(
+        _response(SOLD_URL, 'sold_bostadsratt.html'))
+    listing = extractors.extract_listing_page(
+        _response(LISTING_URL, 'listing.html'))
+    ids = itertools.count(1)
+
+    def make_sold():
+        item = extractors.sold_item(sold, SOLD_URL)
+        item['hemnet_id'] = next(ids)
+        return item
+
+    def make_comp():
+        return extractors.comp_item(listing, LISTING_URL, 57.68566, 11.96993,
+                                    next(ids))
+
+    return [('sold', make_sold), ('comp', make_comp)]
+
+
+def item_size(item):
+    """Bytes of ``item`` and of the dicts holding its values, if any."""
+    size = sys.getsizeof(item)
+    for name in ('__dict__', '_values'):
+        container = getattr(item, name, None)
+        if container is not None:
+            size += sys.getsizeof(container)
+    return size
+
+
+def measure_build(make, n):
+    start = clock()
+    for _ in range(n):
+        make()
+    elapsed = clock() - start
+    return n / elapsed, item_size(make())
+
+
+def measure_rows(make, n):
+    items = [make() for _ in range(n)]
+    model = HemnetSQL if isinstance(items[0], HemnetItem) else HemnetCompSQL
+    start = clock()
+    for item in items:
+        _row(model, item)
+    return n / (clock() - start)
+
+
+def measure_write(make, n, batch_size, write_mode):
+    items = [make() for _ in range(n)]
+    pipeline = HemnetPipeline(batch_size=batch_size, write_mode=write_mode)
+    start = clock()
+    for item in items:
+        pipeline.process_item(item, None)
+    pipeline.close_spider(None)
+    return n / (clock() - start)
+
+
+def run(args):
+    results = {}
+    for name, make in item_factories():
+        if args.filter in 'build/' + name:
+            per_sec, size = measure_build(make, args.items)
+            results['build/' + name] = {'items_per_sec': per_sec,
+                                        'bytes_per_item': size}
+        if args.filter in 'row/' + name:
+            results['row/' + name] = {
+                'items_per_sec': measure_rows(make, args.items)}
+        for label, batch_size, mode in (('row', 1, 'insert'),
+                                        ('batch', 500, 'insert'),
+                                        ('upsert', 500, 'upsert')):
+            key = 'write/%s/%s' % (label, name)
+            if args.filter not in key:
+                continue
+            n = args.items if batch_size > 1 else args.items // 10
+            results[key] = {
+                'items_per_sec': measure_write(make, n, batch_size, mode)}
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """Print the change against ``baseline``; return the regressed names."""
+    regressed = []
+    print()
+    print('%-24s %14s %14s %9s' % ('benchmark', 'base items/s', 'items/s',
+                                   'change'))
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            print('%-24s %14s %14.0f %9s' % (name, '-',
+                                             result['items_per_sec'], 'new'))
+            continue
+        change = result['items_per_sec'] / base['items_per_sec'] - 1
+        flag = ''
+        if change < -max_regression:
+            regressed.append(name)
+            flag = '  REGRESSION'
+        print('%-24s %14.0f %14.0f %+8.1f%%%s' % (
+            name, base['items_per_sec'], result['items_per_sec'],
+            change * 100, flag))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--items', type=int, default=20000)
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare against results saved with --save')
+    parser.add_argument('--max-regression', type=float, default=0.10,
+                        help='allowed items/sec drop with --compare '
+                             '(default: 0.10)')
+    args = parser.parse_args(argv)
+
+    # The pipeline writes to a scratch database, see models.db_connect.
+    scratch = tempfile.mkdtemp(prefix='bench_items')
+    os.environ['HEMNET_DATABASE_URL'] = 'sqlite:///' + os.path.join(
+        scratch, 'bench.db')
+    try:
+        results = run(args)
+    finally:
+        shutil.rmtree(scratch)
+
+    print('%-24s %12s %14s' % ('benchmark', 'items/s', 'bytes/item'))
+    for name, result in sorted(results.items()):
+        size = result.get('bytes_per_item')
+        print('%-24s %12.0f %14s' % (name, result['items_per_sec'],
+                                     '%.0f' % size if size is not None
+                                     else ''))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
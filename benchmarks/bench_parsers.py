@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""Offline benchmarks for the Hemnet page parsers.
+
+Runs the spider callbacks and the extraction helpers over the saved pages in
+``benchmarks/fixtures`` without touching the network or the database, and
+reports pages/sec, p50/p99 latency and the memory a parsed page holds while
+its response is alive (the lxml tree and the output). The memory comes from
+the growth of the peak RSS in a forked child (``resource.getrusage``), so it
+includes what lxml allocates; it is left out where there is no ``fork`` or
+``resource`` (Windows).
+
+    python benchmarks/bench_parsers.py
+    python benchmarks/bench_parsers.py --save baseline.json
+    python benchmarks/bench_parsers.py --compare baseline.json
+
+With ``--compare`` the exit status is 1 when the p50 of any benchmark got
+slower than the baseline by more than ``--max-regression``.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+from collections import defaultdict
+from timeit import default_timer as clock
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import scrapy
+from scrapy.http import HtmlResponse
+
+from hemnet import extractors
+from hemnet.seen import SeenIds
+from hemnet.spiders import hemnet_spider, hemnet_comp_spider
+
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+
+RESULTS_URL = ('http://www.hemnet.se/salda/bostader?location_ids%5B%5D=17744'
+               '&item_types%5B%5D=bostadsratt&sold_age=1m')
+SOLD_URL = ('https://www.hemnet.se/salda/'
+            'lagenhet-2rum-guldheden-goteborgs-kommun-9436617')
+LISTING_URL = ('https://www.hemnet.se/bostad/'
+               'lagenhet-2rum-guldheden-goteborgs-kommun-11956472')
+LISTING_META = {'lat': 57.68566, 'lon': 11.96993, 'salda_id': 9436617}
+ENCODED_EMAIL = ('/cdn-cgi/l/email-protection#'
+                 '4f2e21212e612e212b2a3d3c3c20210f3c392a213c24292e3c3b613c2a')
+
+
+def _fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def _response_factory(url, fixture, meta=None):
+    body = _fixture(fixture)
+
+    def make():
+        request = scrapy.Request(url, meta=dict(meta or {}))
+        return HtmlResponse(url, body=body, encoding='utf-8',
+                            request=request)
+    return make
+
+
+def _make_spider(cls, **attrs):
+    """Build a spider without running its ``__init__`` (no database)."""
+    spider = cls.__new__(cls)
+    scrapy.Spider.__init__(spider)
+    spider._write_err = lambda *args: None
+    for name, value in attrs.items():
+        setattr(spider, name, value)
+    return spider
+
+
+def _callback(spider, name, reset=None):
+    def run(response):
+        if reset:
+            reset(spider)
+        return list(getattr(spider, name)(response))
+    return run
+
+
+def _reset_seen(spider):
+    spider.seen_ids = SeenIds()
+
+
+def benchmarks():
+    """Return ``(name, make_input, run)`` for every benchmark."""
+    spider = _make_spider(hemnet_spider.HemnetSpider, sold_age='1m',
+                          incremental=False, seen_ids=SeenIds(),
+                          watermarks={}, budgets={}, default_budget=None,
+                          spent=defaultdict(int), over_budget=set(),
+                          fingerprints={})
+    comp_spider = _make_spider(hemnet_comp_spider.HemnetSpider)
+
+    sold = [('bostadsratt', 'sold_bostadsratt.html'),
+            ('villa', 'sold_villa.html'),
+            ('malformed', 'malformed_sold.html')]
+    listing = [('listing', 'listing.html'),
+               ('malformed', 'malformed_listing.html')]
+
+    yield ('parse/results', _response_factory(RESULTS_URL, 'results.html'),
+           _callback(spider, 'parse', reset=_reset_seen))
+    for label, fixture in sold:
+        yield ('parse_detail_page/%s' % label,
+               _response_factory(SOLD_URL, fixture),
+               _callback(spider, 'parse_detail_page'))
+        yield ('parse_salda/%s' % label,
+               _response_factory(SOLD_URL, fixture, {'salda_id': 9436617}),
+               _callback(comp_spider, 'parse_salda'))
+    for label, fixture in listing:
+        yield ('parse_prev_page/%s' % label,
+               _response_factory(LISTING_URL, fixture, LISTING_META),
+               _callback(spider, 'parse_prev_page'))
+    for label, fixture in sold[:2]:
+        make = _response_factory(SOLD_URL, fixture)
+        yield ('get_property_attributes/%s' % label, make,
+               extractors.get_property_attributes)
+        yield ('extract_coords/%s' % label, make, extractors.extract_coords)
+    yield ('decode_email', lambda: ENCODED_EMAIL, extractors.decode_email)
+
+
+def _percentile(sorted_values, q):
+    return sorted_values[int(round(q * (len(sorted_values) - 1)))]
+
+
+def _max_rss_kib():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return rss / 1024.0 if sys.platform == 'darwin' else float(rss)
+
+
+def kib_per_call(make_input, run, iterations):
+    """KiB the peak RSS grows by per call of ``run``.
+
+    The inputs of the ``iterations`` calls are kept alive, like responses
+    in flight. The calls run in a forked child, whose peak starts at its
+    own resident size, so earlier benchmarks do not hide the growth, after
+    one call to warm up.
+    """
+    if resource is None or not hasattr(os, 'fork') or not iterations:
+        return None
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read)
+            args = [make_input() for _ in range(iterations + 1)]
+            # the first call sets up parsers and caches
+            run(args.pop())
+            before = _max_rss_kib()
+            for arg in args:
+                run(arg)
+            growth = (_max_rss_kib() - before) / iterations
+            os.write(write, repr(growth).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(write)
+    data = os.read(read, 64)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return float(data) if data else None
+
+
+def measure(make_input, run, iterations, alloc_iterations):
+    timings = []
+    for _ in range(iterations):
+        arg = make_input()
+        start = clock()
+        run(arg)
+        timings.append(clock() - start)
+    timings.sort()
+
+    total = sum(timings)
+    return {
+        'pages_per_sec': len(timings) / total if total else float('inf'),
+        'p50_ms': _percentile(timings, 0.50) * 1000.0,
+        'p99_ms': _percentile(timings, 0.99) * 1000.0,
+        'kib_per_call': kib_per_call(make_input, run, alloc_iterations),
+    }
+
+
+def compare(results, baseline, max_regression):
+    """Print the change against ``baseline``; return the regressed names."""
+    regressed = []
+    print()
+    print('%-36s %12s %12s %9s' % ('benchmark', 'base p50 ms', 'p50 ms',
+                                   'change'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            print('%-36s %12s %12.3f %9s' % (name, '-', result['p50_ms'],
+                                             'new'))
+            continue
+        change = result['p50_ms'] / base['p50_ms'] - 1
+        flag = ''
+        if change > max_regression:
+            regressed.append(name)
+            flag = '  REGRESSION'
+        print('%-36s %12.3f %12.3f %+8.1f%%%s' % (
+            name, base['p50_ms'], result['p50_ms'], change * 100, flag))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('--alloc-iterations', type=int, default=100,
+                        help='calls run to measure the peak memory '
+                             '(0 disables)')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare against results saved with --save')
+    parser.add_argument('--max-regression', type=float, default=0.10,
+                        help='allowed p50 slowdown with --compare '
+                             '(default: 0.10)')
+    args = parser.parse_args(argv)
+
+    results = {}
+    print('%-36s %10s %10s %10s %10s' % ('benchmark', 'pages/s', 'p50 ms',
+                                         'p99 ms', 'KiB/call'))
+    for name, make_input, run in benchmarks():
+        if args.filter not in name:
+            continue
+        result = measure(make_input, run, args.iterations,
+                         args.alloc_iterations)
+        results[name] = result
+        peak = result['kib_per_call']
+        print('%-36s %10.0f %10.3f %10.3f %10s' % (
+            name, result['pages_per_sec'], result['p50_ms'],
+            result['p99_ms'], '%.1f' % peak if peak is not None else 'n/a'))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""Indexes and pre-aggregated tables for the queries in ``queries.sql``.
+
+``setup_indexes`` adds trigram indexes so ``geographic_area LIKE '%...%'``
+and ``address LIKE '%...%'`` no longer scan the whole table, plus b-tree
+indexes on the date columns. ``refresh_broker_area_month`` rebuilds the
+rows of ``hemnet_broker_area_month`` (sales, prices and living area per
+broker, area and month of sale) for the months of the rows the pipeline
+inserted or changed (``updated_at``) since the previous refresh.
+
+The ``AnalyticsRefresh`` extension refreshes the aggregates when a spider
+closes; ``scrapy analytics`` creates the indexes and refreshes by hand.
+"""
+
+import logging
+import time
+from datetime import datetime, timedelta
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.log import failure_to_exc_info
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from hemnet.db import shared_pool
+from hemnet.models import HemnetCrawlState, is_postgres
+
+logger = logging.getLogger(__name__)
+
+STATE_SCOPE = 'analytics:broker_area_month'
+
+# Rows stamped before a refresh started but committed after it read the
+# table are picked up by the next refresh.
+STATE_OVERLAP = timedelta(minutes=10)
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_hemnet_items_geographic_area_trgm '
+    'ON hemnet_items USING gin (geographic_area gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_hemnet_items_address_trgm '
+    'ON hemnet_items USING gin (address gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_hemnet_items_sold_date '
+    'ON hemnet_items (sold_date)',
+    'CREATE INDEX IF NOT EXISTS ix_hemnet_items_collected_at '
+    'ON hemnet_items (collected_at)',
+    'CREATE INDEX IF NOT EXISTS ix_hemnet_items_updated_at '
+    'ON hemnet_items (updated_at)',
+]
+
+TOUCHED_MONTHS = text("""
+    SELECT DISTINCT date_trunc('month', sold_date)::date
+    FROM hemnet_items
+    WHERE sold_date IS NOT NULL
+      AND (CAST(:since AS timestamp) IS NULL OR updated_at >= :since)
+""")
+
+DELETE_MONTHS = text("""
+    DELETE FROM hemnet_broker_area_month WHERE month = ANY(:months)
+""")
+
+INSERT_MONTHS = text("""
+    INSERT INTO hemnet_broker_area_month
+        (broker_email, geographic_area, month, broker_name, broker_firm,
+         sales, total_price, total_asked_price, priced_sales,
+         priced_total_price, priced_square_meters)
+    SELECT coalesce(broker_email, ''),
+           coalesce(geographic_area, ''),
+           date_trunc('month', sold_date)::date AS month,
+           max(broker_name),
+           max(broker_firm),
+           count(*),
+           sum(price),
+           sum(asked_price),
+           count(*) FILTER (WHERE price IS NOT NULL
+                            AND square_meters > 0),
+           sum(price) FILTER (WHERE price IS NOT NULL
+                              AND square_meters > 0),
+           sum(square_meters) FILTER (WHERE price IS NOT NULL
+                                      AND square_meters > 0)
+    FROM hemnet_items
+    WHERE date_trunc('month', sold_date)::date = ANY(:months)
+    GROUP BY 1, 2, 3
+""")
+
+
+def setup_indexes(engine):
+    """Create the pg_trgm extension and the indexes that are missing.
+
+    Creating the extension needs a role allowed to; if it fails the trigram
+    indexes are skipped.
+    """
+    with engine.begin() as conn:
+        try:
+            conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except DBAPIError:
+            logger.warning('Could not create the pg_trgm extension; run '
+                           '"CREATE EXTENSION pg_trgm" as a superuser to get '
+                           'the trigram indexes')
+            trigram = False
+        else:
+            trigram = True
+    for statement in INDEXES:
+        if not trigram and 'gin_trgm_ops' in statement:
+            continue
+        start = time.time()
+        with engine.begin() as conn:
+            conn.execute(statement)
+        logger.debug('%s (%.1fs)', statement, time.time() - start)
+
+
+def refresh_broker_area_month(engine, full=False):
+    """Re-aggregate the months touched since the last refresh.
+
+    Months are recomputed whole, so a refresh can be repeated safely and
+    the overlap with the previous one is harmless.
+    Returns the number of months refreshed.
+    """
+    started = datetime.now()
+    with engine.begin() as conn:
+        state = conn.execute(
+            HemnetCrawlState.__table__.select()
+            .where(HemnetCrawlState.scope == STATE_SCOPE)).first()
+        since = None
+        if state is not None and not full:
+            since = state.updated_at - STATE_OVERLAP
+        months = [m for m, in conn.execute(TOUCHED_MONTHS, since=since)]
+        if months:
+            conn.execute(DELETE_MONTHS, months=months)
+            conn.execute(INSERT_MONTHS, months=months)
+
+        table = HemnetCrawlState.__table__
+        if state is None:
+            conn.execute(table.insert().values(scope=STATE_SCOPE,
+                                               updated_at=started))
+        else:
+            conn.execute(table.update()
+                         .where(table.c.scope == STATE_SCOPE)
+                         .values(updated_at=started))
+    logger.info('Refreshed hemnet_broker_area_month for %d months in %.1fs',
+                len(months), (datetime.now() - started).total_seconds())
+    return len(months)
+
+
+class AnalyticsRefresh(object):
+    """Refresh the aggregate tables when a spider closes."""
+
+    def __init__(self, stats, db):
+        self.stats = stats
+        self.db = db
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('HEMNET_ANALYTICS_REFRESH'):
+            raise NotConfigured
+        db = shared_pool(crawler.settings)
+        if not is_postgres(db.engine):
+            raise NotConfigured('The analytics tables need Postgres')
+        o = cls(crawler.stats, db)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_closed(self, spider, reason):
+        d = self.db.run(refresh_broker_area_month, self.db.engine)
+        d.addCallbacks(self._refreshed, self._failed)
+        return d
+
+    def _refreshed(self, months):
+        self.stats.set_value('hemnet/analytics/months_refreshed', months)
+
+    def _failed(self, failure):
+        failure.trap(DBAPIError)
+        logger.error('Could not refresh the analytics tables',
+                     exc_info=failure_to_exc_info(failure))
@@ -0,0 +1,42 @@
+from __future__ import print_function
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from hemnet.analytics import refresh_broker_area_month, setup_indexes
+from hemnet.models import create_hemnet_table, db_connect, is_postgres
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Create the analytics indexes and refresh the aggregates'
+
+    def long_desc(self):
+        return ('Create the trigram and date indexes used by the queries in '
+                'queries.sql if they are missing, then refresh '
+                'hemnet_broker_area_month for the months that got new rows '
+                'since the last refresh.')
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('--full', action='store_true',
+                          help='re-aggregate every month')
+        parser.add_option('--no-indexes', action='store_true',
+                          help='only refresh the aggregates')
+
+    def run(self, args, opts):
+        engine = db_connect()
+        if not is_postgres(engine):
+            raise UsageError('The analytics tables need Postgres',
+                             print_help=False)
+        create_hemnet_table(engine)
+        if not opts.no_indexes:
+            setup_indexes(engine)
+        months = refresh_broker_area_month(engine, full=opts.full)
+        print('Refreshed %d months' % months)
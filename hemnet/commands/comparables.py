@@ -0,0 +1,132 @@
+from __future__ import print_function
+
+import csv
+import sys
+import time
+from datetime import datetime
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from hemnet.comparables import ComparablesIndex, np, refresh_index
+from hemnet.db import get_engine
+
+FIELDS = ['subject', 'rank', 'salda_id', 'distance', 'price', 'sold_date',
+          'living_area', 'rooms', 'item_type', 'lat', 'lon']
+
+
+def _float(value):
+    return float(value) if value not in (None, '') else None
+
+
+def read_subjects(path):
+    """Subjects from a CSV file with lat and lon columns and optionally id,
+    item_type, rooms and living_area."""
+    with open(path) as f:
+        for i, row in enumerate(csv.DictReader(f)):
+            yield {
+                'id': row.get('id') or i + 1,
+                'lat': float(row['lat']),
+                'lon': float(row['lon']),
+                'item_type': row.get('item_type') or None,
+                'rooms': _float(row.get('rooms')),
+                'living_area': _float(row.get('living_area')),
+            }
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Refresh the comparables index or look up comparables'
+
+    def long_desc(self):
+        return ('With --refresh, add the comps written since the last '
+                'refresh to the comparables index (see hemnet/comparables.py)'
+                '. With --subjects, write the k nearest sold comparables of '
+                'every property in a CSV file with lat and lon columns (and '
+                'optionally id, item_type, rooms and living_area) as CSV. '
+                'Needs numpy.')
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('--index',
+                          help='index file (default: '
+                               'HEMNET_COMPARABLES_INDEX or comparables.npz)')
+        parser.add_option('--refresh', action='store_true',
+                          help='read new comps from the database first')
+        parser.add_option('--full', action='store_true',
+                          help='rebuild the index from scratch')
+        parser.add_option('--subjects', metavar='CSV',
+                          help='properties to find comparables for')
+        parser.add_option('-o', '--output', metavar='CSV',
+                          help='write comparables here (default: stdout)')
+        parser.add_option('-k', type='int', default=10,
+                          help='comparables per subject (default: 10)')
+        parser.add_option('--radius', type='float', default=1000,
+                          help='search radius in metres (default: 1000)')
+        parser.add_option('--rooms-margin', type='float',
+                          help='allowed difference in rooms')
+        parser.add_option('--area-margin', type='float',
+                          help='allowed living area difference as a '
+                               'fraction, e.g. 0.2')
+        parser.add_option('--any-type', action='store_true',
+                          help='do not require the same item type')
+        parser.add_option('--since', metavar='YYYY-MM-DD',
+                          help='only comparables sold on or after this date')
+
+    def run(self, args, opts):
+        if np is None:
+            raise UsageError('The comparables index needs numpy: '
+                             'pip install numpy', print_help=False)
+        if not (opts.refresh or opts.full or opts.subjects):
+            raise UsageError('Give --refresh, --full or --subjects')
+        path = opts.index or \
+            self.settings.get('HEMNET_COMPARABLES_INDEX') or \
+            'comparables.npz'
+        sold_after = None
+        if opts.since:
+            try:
+                sold_after = datetime.strptime(opts.since, '%Y-%m-%d').date()
+            except ValueError:
+                raise UsageError('--since must be YYYY-MM-DD')
+
+        if opts.refresh or opts.full:
+            index, count = refresh_index(
+                get_engine(), path,
+                self.settings.getfloat('HEMNET_COMPARABLES_CELL_SIZE', 500),
+                full=opts.full)
+            print('Read %d comps, %d in the index' % (count, len(index)),
+                  file=sys.stderr)
+        else:
+            index = ComparablesIndex.load(path)
+
+        if not opts.subjects:
+            return
+        out = open(opts.output, 'w') if opts.output else sys.stdout
+        try:
+            writer = csv.DictWriter(out, FIELDS)
+            writer.writeheader()
+            start = time.time()
+            subjects = 0
+            results = index.nearest_many(
+                read_subjects(opts.subjects), k=opts.k, radius=opts.radius,
+                rooms_margin=opts.rooms_margin, area_margin=opts.area_margin,
+                same_type=not opts.any_type, sold_after=sold_after)
+            for subject, comparables in results:
+                subjects += 1
+                for rank, comparable in enumerate(comparables, 1):
+                    row = comparable._asdict()
+                    row.update(subject=subject['id'], rank=rank)
+                    writer.writerow(row)
+            elapsed = time.time() - start
+        finally:
+            if opts.output:
+                out.close()
+        print('Looked up %d subjects in %.2fs (%.2f ms each)' % (
+            subjects, elapsed, elapsed * 1000 / subjects if subjects else 0),
+            file=sys.stderr)
@@ -0,0 +1,279 @@
+from __future__ import print_function
+
+import json
+import os
+import re
+import shutil
+import time
+from collections import OrderedDict, defaultdict
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from sqlalchemy import (
+    BigInteger, Boolean, Date, DateTime, Float, Integer, create_engine, text
+)
+
+from hemnet.models import (
+    HemnetItem as HemnetSQL,
+    HemnetCompItem as HemnetCompSQL,
+    db_connect,
+    is_postgres,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Rows of each table, with the month of sale and the municipality the files
+# are partitioned by. Comp items take the sale month of their sold item.
+QUERIES = {
+    'hemnet_items': """
+        SELECT i.*,
+               to_char(i.sold_date, 'YYYY-MM') AS _month,
+               trim(substring(i.geographic_area from '[^,]*$'))
+                   AS _municipality
+        FROM hemnet_items i
+        WHERE i.id > :last_id
+        ORDER BY i.id
+    """,
+    'hemnet_comp_items': """
+        SELECT c.*,
+               to_char(i.sold_date, 'YYYY-MM') AS _month,
+               c.municipality AS _municipality
+        FROM hemnet_comp_items c
+        LEFT JOIN hemnet_items i ON i.hemnet_id = c.salda_id
+        WHERE c.id > :last_id
+        ORDER BY c.id
+    """,
+}
+
+MODELS = {
+    'hemnet_items': HemnetSQL,
+    'hemnet_comp_items': HemnetCompSQL,
+}
+
+STATE_FILE = 'export_state.json'
+
+PART_FILE = re.compile(r'^part-(\d+)-(\d+)\.parquet$')
+
+
+def arrow_schema(model):
+    """Arrow schema matching the columns of ``model``."""
+    types = [
+        (BigInteger, pa.int64()),
+        (Integer, pa.int32()),
+        (Float, pa.float64()),
+        (Boolean, pa.bool_()),
+        (DateTime, pa.timestamp('us')),
+        (Date, pa.date32()),
+    ]
+    fields = []
+    for column in model.__table__.columns:
+        arrow_type = next((t for sql_type, t in types
+                           if isinstance(column.type, sql_type)), pa.string())
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+
+def _partition_value(value):
+    if not value:
+        return 'unknown'
+    return value.replace('/', '_')
+
+
+class PartitionWriters(object):
+    """One open ``ParquetWriter`` per partition directory.
+
+    Every chunk adds a row group to the file of each partition it touches.
+    At most ``max_open`` files are open; the least recently written one is
+    closed to make room, and its partition starts a new file when it gets
+    more rows. Files are written as ``.tmp``: ``commit`` renames them all to
+    ``part-<first id>-<last id>.parquet`` once the export went through and
+    ``abort`` removes them.
+    """
+
+    def __init__(self, schema, max_open=256):
+        self.schema = schema
+        self.max_open = max_open
+        # directory -> [writer, path, first id, last id]
+        self.open = OrderedDict()
+        # (directory, path, first id, last id) of the closed files
+        self.closed = []
+
+    def write(self, directory, arrow_table, first, last):
+        entry = self.open.pop(directory, None)
+        if entry is None:
+            if len(self.open) >= self.max_open:
+                self._close(*self.open.popitem(last=False))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, 'part-%d.parquet.tmp' % first)
+            writer = pq.ParquetWriter(path, self.schema, use_dictionary=True,
+                                      compression='snappy')
+            entry = [writer, path, first, last]
+        entry[0].write_table(arrow_table)
+        entry[3] = last
+        self.open[directory] = entry
+
+    def _close(self, directory, entry):
+        writer, path, first, last = entry
+        writer.close()
+        self.closed.append((directory, path, first, last))
+
+    def close(self):
+        while self.open:
+            self._close(*self.open.popitem(last=False))
+
+    def commit(self):
+        """Close the files and give them their final names."""
+        self.close()
+        for directory, path, first, last in self.closed:
+            os.rename(path, os.path.join(
+                directory, 'part-%d-%d.parquet' % (first, last)))
+        return len(self.closed)
+
+    def abort(self):
+        """Close the files and remove them."""
+        self.close()
+        for _, path, _, _ in self.closed:
+            os.remove(path)
+        self.closed = []
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Export the item tables to partitioned Parquet files'
+
+    def long_desc(self):
+        return ('Stream hemnet_items and hemnet_comp_items with a server-side '
+                'cursor and write them as Parquet files partitioned by month '
+                'of sale and municipality: '
+                '<output>/<table>/month=YYYY-MM/municipality=<name>/'
+                'part-<first id>-<last id>.parquet, one file per partition '
+                'and run with a row group per chunk. Only rows added since '
+                'the last export are written unless --full is given; rows '
+                'updated in place by upsert mode are picked up by --full '
+                'only, which replaces the exported files. '
+                'Needs pyarrow.')
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('-o', '--output', default='export',
+                          help='output directory (default: export)')
+        parser.add_option('--table', action='append', default=[],
+                          choices=sorted(QUERIES),
+                          help='only export this table (can be repeated)')
+        parser.add_option('--chunk-size', type='int', default=50000,
+                          help='rows fetched and written at a time')
+        parser.add_option('--max-open-files', type='int', default=256,
+                          help='partition files kept open at once')
+        parser.add_option('--full', action='store_true',
+                          help='export every row, not just the new ones')
+        parser.add_option('--database-url',
+                          help='SQLAlchemy URL to read from, e.g. a replica '
+                               '(default: DATABASE in settings)')
+
+    def run(self, args, opts):
+        if pa is None:
+            raise UsageError('The export command needs pyarrow: '
+                             'pip install pyarrow', print_help=False)
+        engine = create_engine(opts.database_url) if opts.database_url \
+            else db_connect()
+        if not is_postgres(engine):
+            raise UsageError('The export reads from Postgres; a SQLite '
+                             'database can be read directly',
+                             print_help=False)
+
+        state_path = os.path.join(opts.output, STATE_FILE)
+        state = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+
+        for table in opts.table or sorted(QUERIES):
+            if opts.full and os.path.isdir(os.path.join(opts.output, table)):
+                shutil.rmtree(os.path.join(opts.output, table))
+            last_id = 0 if opts.full else state.get(table, 0)
+            self._remove_partial(os.path.join(opts.output, table), last_id)
+            start = time.time()
+            last_id, rows, files = self.export_table(
+                engine, table, opts.output, last_id, opts.chunk_size,
+                opts.max_open_files)
+            # The files only get their names once the whole table is
+            # written, so the state moves on per table rather than per
+            # chunk.
+            if rows:
+                state[table] = last_id
+                self._save_state(state_path, state)
+            print('Exported %d rows of %s to %d files in %.1fs' % (
+                rows, table, files, time.time() - start))
+
+    def export_table(self, engine, table, output, last_id, chunk_size,
+                     max_open_files=256):
+        """Write the rows of ``table`` after ``last_id`` chunk by chunk.
+
+        Returns the last id, the number of rows and the number of files
+        written.
+        """
+        schema = arrow_schema(MODELS[table])
+        names = schema.names
+        writers = PartitionWriters(schema, max_open_files)
+        count = 0
+        try:
+            with engine.connect() as conn:
+                result = conn.execution_options(stream_results=True).execute(
+                    text(QUERIES[table]), last_id=last_id)
+                while True:
+                    chunk = result.fetchmany(chunk_size)
+                    if not chunk:
+                        break
+                    partitions = defaultdict(list)
+                    for row in chunk:
+                        key = (_partition_value(row['_month']),
+                               _partition_value(row['_municipality']))
+                        partitions[key].append(row)
+                    for (month, municipality), rows in partitions.items():
+                        columns = [pa.array([row[name] for row in rows],
+                                            type=field.type)
+                                   for name, field in zip(names, schema)]
+                        directory = os.path.join(
+                            output, table, 'month=%s' % month,
+                            'municipality=%s' % municipality)
+                        writers.write(
+                            directory,
+                            pa.Table.from_arrays(columns, schema=schema),
+                            rows[0]['id'], rows[-1]['id'])
+                    last_id = chunk[-1]['id']
+                    count += len(chunk)
+        except BaseException:
+            writers.abort()
+            raise
+        return last_id, count, writers.commit()
+
+    def _remove_partial(self, directory, last_id):
+        """Remove the files an interrupted export left behind.
+
+        Those are the ``.tmp`` files, and the files holding rows after
+        ``last_id`` if it stopped before saving the state.
+        """
+        for root, _, names in os.walk(directory):
+            for name in names:
+                match = PART_FILE.match(name)
+                if name.endswith('.tmp') or \
+                        match and int(match.group(1)) > last_id:
+                    os.remove(os.path.join(root, name))
+
+    def _save_state(self, path, state):
+        if not os.path.isdir(os.path.dirname(path) or '.'):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
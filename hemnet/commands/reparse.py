@@ -0,0 +1,150 @@
+from __future__ import print_function
+
+import os
+import time
+from multiprocessing import Pool, cpu_count
+
+import scrapy
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.http import Headers, HtmlResponse
+from scrapy.utils.project import data_path
+
+from hemnet.extractors import (
+    ExtractError,
+    comp_item,
+    extract_listing_page,
+    extract_sold_page,
+    sold_item,
+)
+from hemnet.httpcache import SegmentCache, page_key
+from hemnet.items import HemnetItem, HemnetCompItem
+from hemnet.pipelines import HemnetPipeline
+
+# Caches opened by each worker process, by path.
+_caches = {}
+
+
+def _init_worker(paths, segment_size):
+    for path in paths:
+        _caches[path] = SegmentCache(path, segment_size)
+
+
+def _response(data):
+    return HtmlResponse(data['url'], headers=Headers(data['headers']),
+                        body=data['body'], encoding='utf-8')
+
+
+def reparse_sold(task):
+    """Parse one cached sold page and the listing page it links to.
+
+    Runs in a worker process; returns a list of item dicts.
+    """
+    path, key = task
+    cache = _caches[path]
+    data, _ = cache.get(key)
+    page = extract_sold_page(_response(data))
+    if page.sold_property is None:
+        return []
+    item = sold_item(page, data['url'])
+    items = [dict(item)]
+
+    if page.prev_url:
+        _, listing_key = page_key(scrapy.Request(page.prev_url))
+        found = cache.get(listing_key)
+        if found is not None:
+            listing_data, _ = found
+            try:
+                listing = extract_listing_page(_response(listing_data))
+            except ExtractError:
+                pass
+            else:
+                items.append(dict(comp_item(
+                    listing, listing_data['url'], page.lat, page.lon,
+                    item['hemnet_id'])))
+    return items
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Re-parse sold pages stored in the HTTP cache'
+
+    def long_desc(self):
+        return ('Re-parse every sold page stored by SegmentCacheStorage, '
+                'together with the listing page it links to, across a pool '
+                'of processes and write the items through HemnetPipeline. '
+                'Existing rows for the re-parsed ids are updated in place '
+                '(upsert mode, whatever HEMNET_PIPELINE_WRITE_MODE says).')
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('-p', '--processes', type='int',
+                          default=cpu_count(),
+                          help='worker processes (default: all cores)')
+        parser.add_option('--spider', action='append', default=[],
+                          help='only read the cache of this spider '
+                               '(can be repeated)')
+        parser.add_option('--chunk-size', type='int', default=500,
+                          help='items written per database round')
+
+    def run(self, args, opts):
+        cachedir = data_path(self.settings['HTTPCACHE_DIR'])
+        if not os.path.isdir(cachedir):
+            raise UsageError('No HTTP cache at %s' % cachedir)
+        names = opts.spider or sorted(os.listdir(cachedir))
+        paths = [os.path.join(cachedir, n) for n in names
+                 if os.path.isdir(os.path.join(cachedir, n))]
+        segment_size = self.settings.getint('HEMNET_HTTPCACHE_SEGMENT_SIZE')
+
+        # The same sold page can be cached by several spiders.
+        tasks, seen = [], set()
+        for path in paths:
+            cache = SegmentCache(path, segment_size)
+            entries = sorted(cache.index.items(), key=lambda kv: kv[1][1:3])
+            for key, entry in entries:
+                if entry[0] == 'sold' and key not in seen:
+                    seen.add(key)
+                    tasks.append((path, key))
+            cache.close()
+
+        # Upserts replace the stored rows in place: deleting them first
+        # would lose them for good when a batch fails.
+        pipeline = HemnetPipeline(
+            batch_size=self.settings.getint('HEMNET_PIPELINE_BATCH_SIZE'),
+            write_mode='upsert')
+        pool = Pool(opts.processes, _init_worker, (paths, segment_size))
+        start = time.time()
+        pages = written = 0
+        chunk = []
+        try:
+            for items in pool.imap_unordered(reparse_sold, tasks,
+                                             chunksize=64):
+                pages += 1
+                chunk.extend(items)
+                if len(chunk) >= opts.chunk_size:
+                    written += self._write(pipeline, chunk)
+                    chunk = []
+            written += self._write(pipeline, chunk)
+            pipeline.close_spider(None)
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - start
+        print('Re-parsed %d pages into %d items in %.1fs (%.0f pages/s)' % (
+            pages, written, elapsed, pages / elapsed if elapsed else 0))
+
+    def _write(self, pipeline, rows):
+        """Queue ``rows`` for writing over the stored ones."""
+        for row in rows:
+            if 'salda_id' in row:
+                pipeline.process_item(HemnetCompItem(row), None)
+            else:
+                pipeline.process_item(HemnetItem(row), None)
+        return len(rows)
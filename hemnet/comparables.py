@@ -0,0 +1,390 @@
+"""Nearest sold comparables for valuing a property.
+
+``ComparablesIndex`` holds every comp item with coordinates and a sold
+price (hemnet_comp_items joined to hemnet_items on the salda id) in NumPy
+arrays, sorted by the cell of a grid of about ``cell_size`` metres they
+fall in. A lookup only reads the cells within the search radius, computes
+great-circle distances for the comparables found there and keeps the
+``k`` nearest that pass the filters on type, rooms, living area and sale
+date, so it takes a fraction of a millisecond for a city block.
+
+The index is saved to a ``.npz`` file along with the highest comp id it
+holds. ``refresh`` reads only the comps added since, plus the rows whose
+``updated_at`` shows the pipeline rewrote them since the last refresh, so
+it is cheap enough to run after every crawl. The
+``ComparablesRefresh`` extension refreshes it when a crawl closes if
+``HEMNET_COMPARABLES_INDEX`` is set; ``scrapy comparables --refresh``
+refreshes it by hand.
+
+Needs NumPy.
+"""
+
+import json
+import logging
+import math
+import os
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.log import failure_to_exc_info
+from sqlalchemy import or_
+from sqlalchemy.orm import sessionmaker
+
+from hemnet.db import shared_pool
+from hemnet.models import (
+    HemnetItem as HemnetSQL,
+    HemnetCompItem as HemnetCompSQL,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS = 6371000.0
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# Longitude cells are twice as wide in degrees as latitude cells, which
+# makes them about square around 60 degrees north.
+LON_CELL_FACTOR = 2.0
+
+EPOCH = date(1970, 1, 1)
+
+# Rows stamped before a refresh started but committed after it read the
+# tables are picked up by the next refresh.
+REFRESH_OVERLAP = timedelta(minutes=10)
+
+REFRESHED_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+Comparable = namedtuple('Comparable', [
+    'salda_id', 'distance', 'price', 'sold_date', 'living_area', 'rooms',
+    'item_type', 'lat', 'lon',
+])
+
+# Arrays of an index, with their dtype. Missing living areas and rooms are
+# NaN; sold_day is days since 1970-01-01, -1 when unknown.
+COLUMNS = [
+    ('comp_id', 'int64'),
+    ('salda_id', 'int64'),
+    ('lat', 'float64'),
+    ('lon', 'float64'),
+    ('price', 'float64'),
+    ('sold_day', 'int32'),
+    ('living_area', 'float32'),
+    ('rooms', 'float32'),
+    ('item_type', 'int16'),
+]
+
+
+def _day(value):
+    return (value - EPOCH).days if value is not None else -1
+
+
+def load_rows(session, after_id=None, since=None):
+    """Comps with coordinates and a sold price, as tuples of ``COLUMNS``.
+
+    With ``after_id`` and ``since`` only the comps after that id and the
+    rows of either table updated at or after ``since`` are returned.
+    The item type is returned as a string.
+    """
+    q = session.query(HemnetCompSQL.id, HemnetCompSQL.salda_id,
+                      HemnetCompSQL.lattitude, HemnetCompSQL.longitude,
+                      HemnetSQL.price, HemnetSQL.sold_date,
+                      HemnetCompSQL.living_area, HemnetCompSQL.rooms,
+                      HemnetCompSQL.item_type)\
+        .join(HemnetSQL, HemnetSQL.hemnet_id == HemnetCompSQL.salda_id)\
+        .filter(HemnetCompSQL.lattitude.isnot(None))\
+        .filter(HemnetCompSQL.longitude.isnot(None))\
+        .filter(HemnetSQL.price.isnot(None))
+    if after_id is not None:
+        changed = [HemnetCompSQL.id > after_id]
+        if since is not None:
+            changed += [HemnetCompSQL.updated_at >= since,
+                        HemnetSQL.updated_at >= since]
+        q = q.filter(or_(*changed))
+    return q.order_by(HemnetCompSQL.id)\
+        .execution_options(stream_results=True).yield_per(10000)
+
+
+class ComparablesIndex(object):
+    """Grid index over the coordinates of sold comparables."""
+
+    def __init__(self, cell_size=500.0):
+        if np is None:
+            raise ImportError('The comparables index needs numpy: '
+                              'pip install numpy')
+        self.cell_size = float(cell_size)
+        self.lat_step = self.cell_size / METRES_PER_DEGREE
+        self.lon_step = self.lat_step * LON_CELL_FACTOR
+        self.ncols = int(math.ceil(360 / self.lon_step)) + 1
+        self.item_types = []
+        self.last_id = 0
+        self.refreshed = None
+        for name, dtype in COLUMNS:
+            setattr(self, name, np.zeros(0, dtype=dtype))
+        self.keys = np.zeros(0, dtype='int64')
+
+    def __len__(self):
+        return len(self.comp_id)
+
+    def _type_code(self, item_type):
+        if item_type not in self.item_types:
+            self.item_types.append(item_type)
+        return self.item_types.index(item_type)
+
+    def _rows(self, lat):
+        return np.floor((np.asarray(lat) + 90) / self.lat_step)\
+            .astype('int64')
+
+    def _cols(self, lon):
+        return np.floor((np.asarray(lon) + 180) / self.lon_step)\
+            .astype('int64')
+
+    def add(self, rows):
+        """Add tuples of ``COLUMNS``, replacing comps of the same salda id."""
+        codes = {}
+        columns = [[] for _ in COLUMNS]
+        for row in rows:
+            row = list(row)
+            row[5] = _day(row[5])
+            if row[8] not in codes:
+                codes[row[8]] = self._type_code(row[8])
+            row[8] = codes[row[8]]
+            for values, value in zip(columns, row):
+                values.append(value)
+        if not columns[0]:
+            return 0
+        new = dict((name, np.array(values, dtype=dtype))
+                   for (name, dtype), values in zip(COLUMNS, columns))
+        keep = ~np.isin(self.salda_id, new['salda_id'])
+        for name, _ in COLUMNS:
+            setattr(self, name, np.concatenate([getattr(self, name)[keep],
+                                                new[name]]))
+        self.last_id = max(self.last_id, int(new['comp_id'].max()))
+        self._sort()
+        return len(new['comp_id'])
+
+    def _sort(self):
+        keys = self._rows(self.lat) * self.ncols + self._cols(self.lon)
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        for name, _ in COLUMNS:
+            setattr(self, name, getattr(self, name)[order])
+
+    def _candidates(self, lat, lon, radius):
+        """Positions of the comps in the cells within ``radius``."""
+        dlat = radius / METRES_PER_DEGREE
+        dlon = radius / (METRES_PER_DEGREE *
+                         max(math.cos(math.radians(lat)), 0.01))
+        rows = np.arange(self._rows(lat - dlat), self._rows(lat + dlat) + 1)
+        first, last = self._cols(lon - dlon), self._cols(lon + dlon)
+        starts = np.searchsorted(self.keys, rows * self.ncols + first, 'left')
+        ends = np.searchsorted(self.keys, rows * self.ncols + last, 'right')
+        spans = [np.arange(s, e) for s, e in zip(starts, ends) if e > s]
+        if not spans:
+            return np.zeros(0, dtype='int64')
+        return np.concatenate(spans)
+
+    def nearest(self, lat, lon, k=10, radius=1000.0, item_type=None,
+                rooms=None, living_area=None, sold_after=None,
+                sold_before=None):
+        """The ``k`` nearest comparables within ``radius`` metres.
+
+        ``rooms`` and ``living_area`` are ``(min, max)`` ranges, either end
+        may be None; ``sold_after`` and ``sold_before`` are dates. Returns
+        a list of ``Comparable``, nearest first.
+        """
+        idx = self._candidates(lat, lon, radius)
+        if len(idx) and item_type is not None:
+            if item_type not in self.item_types:
+                return []
+            idx = idx[self.item_type[idx] == self.item_types.index(item_type)]
+        for values, bounds in ((self.rooms, rooms),
+                               (self.living_area, living_area)):
+            if not len(idx) or bounds is None:
+                continue
+            low, high = bounds
+            if low is not None:
+                idx = idx[values[idx] >= low]
+            if high is not None:
+                idx = idx[values[idx] <= high]
+        if len(idx) and sold_after is not None:
+            idx = idx[self.sold_day[idx] >= _day(sold_after)]
+        if len(idx) and sold_before is not None:
+            idx = idx[(self.sold_day[idx] >= 0) &
+                      (self.sold_day[idx] <= _day(sold_before))]
+        if not len(idx):
+            return []
+
+        distance = haversine(lat, lon, self.lat[idx], self.lon[idx])
+        within = distance <= radius
+        idx, distance = idx[within], distance[within]
+        if len(idx) > k:
+            nearest = np.argpartition(distance, k - 1)[:k]
+            idx, distance = idx[nearest], distance[nearest]
+        order = np.argsort(distance, kind='mergesort')
+        return [self._comparable(i, d)
+                for i, d in zip(idx[order], distance[order])]
+
+    def nearest_many(self, subjects, k=10, radius=1000.0, rooms_margin=None,
+                     area_margin=None, same_type=True, sold_after=None,
+                     sold_before=None):
+        """Look up comparables for many subject properties.
+
+        ``subjects`` are mappings with ``lat`` and ``lon`` and optionally
+        ``item_type``, ``rooms`` and ``living_area``. Comparables must have
+        the subject's item type when ``same_type`` is set, rooms within
+        ``rooms_margin`` of the subject's and a living area within
+        ``area_margin`` (a fraction, 0.2 is 20%) of the subject's. Yields
+        the subject and its list of comparables.
+        """
+        for subject in subjects:
+            rooms = living_area = None
+            if rooms_margin is not None and subject.get('rooms') is not None:
+                rooms = (subject['rooms'] - rooms_margin,
+                         subject['rooms'] + rooms_margin)
+            if area_margin is not None and \
+                    subject.get('living_area') is not None:
+                living_area = (subject['living_area'] * (1 - area_margin),
+                               subject['living_area'] * (1 + area_margin))
+            yield subject, self.nearest(
+                subject['lat'], subject['lon'], k=k, radius=radius,
+                item_type=subject.get('item_type') if same_type else None,
+                rooms=rooms, living_area=living_area,
+                sold_after=sold_after, sold_before=sold_before)
+
+    def _comparable(self, i, distance):
+        day = int(self.sold_day[i])
+        return Comparable(
+            salda_id=int(self.salda_id[i]),
+            distance=float(distance),
+            price=float(self.price[i]),
+            sold_date=EPOCH + timedelta(days=day) if day >= 0 else None,
+            living_area=_optional(self.living_area[i]),
+            rooms=_optional(self.rooms[i]),
+            item_type=self.item_types[self.item_type[i]],
+            lat=float(self.lat[i]),
+            lon=float(self.lon[i]),
+        )
+
+    def refresh(self, session):
+        """Read the comps added or rewritten since the last refresh.
+
+        Returns the number of comps read.
+        """
+        started = datetime.now()
+        if self.refreshed is None:
+            rows = load_rows(session)
+        else:
+            rows = load_rows(session, after_id=self.last_id,
+                             since=self.refreshed - REFRESH_OVERLAP)
+        count = self.add(rows)
+        self.refreshed = started
+        return count
+
+    def save(self, path):
+        meta = {
+            'cell_size': self.cell_size,
+            'item_types': self.item_types,
+            'last_id': self.last_id,
+            'refreshed': self.refreshed.strftime(REFRESHED_FORMAT)
+            if self.refreshed else None,
+        }
+        arrays = dict((name, getattr(self, name)) for name, _ in COLUMNS)
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, meta=np.array(json.dumps(meta)), **arrays)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=False)
+        meta = json.loads(str(data['meta']))
+        index = cls(meta['cell_size'])
+        index.item_types = meta['item_types']
+        index.last_id = meta['last_id']
+        refreshed = meta['refreshed']
+        if refreshed:
+            # indexes saved before updated_at only kept the day
+            fmt = '%Y-%m-%d' if len(refreshed) == 10 else REFRESHED_FORMAT
+            index.refreshed = datetime.strptime(refreshed, fmt)
+        for name, dtype in COLUMNS:
+            setattr(index, name, data[name].astype(dtype))
+        index._sort()
+        return index
+
+
+def _optional(value):
+    return None if np.isnan(value) else float(value)
+
+
+def haversine(lat, lon, lats, lons):
+    """Great-circle distances in metres from one point to arrays of them."""
+    lat, lon = math.radians(lat), math.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + \
+        math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def refresh_index(engine, path, cell_size=500.0, full=False):
+    """Load the index at ``path`` (or start one), refresh and save it.
+
+    Returns the index and the number of comps read.
+    """
+    start = time.time()
+    if os.path.exists(path) and not full:
+        index = ComparablesIndex.load(path)
+    else:
+        index = ComparablesIndex(cell_size)
+    session = sessionmaker(bind=engine)()
+    try:
+        count = index.refresh(session)
+    finally:
+        session.close()
+    index.save(path)
+    logger.info('Refreshed comparables index %s with %d comps, %d in total, '
+                'in %.1fs', path, count, len(index), time.time() - start)
+    return index, count
+
+
+class ComparablesRefresh(object):
+    """Refresh the comparables index when a spider closes."""
+
+    def __init__(self, stats, db, path, cell_size):
+        self.stats = stats
+        self.db = db
+        self.path = path
+        self.cell_size = cell_size
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        path = settings.get('HEMNET_COMPARABLES_INDEX')
+        if not path:
+            raise NotConfigured
+        if np is None:
+            raise NotConfigured('The comparables index needs numpy')
+        o = cls(crawler.stats, shared_pool(settings), path,
+                settings.getfloat('HEMNET_COMPARABLES_CELL_SIZE', 500))
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_closed(self, spider, reason):
+        d = self.db.run(refresh_index, self.db.engine, self.path,
+                        self.cell_size)
+        d.addCallbacks(self._refreshed, self._failed)
+        return d
+
+    def _refreshed(self, result):
+        index, count = result
+        self.stats.set_value('hemnet/comparables/refreshed', count)
+        self.stats.set_value('hemnet/comparables/total', len(index))
+
+    def _failed(self, failure):
+        logger.error('Could not refresh the comparables index %s', self.path,
+                     exc_info=failure_to_exc_info(failure))
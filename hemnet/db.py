@@ -0,0 +1,114 @@
+"""One database engine per process and a thread pool to run queries on.
+
+SQLAlchemy calls block, and a query running on the reactor thread stops
+every download until it returns. The spiders, ``HemnetPipeline`` and the
+``AnalyticsRefresh`` extension hand their database work to
+``DatabasePool.run`` instead, which calls it in one of
+``HEMNET_DB_THREADS`` worker threads and returns a Deferred firing in the
+reactor thread.
+
+At most ``HEMNET_DB_THREADS`` calls run at once; the rest wait in line.
+The pipeline returns the Deferred of its writes to Scrapy, which counts
+the items in progress against ``SCRAPER_SLOT_MAX_ACTIVE_SIZE`` and stops
+starting new downloads while too many wait for the database, so a slow
+database slows the crawl down instead of filling memory.
+
+All of them share the engine of ``get_engine``, whose connection pool
+holds ``HEMNET_DB_POOL_SIZE`` connections (plus ``HEMNET_DB_MAX_OVERFLOW``
+when busy); keep it at least as large as the thread pool.
+"""
+
+import threading
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+from hemnet.models import create_hemnet_table, database_url, db_connect
+
+# Engines by URL and the pool of each, shared by the whole process.
+_engines = {}
+_pools = {}
+_lock = threading.Lock()
+
+
+def get_engine(pool_size=5, max_overflow=10):
+    """Return the engine of ``database_url()``, creating it on first use.
+
+    The tables are created along with the engine. The pool sizes only
+    apply to the call that creates it.
+    """
+    key = str(database_url())
+    with _lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = db_connect(pool_size=pool_size,
+                                max_overflow=max_overflow)
+            create_hemnet_table(engine)
+            _engines[key] = engine
+        return engine
+
+
+def shared_pool(settings):
+    """Return the process-wide ``DatabasePool`` configured by ``settings``."""
+    engine = get_engine(
+        pool_size=settings.getint('HEMNET_DB_POOL_SIZE', 5),
+        max_overflow=settings.getint('HEMNET_DB_MAX_OVERFLOW', 10))
+    with _lock:
+        pool = _pools.get(engine)
+        if pool is None:
+            pool = _pools[engine] = DatabasePool(
+                engine, settings.getint('HEMNET_DB_THREADS', 4))
+        return pool
+
+
+class DatabasePool(object):
+    """Run blocking database calls in a bounded pool of threads.
+
+    With ``threads=0`` calls run straight away in the calling thread, for
+    code that has no running reactor, and ``run`` returns a Deferred that
+    already fired.
+    """
+
+    def __init__(self, engine, threads=4):
+        self.engine = engine
+        self.threads = threads
+        self.semaphore = defer.DeferredSemaphore(max(threads, 1))
+        self.threadpool = None
+        self.shutdown_trigger = None
+
+    def start(self):
+        if self.threadpool is not None:
+            return
+        self.threadpool = ThreadPool(self.threads, self.threads,
+                                     name='hemnet-db')
+        self.threadpool.start()
+        if self.shutdown_trigger is None:
+            self.shutdown_trigger = reactor.addSystemEventTrigger(
+                'during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.threadpool is None:
+            return
+        self.threadpool.stop()
+        self.threadpool = None
+
+    def run(self, f, *args, **kwargs):
+        """Call ``f(*args, **kwargs)`` in a worker thread.
+
+        The Deferred fires with its result in the reactor thread.
+        """
+        if not self.threads:
+            return defer.maybeDeferred(f, *args, **kwargs)
+        self.start()
+        return self.semaphore.run(threads.deferToThreadPool, reactor,
+                                  self.threadpool, f, *args, **kwargs)
+
+    @property
+    def busy(self):
+        """Calls running in a worker thread."""
+        return self.semaphore.limit - self.semaphore.tokens
+
+    @property
+    def waiting(self):
+        """Calls waiting for a free thread."""
+        return len(self.semaphore.waiting)
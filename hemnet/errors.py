@@ -0,0 +1,196 @@
+"""Failed requests are recorded in a JSON lines file that doubles as a retry
+queue.
+
+Each line describes one failure: url, callback, error class, HTTP status,
+attempt number, timestamp and the simple values of the request meta, with
+namedtuples (a search partition) stored as dicts. Spiders
+mixing in ``ErrorQueueMixin`` write there from their errbacks and, when
+started with ``-a retry_errors=1``, crawl the due entries of the queue
+instead of their usual start requests.
+"""
+
+import json
+import logging
+import os
+import time
+
+import scrapy
+from scrapy.spidermiddlewares.httperror import HttpError
+
+logger = logging.getLogger(__name__)
+
+SIMPLE_TYPES = (bool, int, float, type(None), type(u''), type(''))
+
+# Meta keys that only mean something to the run that set them.
+RUN_META = ('depth', 'attempt', 'frontier_id', 'tier_ticket', 'queue_ticket',
+            'queue_parent')
+
+# Sent by ErrorQueueMixin.download_err_back with the failed request, so
+# components can tell a request is finished; Scrapy has no signal for it.
+request_failed = object()
+
+
+def _simple_meta(meta):
+    """The meta values worth keeping for a retry.
+
+    Namedtuples are kept as dicts; see ``ErrorQueueMixin.retry_meta``.
+    """
+    simple = {}
+    for k, v in meta.items():
+        if k.startswith('download_') or k in RUN_META:
+            continue
+        if isinstance(v, SIMPLE_TYPES):
+            simple[k] = v
+        elif isinstance(v, tuple) and hasattr(v, '_asdict'):
+            simple[k] = dict(v._asdict())
+    return simple
+
+
+class ErrorSink(object):
+    """Append failure records to ``path``, ``buffer_size`` at a time."""
+
+    def __init__(self, path, buffer_size=100):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def record(self, url, callback, error, status=None, attempt=1,
+               meta=None):
+        self.buffer.append({
+            'url': url,
+            'callback': callback,
+            'error': error,
+            'status': status,
+            'attempt': attempt,
+            'ts': time.time(),
+            'meta': meta or {},
+        })
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        with open(self.path, 'a') as f:
+            for entry in self.buffer:
+                f.write(json.dumps(entry) + '\n')
+        self.buffer = []
+
+    close = flush
+
+
+def take_due(path, now=None, backoff=60, max_attempts=5, priorities=None):
+    """Take the entries whose backoff has passed out of the queue at ``path``.
+
+    Only the latest failure per URL is kept. An entry is due
+    ``backoff * 2 ** (attempt - 1)`` seconds after it failed; entries that
+    are not due yet go back into the queue, entries that already failed
+    ``max_attempts`` times are moved to ``<path>.dead``.
+
+    Due entries are returned by callback priority (``priorities`` maps
+    callback names to numbers, higher first), then fewest attempts.
+    """
+    if not os.path.exists(path):
+        return []
+    now = time.time() if now is None else now
+    draining = path + '.draining'
+    os.rename(path, draining)
+
+    latest = {}
+    with open(draining) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            old = latest.get(entry['url'])
+            if old is None or entry['attempt'] >= old['attempt']:
+                latest[entry['url']] = entry
+
+    due, later, dead = [], [], []
+    for entry in latest.values():
+        if entry['attempt'] >= max_attempts:
+            dead.append(entry)
+        elif entry['ts'] + backoff * 2 ** (entry['attempt'] - 1) <= now:
+            due.append(entry)
+        else:
+            later.append(entry)
+
+    for target, entries in ((path, later), (path + '.dead', dead)):
+        if entries:
+            with open(target, 'a') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry) + '\n')
+    os.remove(draining)
+
+    logger.info('Error queue %s: %d due, %d waiting, %d given up',
+                path, len(due), len(later), len(dead))
+    priorities = priorities or {}
+    due.sort(key=lambda e: (-priorities.get(e['callback'], 0),
+                            e['attempt'], e['ts']))
+    return due
+
+
+class ErrorQueueMixin(object):
+    """Errback and error queue shared by the spiders.
+
+    ``retry_priorities`` maps callback names to the priority of their
+    retried requests. Spiders override ``retry_meta`` to rebuild the meta
+    values recorded as dicts.
+    """
+
+    retry_errors = False
+    retry_priorities = {}
+
+    @property
+    def error_sink(self):
+        sink = self.__dict__.get('_error_sink')
+        if sink is None:
+            settings = getattr(self, 'settings', None)
+            path = settings.get('HEMNET_ERROR_QUEUE') if settings else None
+            path = (path or '%(name)s_err.jsonl') % {'name': self.name}
+            size = settings.getint('HEMNET_ERROR_BUFFER', 100) \
+                if settings else 100
+            sink = self.__dict__['_error_sink'] = ErrorSink(path, size)
+        return sink
+
+    def _write_err(self, error, request, status=None):
+        callback = request.callback
+        name = getattr(callback, '__name__', None) or 'parse'
+        attempt = request.meta.get('attempt', 0) + 1
+        self.error_sink.record(request.url, name, error, status=status,
+                               attempt=attempt,
+                               meta=_simple_meta(request.meta))
+        self.logger.debug('%s (attempt %d): %s', error, attempt, request.url)
+
+    def download_err_back(self, failure):
+        status = None
+        if failure.check(HttpError):
+            status = failure.value.response.status
+        self._write_err(failure.type.__name__, failure.request, status)
+        crawler = getattr(self, 'crawler', None)
+        if crawler is not None:
+            crawler.signals.send_catch_log(signal=request_failed,
+                                           request=failure.request,
+                                           failure=failure, spider=self)
+
+    def retry_meta(self, meta):
+        """Turn the meta of a queue entry back into request meta."""
+        return meta
+
+    def retry_requests(self):
+        settings = self.settings
+        due = take_due(
+            self.error_sink.path,
+            backoff=settings.getfloat('HEMNET_ERROR_BACKOFF', 60),
+            max_attempts=settings.getint('HEMNET_ERROR_MAX_ATTEMPTS', 5),
+            priorities=self.retry_priorities)
+        for entry in due:
+            callback = entry['callback']
+            yield scrapy.Request(entry['url'], getattr(self, callback),
+                                 meta=dict(self.retry_meta(entry['meta']),
+                                           attempt=entry['attempt']),
+                                 priority=self.retry_priorities.get(callback,
+                                                                    0),
+                                 errback=self.download_err_back,
+                                 dont_filter=True)
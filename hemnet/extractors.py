@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+"""Extract data from Hemnet pages in a single pass over the parsed tree.
+
+The spiders used to run a handful of CSS queries per page plus two regular
+expressions over the whole body. The functions here reuse the lxml tree
+Scrapy already built for the response, evaluate precompiled XPath
+expressions and only look for the dataLayer and the coordinates inside
+``<script>`` elements.
+"""
+
+import json
+import re
+from collections import namedtuple
+
+from lxml import etree
+
+from urlparse import urlparse
+
+from hemnet.items import HemnetItem, HemnetCompItem
+
+
+def _has_class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+
+SCRIPTS = etree.XPath('//script/text()')
+PREV_URL = etree.XPath('//link[@rel="prev"]/@href')
+BROKER_CARD = etree.XPath(
+    '//*[%s]' % _has_class('broker-contact-card__information'))
+BROKER_NAME = etree.XPath('.//strong/text()')
+BROKER_LINKS = etree.XPath(
+    './/a[%s]/@href' % _has_class('broker-contact__link'))
+PHONE_NUMBERS = etree.XPath('.//*[%s]/@href' % _has_class('phone-number'))
+ATTRIBUTES = etree.XPath('//*[%s]/*[self::dt or self::dd]'
+                         % _has_class('sold-property__attributes'))
+TEXT = etree.XPath('text()')
+
+DATA_LAYER_RE = re.compile(r'dataLayer\s*=\s*(?=\[)')
+COORDS_RE = re.compile(r'coordinate.*\[(\d{2}\.\d+\,\d{2}\.\d+)\]')
+
+_decoder = json.JSONDecoder()
+
+
+SoldPage = namedtuple('SoldPage', [
+    'sold_property',
+    'lat',
+    'lon',
+    'broker_name',
+    'broker_phone',
+    'broker_email',
+    'broker_firm_phone',
+    'attributes',
+    'prev_url',
+])
+
+ListingPage = namedtuple('ListingPage', ['property'])
+
+
+class ExtractError(ValueError):
+    """The page has no usable dataLayer."""
+
+
+def _root(response):
+    return response.selector.root
+
+
+def scan_scripts(root):
+    """Return the dataLayer list and the coordinates found in ``root``."""
+    layer_data, coords = None, (None, None)
+    for text in SCRIPTS(root):
+        if layer_data is None and 'dataLayer' in text:
+            m = DATA_LAYER_RE.search(text)
+            if m:
+                try:
+                    layer_data, _ = _decoder.raw_decode(text, m.end())
+                except ValueError:
+                    pass
+        if coords[0] is None and 'coordinate' in text:
+            m = COORDS_RE.search(text)
+            if m:
+                coords = tuple(map(float, m.group(1).split(',')))
+    return layer_data, coords
+
+
+def _layer_entry(layer_data, key):
+    if layer_data is None:
+        return None
+    return next((el for el in layer_data if key in el), {}).get(key, {})
+
+
+def extract_coords(response):
+    _, coords = scan_scripts(_root(response))
+    return coords
+
+
+def attributes(root):
+    """Pair every ``dt`` of the attribute list with the ``dd`` after it."""
+    attrs = {}
+    key = None
+    for el in ATTRIBUTES(root):
+        text = u''.join(TEXT(el))
+        if el.tag == 'dt':
+            key = text.strip()
+        elif key is not None:
+            attrs[key] = text
+            key = None
+    return attrs
+
+
+def get_property_attributes(response):
+    return attributes(_root(response))
+
+
+def extract_sold_page(response):
+    """Extract everything the spiders read from a sold (``salda``) page.
+
+    Fields missing from the page are ``None``; ``sold_property`` is ``None``
+    when the page has no dataLayer.
+    """
+    root = _root(response)
+    layer_data, (lat, lon) = scan_scripts(root)
+    sold_property = _layer_entry(layer_data, u'sold_property')
+
+    broker_name = broker_phone = broker_email = broker_firm_phone = None
+    cards = BROKER_CARD(root)
+    if cards:
+        card = cards[0]
+        names = BROKER_NAME(card)
+        if names:
+            broker_name = names[0].strip()
+        links = BROKER_LINKS(card)
+        if len(links) == 2:
+            broker_phone = strip_phone(links[0])
+            email = decode_email(links[1])
+            if email:
+                broker_email = email.split('?')[0]
+        phones = PHONE_NUMBERS(card)
+        if len(phones) > 1:
+            broker_firm_phone = strip_phone(phones[1])
+
+    prev_urls = PREV_URL(root)
+
+    return SoldPage(
+        sold_property=sold_property,
+        lat=lat,
+        lon=lon,
+        broker_name=broker_name,
+        broker_phone=broker_phone,
+        broker_email=broker_email,
+        broker_firm_phone=broker_firm_phone,
+        attributes=attributes(root),
+        prev_url=prev_urls[0] if prev_urls else None,
+    )
+
+
+def extract_listing_page(response):
+    """Extract the ``property`` entry of a listing page's dataLayer.
+
+    Raises ``ExtractError`` when the page has no dataLayer.
+    """
+    layer_data, _ = scan_scripts(_root(response))
+    if layer_data is None:
+        raise ExtractError('dataLayer not found')
+    return ListingPage(property=_layer_entry(layer_data, u'property'))
+
+
+def _int_attr(attrs, name, suffix=u''):
+    try:
+        return int(attrs.get(name, '').replace(suffix, u'')
+                   .replace(u'\xa0', u''))
+    except ValueError:
+        return None
+
+
+def _area_attr(attrs, name):
+    try:
+        return int(attrs.get(name).strip().rsplit(' ')[0]
+                   .replace(u'\xa0', ''))
+    except (AttributeError, ValueError):
+        return None
+
+
+def sold_item(page, url):
+    """Build a ``HemnetItem`` from a ``SoldPage``."""
+    props = page.sold_property
+    attrs = page.attributes
+    item = HemnetItem()
+
+    item['url'] = url
+    slug = urlparse(url).path.split('/')[-1]
+    item['hemnet_id'] = props.get('id')
+    item['type'] = slug.split('-')[0]
+
+    try:
+        item['rooms'] = float(props.get('rooms'))
+    except (TypeError, ValueError):
+        pass
+
+    item['monthly_fee'] = _int_attr(attrs, u'Avgift/månad', u' kr/m\xe5n')
+
+    try:
+        item['square_meters'] = float(props.get('living_area'))
+    except (TypeError, ValueError):
+        pass
+
+    item['cost_per_year'] = _int_attr(attrs, u'Driftskostnad', u' kr/\xe5r')
+
+    # can be '2008-2009'
+    item['year'] = attrs.get(u'Byggår', '')
+
+    association = attrs.get(u'Förening')
+    item['association'] = association.strip() if association else None
+
+    item['lot_size'] = _area_attr(attrs, u'Tomtarea')
+    item['biarea'] = _area_attr(attrs, u'Biarea')
+
+    item['broker_name'] = page.broker_name or u''
+    item['broker_phone'] = page.broker_phone or u''
+    if page.broker_email is not None:
+        item['broker_email'] = page.broker_email
+
+    item['broker_firm'] = props.get('broker_agency')
+    item['broker_firm_phone'] = page.broker_firm_phone
+    item['price'] = props.get('selling_price')
+    item['asked_price'] = props.get('price')
+    item['sold_date'] = props.get('sold_at_date')
+    item['address'] = props.get('street_address')
+    item['geographic_area'] = props.get('location')
+
+    item['lat'] = page.lat
+    item['lon'] = page.lon
+    item['listing_url'] = page.prev_url
+    return item
+
+
+def comp_item(listing, url, lat, lon, salda_id):
+    """Build a ``HemnetCompItem`` from a ``ListingPage``."""
+    prop = listing.property
+    item = HemnetCompItem()
+
+    item['url'] = url
+
+    item['lattitude'] = lat
+    item['longitude'] = lon
+
+    item['salda_id'] = salda_id
+
+    locations = prop.get('locations', {})
+
+    item['city'] = locations.get('city')
+    item['district'] = locations.get('district')
+    item['postal_city'] = locations.get('postal_city')
+    item['country'] = locations.get('country')
+    item['municipality'] = locations.get('municipality')
+    item['region'] = locations.get('county', locations.get('region'))
+    item['street'] = locations.get('street')
+
+    item['offers_selling_price'] = prop.get('offers_selling_price')
+    item['living_area'] = prop.get('living_area')
+    item['rooms'] = prop.get('rooms')
+    item['hemnet_id'] = prop.get('id')
+    item['cost_per_year'] = prop.get('driftkostnad')
+    item['new_production'] = prop.get('new_production')
+    item['broker_firm'] = prop.get('broker_firm')
+    item['upcoming_open_houses'] = prop.get('upcoming_open_houses')
+    item['location'] = prop.get('location')
+    item['home_swapping'] = prop.get('home_swapping')
+    item['has_price_change'] = prop.get('has_price_change')
+    item['status'] = prop.get('status')
+    item['price'] = prop.get('price')
+    item['monthly_fee'] = prop.get('borattavgift')
+    item['main_location'] = prop.get('main_location')
+    item['publication_date'] = prop.get('publication_date')
+    item['has_active_toplisting'] = prop.get('has_active_toplisting')
+    item['images_count'] = prop.get('images_count')
+    item['item_type'] = prop.get('item_type')
+    item['price_per_m2'] = prop.get('price_per_m2')
+    item['street_address'] = prop.get('street_address')
+    return item
+
+
+def cfDecodeEmail(encodedString):
+    r = int(encodedString[:2],16)
+    email = ''.join([chr(int(encodedString[i:i+2], 16) ^ r) for i in
+                     range(2, len(encodedString), 2)])
+    return email
+
+
+def decode_email(encoded_str):
+    # u'/cdn-cgi/l/email-protection#b2d8d7c1c2d7c09cdead...'
+    try:
+        decoded = cfDecodeEmail(encoded_str.split('#')[-1])
+    except:
+        decoded = None
+    return decoded
+
+
+def strip_phone(phone_text):
+    if phone_text:
+        return phone_text.replace(u'tel:', u'')
+    else:
+        return u''
@@ -0,0 +1,272 @@
+"""Scheduler keeping the requests of a crawl in a shared Postgres table.
+
+Several Scrapy processes, on one machine or many, run the same spider with::
+
+    scrapy crawl hemnetspider -s SCHEDULER=hemnet.frontier.FrontierScheduler \\
+        -s HEMNET_FRONTIER_CRAWL=sold-2016-06-01
+
+and split the work between them. Every scheduled request is inserted into
+``hemnet_frontier`` under the crawl name; the unique (crawl, fingerprint)
+key drops requests another worker already queued, so all workers may run
+``start_requests``. Workers lease a batch of queued rows at a time with
+``FOR UPDATE SKIP LOCKED``, so they never wait on each other, and mark a
+row done when its response arrives. A lease that is not done within
+``HEMNET_FRONTIER_VISIBILITY_TIMEOUT`` seconds (the worker died or the
+download failed) makes the row available to the workers again, up to
+``HEMNET_FRONTIER_MAX_ATTEMPTS`` leases.
+
+A worker keeps running while any row of the crawl is queued or leased, so
+it picks up the requests other workers are still producing.
+"""
+
+import heapq
+import logging
+import os
+import pickle
+import socket
+import uuid
+from datetime import date
+from timeit import default_timer as clock
+
+from scrapy import signals
+from scrapy.utils.reqser import request_to_dict, request_from_dict
+from scrapy.utils.request import request_fingerprint
+from sqlalchemy import LargeBinary, bindparam, text
+
+from hemnet.db import shared_pool
+from hemnet.models import is_postgres
+
+logger = logging.getLogger(__name__)
+
+# Sent by FrontierScheduler with a request it queued in the table, which
+# any worker may download; components tracking the request in this process
+# (see TierMiddleware) can let go of it.
+request_shared = object()
+
+# Meta keys that only mean something to the process that set them, left out
+# of the queued request.
+LOCAL_META = ('frontier_id', 'tier_ticket')
+
+INSERT = text("""
+    INSERT INTO hemnet_frontier
+        (crawl, fingerprint, priority, request, state, attempts, created_at)
+    VALUES (:crawl, :fingerprint, :priority, :request, 'queued', 0, now())
+    ON CONFLICT (crawl, fingerprint) DO NOTHING
+""").bindparams(bindparam('request', type_=LargeBinary))
+
+LEASE = text("""
+    UPDATE hemnet_frontier f
+    SET state = 'leased', leased_by = :worker, attempts = f.attempts + 1,
+        lease_expires = now() + :timeout * interval '1 second'
+    WHERE f.id IN (
+        SELECT id FROM hemnet_frontier
+        WHERE crawl = :crawl
+          AND (state = 'queued'
+               OR (state = 'leased' AND lease_expires < now()
+                   AND attempts < :max_attempts))
+        ORDER BY priority DESC, id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED)
+    RETURNING f.id, f.priority, f.request
+""")
+
+ACK = text("""
+    UPDATE hemnet_frontier SET state = 'done', lease_expires = NULL
+    WHERE id = ANY(:ids) AND leased_by = :worker
+""")
+
+RELEASE = text("""
+    UPDATE hemnet_frontier
+    SET state = 'queued', leased_by = NULL, lease_expires = NULL,
+        attempts = attempts - 1
+    WHERE id = ANY(:ids) AND leased_by = :worker AND state = 'leased'
+""")
+
+GIVE_UP = text("""
+    UPDATE hemnet_frontier SET state = 'failed'
+    WHERE crawl = :crawl AND state = 'leased' AND lease_expires < now()
+      AND attempts >= :max_attempts
+""")
+
+PENDING = text("""
+    SELECT count(*) FROM hemnet_frontier
+    WHERE crawl = :crawl AND state IN ('queued', 'leased')
+""")
+
+
+class FrontierScheduler(object):
+    """Scrapy ``SCHEDULER`` backed by the ``hemnet_frontier`` table.
+
+    ``HEMNET_FRONTIER_CRAWL`` names the crawl the workers share; it may
+    contain ``%(name)s`` and ``%(date)s`` and defaults to one crawl per
+    spider and day.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.signals = crawler.signals
+        self.stats = crawler.stats
+        self.crawl_template = settings.get('HEMNET_FRONTIER_CRAWL') or \
+            '%(name)s-%(date)s'
+        self.lease_size = settings.getint('HEMNET_FRONTIER_LEASE_SIZE', 32)
+        self.insert_batch = settings.getint('HEMNET_FRONTIER_INSERT_BATCH',
+                                            100)
+        self.timeout = settings.getint('HEMNET_FRONTIER_VISIBILITY_TIMEOUT',
+                                       300)
+        self.max_attempts = settings.getint('HEMNET_FRONTIER_MAX_ATTEMPTS', 3)
+        self.poll_interval = settings.getfloat(
+            'HEMNET_FRONTIER_POLL_INTERVAL', 5)
+        self.worker = '%s:%d' % (socket.gethostname(), os.getpid())
+        # The scheduler interface is synchronous, its queries run on the
+        # reactor thread; they are small and keyed by index.
+        self.engine = shared_pool(settings).engine
+        if not is_postgres(self.engine):
+            raise ValueError('FrontierScheduler needs Postgres, not %s'
+                             % self.engine.dialect.name)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = cls(crawler)
+        crawler.signals.connect(o.response_received,
+                                signal=signals.response_received)
+        return o
+
+    def open(self, spider):
+        self.spider = spider
+        self.crawl = self.crawl_template % {
+            'name': spider.name, 'date': date.today().isoformat()}
+        self.inserts = []
+        self.leased = []      # heap of (-priority, id, request)
+        self.unserializable = []
+        self.in_flight = set()
+        self.done = []
+        self.remote_pending = 0
+        self.last_poll = self.last_empty_lease = None
+        logger.info('Sharing crawl %s through the frontier as %s',
+                    self.crawl, self.worker, extra={'spider': spider})
+
+    def close(self, reason):
+        self._flush_inserts()
+        self._flush_done()
+        ids = [entry[1] for entry in self.leased] + list(self.in_flight)
+        if ids:
+            with self.engine.begin() as conn:
+                conn.execute(RELEASE, ids=ids, worker=self.worker)
+            logger.info('Released %d leased requests', len(ids),
+                        extra={'spider': self.spider})
+
+    def has_pending_requests(self):
+        return len(self) > 0
+
+    def __len__(self):
+        self._poll()
+        return (len(self.inserts) + len(self.leased) +
+                len(self.unserializable) + self.remote_pending)
+
+    def enqueue_request(self, request):
+        self.last_empty_lease = None
+        fingerprint = request_fingerprint(request)
+        if request.dont_filter:
+            fingerprint += ':' + uuid.uuid4().hex
+        try:
+            d = request_to_dict(request, self.spider)
+            d['meta'] = dict((k, v) for k, v in d['meta'].items()
+                             if k not in LOCAL_META)
+            data = pickle.dumps(d, protocol=2)
+        except (ValueError, pickle.PicklingError) as e:
+            logger.error('Keeping unserializable request %s in memory: %s',
+                         request, e, extra={'spider': self.spider})
+            self.unserializable.append(request)
+            self.stats.inc_value('scheduler/enqueued/memory',
+                                 spider=self.spider)
+            return True
+        self.inserts.append({'crawl': self.crawl, 'fingerprint': fingerprint,
+                             'priority': request.priority, 'request': data})
+        if len(self.inserts) >= self.insert_batch:
+            self._flush_inserts()
+        self.stats.inc_value('scheduler/enqueued/frontier', spider=self.spider)
+        self.stats.inc_value('scheduler/enqueued', spider=self.spider)
+        self.signals.send_catch_log(signal=request_shared, request=request,
+                                    spider=self.spider)
+        return True
+
+    def next_request(self):
+        if self.unserializable:
+            return self.unserializable.pop()
+        if not self.leased:
+            self._flush_inserts()
+            self._flush_done()
+            self._lease()
+        if not self.leased:
+            return None
+        _, frontier_id, data = heapq.heappop(self.leased)
+        request = request_from_dict(pickle.loads(data), self.spider)
+        request.meta['frontier_id'] = frontier_id
+        self.in_flight.add(frontier_id)
+        self.stats.inc_value('scheduler/dequeued/frontier', spider=self.spider)
+        self.stats.inc_value('scheduler/dequeued', spider=self.spider)
+        return request
+
+    def response_received(self, response, request, spider):
+        frontier_id = request.meta.get('frontier_id')
+        if frontier_id in self.in_flight:
+            self.in_flight.discard(frontier_id)
+            self.done.append(frontier_id)
+            if len(self.done) >= self.insert_batch:
+                self._flush_done()
+
+    def _flush_inserts(self):
+        if not self.inserts:
+            return
+        rows, self.inserts = self.inserts, []
+        with self.engine.begin() as conn:
+            conn.execute(INSERT, rows)
+
+    def _flush_done(self):
+        if not self.done:
+            return
+        ids, self.done = self.done, []
+        with self.engine.begin() as conn:
+            conn.execute(ACK, ids=ids, worker=self.worker)
+
+    def _lease(self):
+        now = clock()
+        if self.last_empty_lease is not None and \
+                now - self.last_empty_lease < self.poll_interval:
+            return
+        with self.engine.begin() as conn:
+            rows = conn.execute(LEASE, worker=self.worker, crawl=self.crawl,
+                                timeout=self.timeout,
+                                max_attempts=self.max_attempts,
+                                limit=self.lease_size).fetchall()
+        for frontier_id, priority, data in rows:
+            heapq.heappush(self.leased, (-priority, frontier_id, bytes(data)))
+        self.stats.inc_value('scheduler/frontier/leases', spider=self.spider)
+        if rows:
+            self.last_empty_lease = None
+        else:
+            self.last_empty_lease = now
+
+    def _poll(self):
+        """Refresh the count of rows still queued or leased by anyone.
+
+        The engine asks for it on every idle check; the database is only
+        asked every ``poll_interval`` seconds.
+        """
+        now = clock()
+        if self.last_poll is not None and \
+                now - self.last_poll < self.poll_interval:
+            return
+        self.last_poll = now
+        self._flush_inserts()
+        self._flush_done()
+        with self.engine.begin() as conn:
+            failed = conn.execute(GIVE_UP, crawl=self.crawl,
+                                  max_attempts=self.max_attempts).rowcount
+            self.remote_pending = conn.execute(PENDING,
+                                               crawl=self.crawl).scalar()
+        if failed:
+            logger.warning('Gave up on %d requests after %d leases', failed,
+                           self.max_attempts, extra={'spider': self.spider})
+            self.stats.inc_value('scheduler/frontier/failed', failed,
+                                 spider=self.spider)
@@ -0,0 +1,264 @@
+"""HTTP cache storage packing responses into compressed segment files.
+
+Responses are zlib-compressed and appended to numbered segment files; a
+small append-only index maps a key to the segment, offset and age of the
+newest record. Hemnet pages are keyed by page type and hemnet id rather than
+request fingerprint, so a page is found again whatever query string led to
+it, and each page type has its own expiry (sold pages never change, listing
+and result pages do).
+
+Overwritten and expired records stay in the segments until ``compact`` copies
+the live records to new segments, which happens automatically when the
+spider closes and too large a share of the cache is dead.
+
+To use it::
+
+    HTTPCACHE_ENABLED = True
+    HTTPCACHE_STORAGE = 'hemnet.httpcache.SegmentCacheStorage'
+"""
+
+import glob
+import json
+import logging
+import os
+import pickle
+import re
+import struct
+import zlib
+from time import time
+
+from urlparse import urlparse
+
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from scrapy.utils.request import request_fingerprint
+
+logger = logging.getLogger(__name__)
+
+SOLD_PATH_RE = re.compile(r'^/salda/(?!bostader)[^/]*-(\d+)$')
+LISTING_PATH_RE = re.compile(r'^/bostad/[^/]*-(\d+)$')
+RESULTS_PATH = '/salda/bostader'
+
+RECORD_HEADER = struct.Struct('>I')
+
+
+def page_key(request):
+    """Return ``(page_type, key)`` for a request.
+
+    Sold and listing pages are keyed by their hemnet id, everything else
+    by request fingerprint.
+    """
+    path = urlparse(request.url).path.rstrip('/')
+    m = SOLD_PATH_RE.match(path)
+    if m:
+        return 'sold', 'sold:%s' % m.group(1)
+    m = LISTING_PATH_RE.match(path)
+    if m:
+        return 'listing', 'listing:%s' % m.group(1)
+    page_type = 'results' if path == RESULTS_PATH else 'other'
+    return page_type, '%s:%s' % (page_type, request_fingerprint(request))
+
+
+class SegmentCache(object):
+    """Segment files and index of one cache directory."""
+
+    def __init__(self, path, segment_size):
+        self.path = path
+        self.segment_size = segment_size
+        self.index = {}
+        self.dead_bytes = 0
+        self.live_bytes = 0
+        self._readers = {}
+        self._writer = None
+        self._index_file = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._load_index()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, 'segment-%06d.dat' % segment)
+
+    def _index_path(self):
+        return os.path.join(self.path, 'index.jsonl')
+
+    def _load_index(self):
+        if os.path.exists(self._index_path()):
+            with open(self._index_path()) as f:
+                for line in f:
+                    try:
+                        key, page_type, segment, offset, length, ts = \
+                            json.loads(line)
+                    except ValueError:
+                        continue  # torn write at the end of the log
+                    self._account(key, length)
+                    self.index[key] = (page_type, segment, offset, length, ts)
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 0
+
+    def _account(self, key, length):
+        old = self.index.get(key)
+        if old is not None:
+            self.dead_bytes += old[3]
+            self.live_bytes -= old[3]
+        self.live_bytes += length
+
+    def segments(self):
+        names = glob.glob(os.path.join(self.path, 'segment-*.dat'))
+        return sorted(int(os.path.basename(n)[8:14]) for n in names)
+
+    def _open_segment(self):
+        f = open(self._segment_path(self.segment), 'ab')
+        f.seek(0, os.SEEK_END)
+        return f
+
+    def _open_writer(self):
+        if self._writer is None:
+            self._writer = self._open_segment()
+        if self._writer.tell() >= self.segment_size:
+            self._writer.close()
+            self.segment += 1
+            self._writer = self._open_segment()
+        if self._index_file is None:
+            self._index_file = open(self._index_path(), 'a')
+        return self._writer
+
+    def put(self, key, page_type, data, ts=None):
+        payload = zlib.compress(pickle.dumps(data, protocol=2))
+        writer = self._open_writer()
+        offset = writer.tell()
+        writer.write(RECORD_HEADER.pack(len(payload)))
+        writer.write(payload)
+        writer.flush()
+        ts = time() if ts is None else ts
+        length = RECORD_HEADER.size + len(payload)
+        entry = (page_type, self.segment, offset, length, ts)
+        self._index_file.write(json.dumps([key] + list(entry)) + '\n')
+        self._index_file.flush()
+        self._account(key, length)
+        self.index[key] = entry
+
+    def get(self, key):
+        """Return ``(data, timestamp)`` for ``key`` or ``None``."""
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        page_type, segment, offset, length, ts = entry
+        return self._read(segment, offset), ts
+
+    def _read(self, segment, offset):
+        reader = self._readers.get(segment)
+        if reader is None:
+            reader = self._readers[segment] = \
+                open(self._segment_path(segment), 'rb')
+        reader.seek(offset)
+        size, = RECORD_HEADER.unpack(reader.read(RECORD_HEADER.size))
+        return pickle.loads(zlib.decompress(reader.read(size)))
+
+    def items(self):
+        """Yield ``(key, page_type, data, timestamp)`` per live record.
+
+        Records come in segment order so the files are read sequentially.
+        """
+        entries = sorted(self.index.items(), key=lambda kv: kv[1][1:3])
+        for key, (page_type, segment, offset, length, ts) in entries:
+            yield key, page_type, self._read(segment, offset), ts
+
+    def close(self):
+        for f in list(self._readers.values()) + [self._writer,
+                                                 self._index_file]:
+            if f is not None:
+                f.close()
+        self._readers = {}
+        self._writer = self._index_file = None
+
+    def compact(self, is_live=None):
+        """Copy live records to new segments and drop the old ones.
+
+        ``is_live(page_type, ts)`` can reject records, e.g. expired ones.
+        """
+        self.close()
+        old_segments = self.segments()
+        entries = sorted(self.index.items(), key=lambda kv: kv[1][1:3])
+        reclaimed = self.dead_bytes
+
+        self.index = {}
+        self.dead_bytes = self.live_bytes = 0
+        self.segment = old_segments[-1] + 1 if old_segments else 0
+        tmp_index = self._index_path() + '.tmp'
+        self._index_file = open(tmp_index, 'w')
+        dropped = 0
+        for key, (page_type, segment, offset, length, ts) in entries:
+            if is_live is not None and not is_live(page_type, ts):
+                dropped += 1
+                reclaimed += length
+                continue
+            self.put(key, page_type, self._read(segment, offset), ts)
+        self.close()
+
+        os.rename(tmp_index, self._index_path())
+        for segment in old_segments:
+            os.remove(self._segment_path(segment))
+        logger.info('Compacted HTTP cache %s: kept %d records, dropped %d '
+                    'expired ones, reclaimed %d bytes',
+                    self.path, len(self.index), dropped, reclaimed)
+
+
+class SegmentCacheStorage(object):
+    """Scrapy ``HTTPCACHE_STORAGE`` backed by ``SegmentCache``.
+
+    ``HEMNET_HTTPCACHE_EXPIRATION`` maps page types (``sold``, ``listing``,
+    ``results``, ``other``) to an expiry in seconds, 0 meaning never; types
+    not listed use ``HTTPCACHE_EXPIRATION_SECS``.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.default_expiration = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.expiration = settings.getdict('HEMNET_HTTPCACHE_EXPIRATION')
+        self.segment_size = settings.getint('HEMNET_HTTPCACHE_SEGMENT_SIZE',
+                                            256 * 1024 * 1024)
+        self.compact_ratio = settings.getfloat(
+            'HEMNET_HTTPCACHE_COMPACT_RATIO', 0.5)
+        self.cache = None
+
+    def open_spider(self, spider):
+        self.cache = SegmentCache(os.path.join(self.cachedir, spider.name),
+                                  self.segment_size)
+
+    def close_spider(self, spider):
+        cache = self.cache
+        total = cache.dead_bytes + cache.live_bytes
+        if total and float(cache.dead_bytes) / total > self.compact_ratio:
+            cache.compact(self.is_fresh)
+        cache.close()
+
+    def is_fresh(self, page_type, ts):
+        expiration = int(self.expiration.get(page_type,
+                                             self.default_expiration))
+        return not 0 < expiration < time() - ts
+
+    def retrieve_response(self, spider, request):
+        page_type, key = page_key(request)
+        found = self.cache.get(key)
+        if found is None:
+            return  # not cached
+        data, ts = found
+        if not self.is_fresh(page_type, ts):
+            return  # expired
+        url = data['url']
+        headers = Headers(data['headers'])
+        respcls = responsetypes.from_args(headers=headers, url=url)
+        return respcls(url=url, headers=headers, status=data['status'],
+                       body=data['body'])
+
+    def store_response(self, spider, request, response):
+        page_type, key = page_key(request)
+        data = {
+            'status': response.status,
+            'url': response.url,
+            'request_url': request.url,
+            'headers': dict(response.headers),
+            'body': response.body,
+        }
+        self.cache.put(key, page_type, data)
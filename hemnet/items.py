@@ -5,77 +5,165 @@
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/items.html
 
+from pprint import pformat
+
 import scrapy
+import six
+from scrapy.item import BaseItem
+
+
+class RecordMeta(type):
+    """Collect the ``__slots__`` of a record and its bases into ``fields``."""
+
+    def __new__(mcs, name, bases, attrs):
+        cls = super(RecordMeta, mcs).__new__(mcs, name, bases, attrs)
+        names = []
+        for klass in reversed(cls.__mro__):
+            names.extend(klass.__dict__.get('__slots__', ()))
+        cls.fields = dict((field, scrapy.Field()) for field in names)
+        return cls
+
+
+class Record(six.with_metaclass(RecordMeta, BaseItem)):
+    """Item keeping its values in ``__slots__`` rather than in a dict.
+
+    Reads and writes like a ``scrapy.Item`` (``item['price'] = 1``,
+    ``'price' in item``, ``dict(item)``) and fields that were never set are
+    not in the item, but an instance is a fixed size object with no dict of
+    values behind it. Subclasses list their fields in ``__slots__``.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        if args or kwargs:
+            for key, value in six.iteritems(dict(*args, **kwargs)):
+                self[key] = value
 
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
 
-class HemnetItem(scrapy.Item):
-    url = scrapy.Field()
-
-    hemnet_id = scrapy.Field()
-
-    broker_name = scrapy.Field()
-    broker_phone = scrapy.Field()
-    broker_email = scrapy.Field()
-
-    broker_firm = scrapy.Field()
-    broker_firm_phone = scrapy.Field()
-
-    sold_date = scrapy.Field()
-
-    price_per_square_meter = scrapy.Field()
-    price = scrapy.Field()
-    asked_price = scrapy.Field()
-    price_trend_flat = scrapy.Field()
-    price_trend_percentage = scrapy.Field()
-
-    rooms = scrapy.Field()
-    monthly_fee = scrapy.Field()
-    square_meters = scrapy.Field()
-    cost_per_year = scrapy.Field()
-    year = scrapy.Field()
-    type = scrapy.Field()
-    association = scrapy.Field()
-    lot_size = scrapy.Field()
-    biarea = scrapy.Field()
-
-    address = scrapy.Field()
-    geographic_area = scrapy.Field()
-
-
-class HemnetCompItem(scrapy.Item):
-    url = scrapy.Field()
-    
-    hemnet_id = scrapy.Field()
-    salda_id = scrapy.Field()
-
-    lattitude = scrapy.Field()
-    longitude = scrapy.Field()
-
-    city = scrapy.Field()
-    postal_city = scrapy.Field()
-    district = scrapy.Field()
-    country = scrapy.Field()
-    region = scrapy.Field()
-    municipality = scrapy.Field()
-    street = scrapy.Field()
-
-    offers_selling_price = scrapy.Field()
-    living_area = scrapy.Field()
-    rooms = scrapy.Field()
-    cost_per_year = scrapy.Field()
-    new_production = scrapy.Field()
-    broker_firm = scrapy.Field()
-    upcoming_open_houses = scrapy.Field()
-    location = scrapy.Field()
-    home_swapping = scrapy.Field()
-    has_price_change = scrapy.Field()
-    status = scrapy.Field()
-    price = scrapy.Field()
-    monthly_fee = scrapy.Field()
-    main_location = scrapy.Field()
-    publication_date = scrapy.Field()
-    has_active_toplisting = scrapy.Field()
-    images_count = scrapy.Field()
-    item_type = scrapy.Field()
-    price_per_m2 = scrapy.Field()
-    street_address = scrapy.Field()
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError('%s does not support field: %s' %
+                           (self.__class__.__name__, key))
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.fields and hasattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.fields:
+            return default
+        return getattr(self, key, default)
+
+    def keys(self):
+        return [key for key in self.fields if hasattr(self, key)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def copy(self):
+        return self.__class__(self.items())
+
+    def __repr__(self):
+        return pformat(dict(self.items()))
+
+
+class HemnetItem(Record):
+    __slots__ = (
+        'url',
+
+        'hemnet_id',
+
+        'broker_name',
+        'broker_phone',
+        'broker_email',
+
+        'broker_firm',
+        'broker_firm_phone',
+
+        'sold_date',
+
+        'price_per_square_meter',
+        'price',
+        'asked_price',
+        'price_trend_flat',
+        'price_trend_percentage',
+
+        'rooms',
+        'monthly_fee',
+        'square_meters',
+        'cost_per_year',
+        'year',
+        'type',
+        'association',
+        'lot_size',
+        'biarea',
+
+        'address',
+        'geographic_area',
+
+        'lat',
+        'lon',
+        # the listing page of the property before it was sold
+        'listing_url',
+    )
+
+
+class HemnetCompItem(Record):
+    __slots__ = (
+        'url',
+
+        'hemnet_id',
+        'salda_id',
+
+        'lattitude',
+        'longitude',
+
+        'city',
+        'postal_city',
+        'district',
+        'country',
+        'region',
+        'municipality',
+        'street',
+
+        'offers_selling_price',
+        'living_area',
+        'rooms',
+        'cost_per_year',
+        'new_production',
+        'broker_firm',
+        'upcoming_open_houses',
+        'location',
+        'home_swapping',
+        'has_price_change',
+        'status',
+        'price',
+        'monthly_fee',
+        'main_location',
+        'publication_date',
+        'has_active_toplisting',
+        'images_count',
+        'item_type',
+        'price_per_m2',
+        'street_address',
+    )
@@ -0,0 +1,256 @@
+"""Timing histograms and counters for the hot paths of a crawl.
+
+The spider middleware ``hemnet.middlewares.CallbackTimingMiddleware`` times
+every spider callback, ``HemnetPipeline`` times its database writes and
+``MetricsExtension`` counts scraped items per class and samples the
+scheduler queue depth. Everything lands in the module level ``registry``.
+
+Every ``HEMNET_METRICS_INTERVAL`` seconds and when the spider closes the
+extension copies a summary into the crawl stats (``metrics/...``) and, when
+``HEMNET_METRICS_TEXTFILE`` is set, writes the registry in the Prometheus
+text format, e.g. for the node_exporter textfile collector.
+"""
+
+import logging
+import os
+from bisect import bisect_left
+from timeit import default_timer as clock
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from parsing a small page to a slow batch INSERT.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """Cumulative histogram with fixed bucket bounds, as Prometheus has it."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket holding it."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Registry(object):
+    """Histograms, counters and gauges keyed by name and labels."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name, count=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + count
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def clear(self):
+        self.histograms.clear()
+        self.counters.clear()
+        self.gauges.clear()
+
+    def time(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def prometheus_text(self):
+        """Return the registry in the Prometheus text exposition format."""
+        lines = []
+        for kind, metrics in (('counter', self.counters),
+                              ('gauge', self.gauges),
+                              ('histogram', self.histograms)):
+            for name in sorted(set(name for name, _ in metrics)):
+                if name in self.help:
+                    lines.append('# HELP %s %s' % (name, self.help[name]))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for (n, labels), value in sorted(metrics.items()):
+                    if n != name:
+                        continue
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (name, _labels(labels),
+                                                  _number(value)))
+                        continue
+                    cumulative = 0
+                    bounds = [_number(b) for b in value.buckets] + ['+Inf']
+                    for bound, count in zip(bounds, value.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (
+                            name, _labels(labels + (('le', bound),)),
+                            cumulative))
+                    lines.append('%s_sum%s %s' % (name, _labels(labels),
+                                                  _number(value.sum)))
+                    lines.append('%s_count%s %d' % (name, _labels(labels),
+                                                    value.count))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer(object):
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, clock() - self.start, **self.labels)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+registry.describe('hemnet_callback_seconds',
+                  'Time spent inside spider callbacks.')
+registry.describe('hemnet_db_write_seconds',
+                  'Time spent writing items to the database.')
+registry.describe('hemnet_items_total', 'Items scraped per item class.')
+registry.describe('hemnet_items_per_second',
+                  'Items scraped per second over the last interval.')
+registry.describe('hemnet_scheduler_queue_depth',
+                  'Requests waiting in the scheduler.')
+
+
+def write_textfile(path, text):
+    """Replace ``path`` atomically so a collector never reads half a file."""
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.rename(tmp, path)
+
+
+class MetricsExtension(object):
+    """Sample crawl metrics and export them periodically."""
+
+    def __init__(self, crawler, interval, textfile=None):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = interval
+        self.textfile = textfile
+        self.registry = registry
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('HEMNET_METRICS_ENABLED'):
+            raise NotConfigured
+        o = cls(crawler, settings.getfloat('HEMNET_METRICS_INTERVAL', 30),
+                settings.get('HEMNET_METRICS_TEXTFILE'))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.item_scraped, signal=signals.item_scraped)
+        return o
+
+    def spider_opened(self, spider):
+        self.registry.clear()
+        self.started = self.last_sample = clock()
+        self.items_prev = {}
+        if self.textfile:
+            self.textfile = self.textfile % {'name': spider.name}
+        if self.interval > 0:
+            self.task = task.LoopingCall(self.export)
+            self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task and self.task.running:
+            self.task.stop()
+        self.export()
+        elapsed = clock() - self.started
+        for (name, labels), count in self.registry.counters.items():
+            if name == 'hemnet_items_total' and elapsed > 0:
+                self.stats.set_value(
+                    'metrics/items_per_sec/%s' % dict(labels)['item_class'],
+                    round(count / elapsed, 2))
+
+    def item_scraped(self, item, spider):
+        self.registry.inc('hemnet_items_total',
+                          item_class=type(item).__name__)
+
+    def sample(self):
+        now = clock()
+        elapsed = now - self.last_sample
+        self.last_sample = now
+        for (name, labels), count in list(self.registry.counters.items()):
+            if name != 'hemnet_items_total':
+                continue
+            prev = self.items_prev.get(labels, 0)
+            self.items_prev[labels] = count
+            if elapsed > 0:
+                self.registry.set('hemnet_items_per_second',
+                                  (count - prev) / elapsed, **dict(labels))
+
+        slot = getattr(self.crawler.engine, 'slot', None)
+        if slot is not None:
+            depth = len(slot.scheduler)
+            self.registry.set('hemnet_scheduler_queue_depth', depth)
+            self.stats.max_value('metrics/scheduler_queue_depth/max', depth)
+
+    def export(self):
+        self.sample()
+        for (name, labels), histogram in self.registry.histograms.items():
+            prefix = 'metrics/%s/%s' % (
+                name[len('hemnet_'):], '/'.join(str(v) for _, v in labels))
+            self.stats.set_value(prefix + '/count', histogram.count)
+            self.stats.set_value(prefix + '/p50_ms',
+                                 round(histogram.quantile(0.5) * 1000, 3))
+            self.stats.set_value(prefix + '/p99_ms',
+                                 round(histogram.quantile(0.99) * 1000, 3))
+            self.stats.set_value(prefix + '/max_ms',
+                                 round(histogram.max * 1000, 3))
+            self.stats.set_value(prefix + '/total_s', round(histogram.sum, 3))
+        if self.textfile:
+            try:
+                write_textfile(self.textfile, self.registry.prometheus_text())
+            except (IOError, OSError):
+                logger.exception('Could not write metrics to %s',
+                                 self.textfile)
@@ -1,6 +1,13 @@
+from collections import deque
+from itertools import count
 from random import choice
+from timeit import default_timer as clock
+
 from scrapy import signals
-from scrapy.exceptions import NotConfigured
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+from scrapy.http import Request
+
+from hemnet import errors, frontier, metrics
 
 
 class RotateUserAgentMiddleware(object):
@@ -28,4 +35,383 @@ class RotateUserAgentMiddleware(object):
         if not self.enabled or not self.user_agents:
             return
 
-        request.headers['user-agent'] = choice(self.user_agents)
\ No newline at end of file
+        request.headers['user-agent'] = choice(self.user_agents)
+
+
+class _SlotState(object):
+    def __init__(self, concurrency, delay, window):
+        self.concurrency = float(concurrency)
+        self.delay = delay
+        self.outcomes = deque(maxlen=window)
+
+    @property
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return sum(self.outcomes) / float(len(self.outcomes))
+
+
+class AdaptiveThrottleMiddleware(object):
+    """Adjust concurrency and delay of each download slot with AIMD.
+
+    Every response or download error updates the slot it came from:
+
+    * a 429/503 or a Cloudflare challenge page halves the concurrency and
+      doubles the delay (at least to the server's Retry-After);
+    * any other 4xx/5xx response or download error counts as a failure
+      and never grows the concurrency; when more than
+      ``HEMNET_THROTTLE_ERROR_RATE`` of the recent requests failed, the
+      same multiplicative decrease applies;
+    * a healthy response with latency under ``HEMNET_THROTTLE_TARGET_LATENCY``
+      adds ``1 / concurrency`` to the concurrency (one request per round
+      trip) and takes ``HEMNET_THROTTLE_DELAY_STEP`` off the delay; slower
+      responses add that step to the delay instead.
+
+    The current values are kept in the crawl stats under
+    ``adaptive_throttle/<slot>/``. Replaces AutoThrottle, which only looks
+    at latency.
+    """
+
+    THROTTLED_CODES = (429, 503)
+    CHALLENGE_MARKERS = (b'cf-browser-verification', b'cf-challenge',
+                         b'cf_chl_', b'Attention Required! | Cloudflare')
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('HEMNET_THROTTLE_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.min_delay = settings.getfloat('HEMNET_THROTTLE_MIN_DELAY', 0.5)
+        self.max_delay = settings.getfloat('HEMNET_THROTTLE_MAX_DELAY', 60)
+        self.start_delay = settings.getfloat('DOWNLOAD_DELAY', 2)
+        self.delay_step = settings.getfloat('HEMNET_THROTTLE_DELAY_STEP',
+                                            0.1)
+        self.max_concurrency = settings.getint(
+            'HEMNET_THROTTLE_MAX_CONCURRENCY',
+            settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN', 8))
+        self.target_latency = settings.getfloat(
+            'HEMNET_THROTTLE_TARGET_LATENCY', 2.0)
+        self.max_error_rate = settings.getfloat('HEMNET_THROTTLE_ERROR_RATE',
+                                                0.2)
+        self.window = settings.getint('HEMNET_THROTTLE_WINDOW', 50)
+        self.states = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def _slot(self, request):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return key, None, None
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = _SlotState(1, self.start_delay,
+                                                  self.window)
+        return key, slot, state
+
+    def is_challenge(self, response):
+        if response.status not in (403, 429, 503):
+            return False
+        if response.headers.get('cf-mitigated'):
+            return True
+        head = response.body[:4096]
+        return any(marker in head for marker in self.CHALLENGE_MARKERS)
+
+    def process_response(self, request, response, spider):
+        if 'cached' in response.flags:
+            return response
+        key, slot, state = self._slot(request)
+        if slot is None:
+            return response
+
+        if response.status in self.THROTTLED_CODES or \
+                self.is_challenge(response):
+            state.outcomes.append(1)
+            self.stats.inc_value('adaptive_throttle/%s/blocked' % key)
+            retry_after = response.headers.get('Retry-After')
+            try:
+                retry_after = float(retry_after)
+            except (TypeError, ValueError):
+                retry_after = 0
+            self._decrease(state, retry_after)
+        elif response.status >= 400:
+            state.outcomes.append(1)
+            self.stats.inc_value('adaptive_throttle/%s/errors' % key)
+            if state.error_rate > self.max_error_rate:
+                self._decrease(state)
+        else:
+            state.outcomes.append(0)
+            latency = request.meta.get('download_latency')
+            if state.error_rate > self.max_error_rate:
+                self._decrease(state)
+            elif latency is not None and latency > self.target_latency:
+                state.delay = min(self.max_delay,
+                                  state.delay + self.delay_step)
+            else:
+                state.concurrency = min(self.max_concurrency,
+                                        state.concurrency +
+                                        1.0 / state.concurrency)
+                state.delay = max(self.min_delay,
+                                  state.delay - self.delay_step)
+
+        self._apply(key, slot, state)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        key, slot, state = self._slot(request)
+        if slot is None:
+            return
+        state.outcomes.append(1)
+        if state.error_rate > self.max_error_rate:
+            self._decrease(state)
+        self._apply(key, slot, state)
+
+    def _decrease(self, state, min_delay=0):
+        state.concurrency = max(1.0, state.concurrency / 2)
+        state.delay = min(self.max_delay,
+                          max(state.delay * 2, self.min_delay, min_delay))
+
+    def _apply(self, key, slot, state):
+        slot.concurrency = int(state.concurrency)
+        slot.delay = state.delay
+        prefix = 'adaptive_throttle/%s/' % key
+        self.stats.set_value(prefix + 'concurrency', slot.concurrency)
+        self.stats.set_value(prefix + 'delay', round(state.delay, 3))
+        self.stats.set_value(prefix + 'error_rate',
+                             round(state.error_rate, 3))
+
+
+class CallbackTimingMiddleware(object):
+    """Record the time spent in each spider callback.
+
+    Callbacks are generators, so the time is the sum of the calls that
+    produced their output, leaving out the work of the middlewares and the
+    engine consuming it. Observations go to ``hemnet_callback_seconds`` in
+    ``hemnet.metrics.registry``.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('HEMNET_METRICS_ENABLED'):
+            raise NotConfigured
+        return cls(metrics.registry)
+
+    def process_spider_output(self, response, result, spider):
+        callback = response.request.callback if response.request else None
+        name = getattr(callback, '__name__', None) or 'parse'
+        return self._timed(result, name)
+
+    def _timed(self, result, name):
+        elapsed = 0.0
+        iterator = iter(result)
+        try:
+            while True:
+                start = clock()
+                try:
+                    value = next(iterator)
+                finally:
+                    elapsed += clock() - start
+                yield value
+        except StopIteration:
+            pass
+        finally:
+            self.registry.observe('hemnet_callback_seconds', elapsed,
+                                  callback=name)
+
+
+class _RoundRobin(object):
+    """Queue of requests taking turns between the regions in their meta.
+
+    Each ``meta['region']`` has its own FIFO; ``popleft`` serves the
+    regions one request at a time in the order they first had one waiting.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.turns = deque()
+        self.size = 0
+
+    def append(self, request):
+        region = request.meta.get('region')
+        queue = self.queues.get(region)
+        if queue is None:
+            queue = self.queues[region] = deque()
+            self.turns.append(region)
+        queue.append(request)
+        self.size += 1
+
+    def popleft(self):
+        region = self.turns.popleft()
+        queue = self.queues[region]
+        request = queue.popleft()
+        if queue:
+            self.turns.append(region)
+        else:
+            del self.queues[region]
+        self.size -= 1
+        return request
+
+    def __len__(self):
+        return self.size
+
+
+class TierMiddleware(object):
+    """Prioritise requests by tier and cap the outstanding ones per tier.
+
+    Requests carry their tier in ``meta['tier']``; ``HEMNET_TIER_PRIORITIES``
+    maps tiers to request priorities, so detail pages are downloaded before
+    the result pages that produce more of them. A tier with a cap in
+    ``HEMNET_TIER_CAPS`` has at most that many requests scheduled or
+    downloading at a time: further requests of the tier are parked here,
+    and start requests are only pulled from the spider, until one of them
+    finishes. Capping new partitions and next result pages bounds the
+    backlog of detail pages they fan out to.
+
+    Parked requests are released taking turns between the regions in
+    their ``meta['region']``, so a region with many partitions and result
+    pages cannot hold every slot of a capped tier.
+
+    The caps are per process: a request handed to the shared frontier (see
+    ``hemnet.frontier``) stops counting when it is queued there, since any
+    worker may download it.
+    """
+
+    def __init__(self, crawler, priorities, caps):
+        self.crawler = crawler
+        self.priorities = priorities
+        self.caps = caps
+        self.tiers = sorted(priorities, key=priorities.get, reverse=True)
+        self.outstanding = dict((tier, set()) for tier in self.tiers)
+        self.parked = dict((tier, _RoundRobin()) for tier in self.tiers)
+        self.tickets = count()
+        self.spider = None
+        self.start_requests = None
+        self.next_start = None
+        self.pulling = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        priorities = settings.getdict('HEMNET_TIER_PRIORITIES')
+        if not settings.getbool('HEMNET_TIERS_ENABLED') or not priorities:
+            raise NotConfigured
+        caps = dict((tier, int(cap)) for tier, cap in
+                    settings.getdict('HEMNET_TIER_CAPS').items())
+        o = cls(crawler, dict((tier, int(priority)) for tier, priority
+                              in priorities.items()), caps)
+        crawler.signals.connect(o.response_received,
+                                signal=signals.response_received)
+        crawler.signals.connect(o.request_finished,
+                                signal=signals.request_dropped)
+        crawler.signals.connect(o.request_finished,
+                                signal=errors.request_failed)
+        crawler.signals.connect(o.request_finished,
+                                signal=frontier.request_shared)
+        crawler.signals.connect(o.spider_idle, signal=signals.spider_idle)
+        return o
+
+    def process_start_requests(self, start_requests, spider):
+        self.spider = spider
+        self.start_requests = iter(start_requests)
+        return self._pull_start_requests()
+
+    def process_spider_output(self, response, result, spider):
+        for x in result:
+            if isinstance(x, Request):
+                x = self._admit(x)
+                if x is None:
+                    continue
+            yield x
+
+    def response_received(self, response, request, spider):
+        self.request_finished(request)
+
+    def request_finished(self, request, **kwargs):
+        tier = request.meta.get('tier')
+        ticket = request.meta.get('tier_ticket')
+        if tier in self.outstanding and ticket is not None:
+            self.outstanding[tier].discard(ticket)
+            self._release()
+
+    def spider_idle(self, spider):
+        # Nothing is scheduled or downloading; whatever is still counted
+        # finished without a signal (e.g. a failure without errback).
+        for tickets in self.outstanding.values():
+            tickets.clear()
+        if self._release():
+            raise DontCloseSpider
+
+    def _full(self, tier):
+        cap = self.caps.get(tier)
+        return cap is not None and len(self.outstanding[tier]) >= cap
+
+    def _admit(self, request):
+        """Return ``request`` if its tier has room, else park it."""
+        tier = request.meta.get('tier')
+        if tier not in self.priorities:
+            return request
+        if not request.priority:
+            request.priority = self.priorities[tier]
+        if self._full(tier):
+            self.parked[tier].append(request)
+            return None
+        ticket = request.meta.get('tier_ticket')
+        if ticket is None:
+            ticket = request.meta['tier_ticket'] = next(self.tickets)
+        self.outstanding[tier].add(ticket)
+        return request
+
+    def _next_start_request(self):
+        """Pull the next start request, or ``None`` while its tier is full."""
+        if self.pulling or self.start_requests is None:
+            return None
+        request = self.next_start
+        self.next_start = None
+        if request is None:
+            self.pulling = True
+            try:
+                request = next(self.start_requests)
+            except StopIteration:
+                self.start_requests = None
+                return None
+            finally:
+                self.pulling = False
+        tier = request.meta.get('tier')
+        if tier in self.priorities and self._full(tier):
+            self.next_start = request
+            return None
+        return self._admit(request)
+
+    def _pull_start_requests(self):
+        # The engine pulls from here until the first full tier; after that
+        # _release feeds the rest as requests finish.
+        while True:
+            request = self._next_start_request()
+            if request is None:
+                return
+            yield request
+
+    def _release(self):
+        """Schedule parked and start requests that fit; return how many."""
+        if self.spider is None:
+            return 0
+        released = 0
+        for tier in self.tiers:
+            parked = self.parked[tier]
+            while parked and not self._full(tier):
+                self.crawler.engine.crawl(self._admit(parked.popleft()),
+                                          self.spider)
+                released += 1
+        while True:
+            request = self._next_start_request()
+            if request is None:
+                break
+            self.crawler.engine.crawl(request, self.spider)
+            released += 1
+        return released
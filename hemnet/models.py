@@ -1,7 +1,11 @@
+import os
 from datetime import datetime
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, Boolean
-from sqlalchemy.engine.url import URL
+from sqlalchemy import (
+    create_engine, event, Column, Integer, BigInteger, String, Float, Date,
+    DateTime, Boolean, LargeBinary, Index, UniqueConstraint
+)
+from sqlalchemy.engine.url import URL, make_url
 from sqlalchemy.ext.declarative import declarative_base
 
 from . import settings
@@ -9,8 +13,52 @@ from . import settings
 DeclarativeBase = declarative_base()
 
 
-def db_connect():
-    return create_engine(URL(**settings.DATABASE))
+# Applied to every SQLite connection: WAL lets the spiders read while the
+# pipeline writes, and with WAL synchronous=NORMAL only syncs on checkpoints.
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA busy_timeout=5000',
+]
+
+
+def database_url():
+    """URL of ``settings.DATABASE``.
+
+    The ``HEMNET_DATABASE_URL`` environment variable overrides it, e.g.
+    ``sqlite:///hemnet.db`` for a crawl without a database server.
+    """
+    url = os.environ.get('HEMNET_DATABASE_URL')
+    return make_url(url) if url else URL(**settings.DATABASE)
+
+
+def db_connect(**kwargs):
+    """Create an engine for ``database_url()``.
+
+    Keyword arguments go to ``create_engine``; the connection pool sizes
+    are left out for SQLite, which does not pool file connections.
+    """
+    url = database_url()
+    if url.drivername.split('+')[0] == 'sqlite':
+        kwargs.pop('pool_size', None)
+        kwargs.pop('max_overflow', None)
+    engine = create_engine(url, **kwargs)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _set_sqlite_pragmas)
+    return engine
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def is_postgres(engine):
+    return engine.dialect.name == 'postgresql'
 
 
 def create_hemnet_table(engine):
@@ -22,7 +70,7 @@ class HemnetItem(DeclarativeBase):
 
     id = Column(Integer, primary_key=True)
 
-    hemnet_id = Column(Integer, index=True)
+    hemnet_id = Column(Integer, index=True, unique=True)
 
     url = Column(String)
 
@@ -33,7 +81,7 @@ class HemnetItem(DeclarativeBase):
     broker_firm = Column(String, nullable=True)
     broker_firm_phone = Column(String, nullable=True)
 
-    sold_date = Column(Date, nullable=True)
+    sold_date = Column(Date, nullable=True, index=True)
 
     price_per_square_meter = Column(Float, nullable=True)
     price = Column(Integer, nullable=True)
@@ -53,7 +101,17 @@ class HemnetItem(DeclarativeBase):
 
     address = Column(String, default='')
     geographic_area = Column(String, default='')
-    collected_at = Column(Date, default=datetime.now())
+
+    lat = Column(Float, nullable=True)
+    lon = Column(Float, nullable=True)
+    listing_url = Column(String, nullable=True)
+
+    collected_at = Column(Date, default=datetime.now(), index=True)
+
+    # sha1 of the scraped values, see hemnet.pipelines.content_hash
+    content_hash = Column(String, nullable=True)
+    # set by hemnet.pipelines when the row is inserted or its content changes
+    updated_at = Column(DateTime, nullable=True, index=True)
 
 
 class HemnetCompItem(DeclarativeBase):
@@ -61,7 +119,7 @@ class HemnetCompItem(DeclarativeBase):
 
     id = Column(Integer, primary_key=True)
 
-    salda_id = Column(Integer, index=True)
+    salda_id = Column(Integer, index=True, unique=True)
     hemnet_id = Column(Integer, index=True)
 
     url = Column(String)
@@ -103,3 +161,106 @@ class HemnetCompItem(DeclarativeBase):
     price_per_m2 = Column(Integer, nullable=True)
 
     collected_at = Column(Date, default=datetime.now())
+
+    content_hash = Column(String, nullable=True)
+    updated_at = Column(DateTime, nullable=True, index=True)
+
+
+class HemnetCrawlState(DeclarativeBase):
+    """High-water mark of the sold listings seen per search scope."""
+    __tablename__ = "hemnet_crawl_state"
+
+    id = Column(Integer, primary_key=True)
+
+    scope = Column(String, unique=True)
+
+    newest_hemnet_id = Column(Integer, nullable=True)
+    newest_sold_date = Column(Date, nullable=True)
+
+    updated_at = Column(DateTime, default=datetime.now)
+
+
+class HemnetPageFingerprint(DeclarativeBase):
+    """What a results page listed when last parsed, to skip it unchanged."""
+    __tablename__ = "hemnet_page_fingerprints"
+
+    id = Column(Integer, primary_key=True)
+
+    url = Column(String, unique=True)
+
+    # sha1 of the ordered hemnet ids on the page
+    listings_hash = Column(String(40))
+    # validators of the response, sent back in a conditional request
+    etag = Column(String, nullable=True)
+    last_modified = Column(String, nullable=True)
+
+    updated_at = Column(DateTime, default=datetime.now)
+
+
+class HemnetBrokerAreaMonth(DeclarativeBase):
+    """Sales per broker, area and month, see hemnet.analytics."""
+    __tablename__ = "hemnet_broker_area_month"
+
+    broker_email = Column(String, primary_key=True)
+    geographic_area = Column(String, primary_key=True)
+    month = Column(Date, primary_key=True, index=True)
+
+    broker_name = Column(String, nullable=True)
+    broker_firm = Column(String, nullable=True)
+
+    sales = Column(Integer, nullable=False)
+    total_price = Column(BigInteger, nullable=True)
+    total_asked_price = Column(BigInteger, nullable=True)
+    # sales with both a price and a living area; price per m2 is
+    # priced_total_price / priced_square_meters
+    priced_sales = Column(Integer, nullable=False)
+    priced_total_price = Column(BigInteger, nullable=True)
+    priced_square_meters = Column(Float, nullable=True)
+
+
+class HemnetFrontier(DeclarativeBase):
+    """Requests of a crawl shared by several workers, see hemnet.frontier."""
+    __tablename__ = "hemnet_frontier"
+    __table_args__ = (
+        UniqueConstraint('crawl', 'fingerprint'),
+        Index('ix_hemnet_frontier_next', 'crawl', 'state', 'priority'),
+    )
+
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'),
+                primary_key=True)
+
+    crawl = Column(String, nullable=False)
+    fingerprint = Column(String, nullable=False)
+    priority = Column(Integer, nullable=False, default=0)
+    request = Column(LargeBinary, nullable=False)
+
+    # queued -> leased -> done, or failed after too many expired leases
+    state = Column(String, nullable=False, default='queued')
+    leased_by = Column(String, nullable=True)
+    lease_expires = Column(DateTime, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class HemnetLocation(DeclarativeBase):
+    """Locations crawled together, see ``-a location_set`` of hemnetspider."""
+    __tablename__ = "hemnet_locations"
+    __table_args__ = (
+        UniqueConstraint('location_set', 'location_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+
+    location_set = Column(String, nullable=False, default='default')
+    # the location_ids[] of a Hemnet search
+    location_id = Column(Integer, nullable=False)
+    name = Column(String, nullable=True)
+
+    # requests per crawl, 0 for no limit; when NULL -a budget or
+    # HEMNET_REGION_BUDGET applies
+    budget = Column(Integer, nullable=True)
+    enabled = Column(Boolean, nullable=False, default=True)
+
+    # end of the last crawl that covered the location within its budget
+    last_crawled_at = Column(DateTime, nullable=True)
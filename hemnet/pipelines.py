@@ -5,33 +5,376 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
-from sqlalchemy.orm import sessionmaker
-from .models import db_connect, create_hemnet_table
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime
+
+from scrapy.utils.log import failure_to_exc_info
+from sqlalchemy import Date, text
+from twisted.internet import defer, task
+
+from . import queues
+from .db import DatabasePool, get_engine, shared_pool
 from .models import HemnetItem as HemnetDBItem
 from .models import HemnetCompItem as HemnetCompDBItem
 from .items import HemnetItem
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Unique key of each table. A row whose key is stored already is skipped in
+# insert mode and updated in upsert mode.
+UPSERT_KEYS = {
+    HemnetDBItem: 'hemnet_id',
+    HemnetCompDBItem: 'salda_id',
+}
+
+# Columns left out of the content hash; they change on every scrape.
+VOLATILE_COLUMNS = ('collected_at', 'content_hash', 'updated_at')
+
+# Bound parameters SQLite allows in one statement (SQLITE_MAX_VARIABLE_NUMBER
+# of the builds before 3.32); larger batches are split.
+SQLITE_MAX_PARAMS = 999
 
 
 class HemnetPipeline(object):
-    def __init__(self):
-        engine = db_connect()
-        create_hemnet_table(engine)
-        self.Session = sessionmaker(bind=engine)
+    """Write scraped items to the database.
+
+    With ``HEMNET_PIPELINE_BATCH_SIZE`` greater than 1 items are buffered per
+    model and written with a single INSERT when the batch is full,
+    when ``HEMNET_PIPELINE_FLUSH_INTERVAL`` seconds have passed, or when the
+    spider closes. A failing batch is rolled back and logged on its own; the
+    other batches are not affected.
+
+    With ``HEMNET_PIPELINE_WRITE_MODE = 'upsert'`` rows are written with
+    ``INSERT ... ON CONFLICT`` on the table's unique key (``UPSERT_KEYS``).
+    Each row carries a hash of its content, and a stored row is only
+    rewritten when the hash differs, so re-scraping an unchanged page costs
+    no write. ``'insert'`` writes rows as they come with ``INSERT ... ON
+    CONFLICT DO NOTHING``: a row whose key is stored already is skipped
+    (and counted in the ``duplicates`` stat) rather than failing its batch.
+
+    On SQLite (see ``models.db_connect``) an upsert batch is split into
+    statements under SQLite's parameter limit, still written in one
+    transaction.
+
+    Writes run in the threads of ``db`` (see ``hemnet.db``); an item that
+    is written, or fills a batch, is done when its write is. Without a
+    ``db`` writes run in the calling thread. On the ``queues.checkpoint``
+    signal the buffered items are written and the signal waits for every
+    write under way.
+    """
+
+    def __init__(self, batch_size=1, flush_interval=0, stats=None,
+                 write_mode='insert', db=None):
+        self.db = db or DatabasePool(get_engine(), threads=0)
+        engine = self.engine = self.db.engine
+        self.dialect = engine.dialect.name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = stats
+        if write_mode not in ('insert', 'upsert'):
+            raise ValueError('Unknown write mode: %r' % write_mode)
+        self.write_mode = write_mode
+        self.buffers = {HemnetDBItem: [], HemnetCompDBItem: []}
+        self.writing = set()
+        self._flush_task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        o = cls(
+            batch_size=settings.getint('HEMNET_PIPELINE_BATCH_SIZE', 1),
+            flush_interval=settings.getfloat('HEMNET_PIPELINE_FLUSH_INTERVAL',
+                                             0),
+            stats=crawler.stats,
+            write_mode=settings.get('HEMNET_PIPELINE_WRITE_MODE', 'insert'),
+            db=shared_pool(settings),
+        )
+        crawler.signals.connect(o.checkpoint, signal=queues.checkpoint)
+        return o
+
+    def open_spider(self, spider):
+        if self.batch_size > 1 and self.flush_interval > 0:
+            self._flush_task = task.LoopingCall(self.flush)
+            self._flush_task.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider):
+        if self._flush_task and self._flush_task.running:
+            self._flush_task.stop()
+        return self.flush()
 
     def process_item(self, item, spider):
-        session = self.Session()
         if isinstance(item, HemnetItem):
-            deal = HemnetDBItem(**item)
+            model = HemnetDBItem
         else:
-            deal = HemnetCompDBItem(**item)
+            model = HemnetCompDBItem
 
-        try:
-            session.add(deal)
-            session.commit()
-        except:
-            session.rollback()
-            raise
-        finally:
-            session.close()
+        if self.batch_size <= 1 and self.write_mode == 'insert':
+            d = self._track(self.db.run(self._write_one, model,
+                                        _row(model, item)))
+            d.addCallback(self._row_written, model.__tablename__)
+            d.addCallback(lambda _: item)
+            return d
+
+        buf = self.buffers[model]
+        buf.append(_row(model, item))
+        if len(buf) >= self.batch_size:
+            return self._flush_model(model).addCallback(lambda _: item)
 
         return item
+
+    def flush(self):
+        return defer.DeferredList([self._flush_model(model)
+                                   for model in self.buffers])
+
+    def checkpoint(self):
+        """Write the buffered items; fires once every item handed to the
+        pipeline so far is written."""
+        writing = list(self.writing)
+        return defer.DeferredList(writing + [self.flush()],
+                                  consumeErrors=True)
+
+    def _track(self, d):
+        self.writing.add(d)
+
+        def written(result):
+            self.writing.discard(d)
+            return result
+        return d.addBoth(written)
+
+    def _write_one(self, model, row):
+        """Insert one row unless its key is stored; runs in a database
+        thread."""
+        start = time.time()
+        with self.engine.begin() as conn:
+            inserted = conn.execute(
+                insert_statement(model.__table__, UPSERT_KEYS[model], [row]),
+                row).rowcount
+        return time.time() - start, inserted
+
+    def _row_written(self, result, table_name):
+        elapsed, inserted = result
+        registry.observe('hemnet_db_write_seconds', elapsed,
+                         table=table_name, mode='row')
+        if not inserted:
+            self._inc_stat('hemnet/pipeline/%s/duplicates' % table_name)
+
+    def _flush_model(self, model):
+        rows = self.buffers[model]
+        if not rows:
+            return defer.succeed(None)
+        self.buffers[model] = []
+
+        table = model.__table__
+        d = self._track(self.db.run(self._write_batch, model, rows))
+        d.addCallbacks(self._batch_written, self._batch_failed,
+                       callbackArgs=(table, rows), errbackArgs=(table, rows))
+        return d
+
+    def _write_batch(self, model, rows):
+        """Write a batch in one transaction; runs in a database thread.
+
+        Returns the time it took, the number of changed rows in upsert
+        mode and the number of inserted rows.
+        """
+        table = model.__table__
+        key = UPSERT_KEYS[model]
+        start = time.time()
+        changed = inserted = None
+        with self.engine.begin() as conn:
+            if self.write_mode == 'upsert':
+                changed, inserted = self._upsert(conn, model, rows)
+            elif self.dialect == 'sqlite':
+                # executemany runs in C in sqlite3, with no statement to
+                # compile per batch and no parameter limit
+                inserted = conn.execute(
+                    insert_statement(table, key, rows[:1]), rows).rowcount
+            else:
+                statement, params = values_statement(
+                    'INSERT INTO {table} ({columns}) VALUES {values} '
+                    'ON CONFLICT ({key}) DO NOTHING', table, key, rows)
+                inserted = conn.execute(statement, params).rowcount
+        return time.time() - start, changed, inserted
+
+    def _batch_failed(self, failure, table, rows):
+        logger.error('Failed to write batch of %d rows to %s',
+                     len(rows), table.name,
+                     exc_info=failure_to_exc_info(failure))
+        self._inc_stat('hemnet/pipeline/%s/failed_batches' % table.name)
+        self._inc_stat('hemnet/pipeline/%s/failed_rows' % table.name,
+                       len(rows))
+
+    def _batch_written(self, result, table, rows):
+        elapsed, changed, inserted = result
+        registry.observe('hemnet_db_write_seconds', elapsed,
+                         table=table.name, mode='batch')
+        logger.debug('Wrote %d rows to %s in %.3fs',
+                     len(rows), table.name, elapsed)
+        self._inc_stat('hemnet/pipeline/%s/batches' % table.name)
+        self._inc_stat('hemnet/pipeline/%s/rows' % table.name, len(rows))
+        if self.write_mode == 'upsert':
+            self._inc_stat('hemnet/pipeline/%s/changed' % table.name, changed)
+            self._inc_stat('hemnet/pipeline/%s/unchanged' % table.name,
+                           len(rows) - changed)
+            if inserted is not None:
+                self._inc_stat('hemnet/pipeline/%s/inserted' % table.name,
+                               inserted)
+                self._inc_stat('hemnet/pipeline/%s/updated' % table.name,
+                               changed - inserted)
+        elif inserted is not None and inserted >= 0:
+            self._inc_stat('hemnet/pipeline/%s/duplicates' % table.name,
+                           len(rows) - inserted)
+        if self.stats:
+            self.stats.max_value(
+                'hemnet/pipeline/%s/max_batch_seconds' % table.name, elapsed)
+
+    def _chunks(self, table, rows):
+        if self.dialect != 'sqlite':
+            return [rows]
+        size = max(1, SQLITE_MAX_PARAMS // len(table.columns))
+        return [rows[i:i + size] for i in range(0, len(rows), size)]
+
+    def _upsert(self, conn, model, rows):
+        """Upsert ``rows``; return the number of changed and inserted rows.
+
+        Only the last row per key is kept, a statement may not touch a row
+        twice. SQLite cannot tell inserts from updates, the number of
+        inserted rows is ``None`` there.
+        """
+        key = UPSERT_KEYS[model]
+        latest = {}
+        for i, row in enumerate(rows):
+            latest[row[key] if row[key] is not None else ('row', i)] = row
+        rows = list(latest.values())
+
+        if self.dialect == 'sqlite':
+            changed = 0
+            for chunk in self._chunks(model.__table__, rows):
+                statement, params = upsert_statement(
+                    model.__table__, key, chunk, dialect='sqlite')
+                changed += conn.execute(statement, params).rowcount
+            return changed, None
+
+        statement, params = upsert_statement(model.__table__, key, rows)
+        changed = inserted = 0
+        for was_inserted, in conn.execute(statement, params):
+            changed += 1
+            if was_inserted:
+                inserted += 1
+        return changed, inserted
+
+    def _inc_stat(self, key, count=1):
+        if self.stats:
+            self.stats.inc_value(key, count)
+
+
+# (name, default, is a date) of the columns of each model, see _row.
+_row_columns = {}
+
+
+def _columns(model):
+    columns = _row_columns.get(model)
+    if columns is None:
+        columns = _row_columns[model] = [
+            (column.name,
+             column.default.arg if column.default is not None and
+             column.default.is_scalar else None,
+             isinstance(column.type, Date))
+            for column in model.__table__.columns if not column.primary_key]
+    return columns
+
+
+_missing = object()
+
+
+def _row(model, item):
+    """Build an INSERT row holding every column of ``model``.
+
+    Multi-row inserts need the same keys in every row, so columns the item
+    did not set get the column's scalar default just like the ORM would.
+    ``item`` is a record from ``hemnet.items`` or a dict.
+    """
+    get = item.get
+    row = {}
+    for name, default, is_date in _columns(model):
+        value = get(name, _missing)
+        if value is _missing:
+            value = default
+        elif is_date and isinstance(value, basestring):
+            # the dataLayer has 'YYYY-MM-DD'; SQLite wants date objects
+            value = datetime.strptime(value, '%Y-%m-%d').date()
+        row[name] = value
+    if 'content_hash' in row:
+        row['content_hash'] = content_hash(row)
+    if 'updated_at' in row:
+        # the upsert only overwrites it when the content hash changed
+        row['updated_at'] = datetime.now()
+    return row
+
+
+def content_hash(row):
+    """Hash the values of ``row`` that come from the scraped page."""
+    content = dict((k, v) for k, v in row.items()
+                   if k not in VOLATILE_COLUMNS)
+    data = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def insert_statement(table, key, rows):
+    """Build ``INSERT ... ON CONFLICT (key) DO NOTHING`` for one row.
+
+    It binds the columns of ``rows[0]`` by name, so it can be executed with
+    one row or with a list of rows (executemany).
+    """
+    columns = list(rows[0])
+    return text(
+        'INSERT INTO {table} ({columns}) VALUES ({names}) '
+        'ON CONFLICT ({key}) DO NOTHING'.format(
+            table=table.name, columns=', '.join(columns),
+            names=', '.join(':' + c for c in columns), key=key))
+
+
+def values_statement(sql, table, key, rows, **fields):
+    """Fill ``sql`` with the columns and multi-row VALUES of ``rows``.
+
+    Returns the statement and its bound parameters.
+    """
+    columns = list(rows[0])
+    params = {}
+    values = []
+    for i, row in enumerate(rows):
+        names = []
+        for j, column in enumerate(columns):
+            name = 'p%d_%d' % (i, j)
+            params[name] = row[column]
+            names.append(':' + name)
+        values.append('(%s)' % ', '.join(names))
+    statement = text(sql.format(
+        table=table.name, columns=', '.join(columns),
+        values=', '.join(values), key=key, **fields))
+    return statement, params
+
+
+def upsert_statement(table, key, rows, dialect='postgresql'):
+    """Build a multi-row ``INSERT ... ON CONFLICT (key) DO UPDATE``.
+
+    The update only happens when the stored ``content_hash`` differs. On
+    Postgres the statement returns one row per inserted or updated row,
+    telling whether it was inserted; SQLite (3.24 or later) has no
+    ``RETURNING`` or ``IS DISTINCT FROM``.
+    """
+    updates = ', '.join('%s = EXCLUDED.%s' % (c, c)
+                        for c in rows[0] if c != key)
+    sql = ('INSERT INTO {table} ({columns}) VALUES {values} '
+           'ON CONFLICT ({key}) DO UPDATE SET {updates} '
+           'WHERE {table}.content_hash {distinct} EXCLUDED.content_hash')
+    if dialect == 'sqlite':
+        distinct = 'IS NOT'
+    else:
+        distinct = 'IS DISTINCT FROM'
+        sql += ' RETURNING (xmax = 0) AS inserted'
+    return values_statement(sql, table, key, rows, updates=updates,
+                            distinct=distinct)
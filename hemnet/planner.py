@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""Plan the search queries used to walk the sold listings.
+
+Hemnet only lets a search be paginated so far, so a query matching more
+listings than that has to be split into narrower ones. Instead of starting
+from every combination of filters, the crawl starts with one query per
+location and item type and splits a query in two only when its first
+results page reports more hits than can be reached.
+
+Every facet is a list of split points. A partition covers a half-open range
+``[points[lo], points[hi])`` of each facet, so sibling partitions never
+overlap. ``None`` at either end of the list means unbounded.
+
+Hemnet takes inclusive ``*_min``/``*_max`` filters. Facets whose values
+come in whole steps (fee in kronor, rooms in halves) send ``points[hi]``
+less one step as the maximum. Living area can be fractional (49.5 m²),
+so its ranges are sent as ``[points[lo], points[hi]]``: siblings share
+the listings right on their boundary, and ``SeenIds`` drops the second
+copy, but none falls between them.
+"""
+
+from collections import namedtuple
+
+from urllib import urlencode
+
+# Order in which facets are split and the step used to turn the exclusive
+# upper bound into the inclusive ``*_max`` Hemnet expects; ``None`` for
+# facets with fractional values, sent with the upper bound included.
+FACETS = [
+    ('living_area', [None, 20, 25, 30, 35, 40, 45, 50, 60, 70, 80, 100, 120,
+                     150, 200, None], None),
+    ('fee', [None, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 5000, 7000,
+             None], 1),
+    ('rooms', [None, 1.5, 2, 2.5, 3, 3.5, 4, 5, 6, None], 0.5),
+]
+
+
+class Partition(namedtuple('Partition', 'location_id item_type ranges')):
+    """One search query: a location, an item type and a range per facet.
+
+    ``ranges`` is a tuple of ``(lo, hi)`` indices into the split points of
+    each facet in ``FACETS``.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def coarse(cls, location_id, item_type):
+        ranges = tuple((0, len(points) - 1) for _, points, _ in FACETS)
+        return cls(location_id, item_type, ranges)
+
+    @classmethod
+    def from_dict(cls, d):
+        """Rebuild a partition from its ``_asdict()`` read back from JSON."""
+        return cls(d['location_id'], d['item_type'],
+                   tuple(tuple(r) for r in d['ranges']))
+
+    @property
+    def splittable(self):
+        return any(hi - lo > 1 for lo, hi in self.ranges)
+
+    def split(self):
+        """Split the first facet that still spans several intervals."""
+        for i, (lo, hi) in enumerate(self.ranges):
+            if hi - lo > 1:
+                mid = (lo + hi) // 2
+                left = self.ranges[:i] + ((lo, mid),) + self.ranges[i + 1:]
+                right = self.ranges[:i] + ((mid, hi),) + self.ranges[i + 1:]
+                return [self._replace(ranges=left),
+                        self._replace(ranges=right)]
+        return [self]
+
+    @property
+    def scope(self):
+        """The location and item type shared by all splits of a partition."""
+        return '%s:%s' % (self.location_id, self.item_type)
+
+    @property
+    def key(self):
+        """Short stable name, used in logs and stats."""
+        parts = [self.scope]
+        for (name, _, _), (lo, hi) in zip(FACETS, self.ranges):
+            parts.append('%s=%s-%s' % (name, lo, hi))
+        return '/'.join(parts)
+
+    def query(self, sold_age):
+        params = [
+            ('location_ids[]', self.location_id),
+            ('item_types[]', self.item_type),
+        ]
+        for (name, points, step), (lo, hi) in zip(FACETS, self.ranges):
+            if points[lo] is not None:
+                params.append(('%s_min' % name, points[lo]))
+            if points[hi] is not None:
+                params.append(('%s_max' % name,
+                               points[hi] if step is None
+                               else points[hi] - step))
+        params.append(('sold_age', sold_age))
+        return urlencode(params)
+
+
+def coarse_partitions(location_ids, item_types):
+    """One partition per location and item type, locations taking turns."""
+    return [Partition.coarse(location_id, item_type)
+            for item_type in item_types
+            for location_id in location_ids]
@@ -0,0 +1,430 @@
+"""Disk request queue for ``JOBDIR`` crawls that survives a crash.
+
+Scrapy keeps the requests of a ``JOBDIR`` crawl in one LIFO file per
+priority, but only writes a queue's length and the list of priorities when
+the spider closes cleanly; after a crash the queued requests are lost.
+``SpillLifoDiskQueue`` stores compressed records followed by their length,
+so the file alone describes the queue, and keeps the newest records, the
+ones popped next, in a bounded window in memory. ``HemnetScheduler`` finds
+the queue files again on resume.
+
+    scrapy crawl hemnetspider -a sold_age=all -s JOBDIR=crawls/all
+
+Run the same command again to resume; the requests already seen are kept
+in ``requests.seen`` and not issued again. A record the crash left half
+written at the end of a file is dropped on resume.
+
+A request taken off its file for download is first written to the
+``inflight`` journal, and its meta gets a ``queue_ticket``. It is marked
+done once it has been handled: its callback ran to the end, the requests
+the callback returned are queued (``QueueTicketMiddleware`` tracks them)
+and its items are stored, which the scheduler makes sure of by sending the
+``checkpoint`` signal every ``HEMNET_QUEUE_CHECKPOINT`` handled requests
+(``HemnetPipeline`` writes its batches). A request whose download failed
+is done when its errback sent ``errors.request_failed``. On resume the
+requests the journal holds that are not done are queued again, so a crash
+costs at most downloading them a second time.
+"""
+
+import glob
+import logging
+import os
+import pickle
+import struct
+import zlib
+from collections import defaultdict, deque
+from itertools import count
+from os.path import basename, join
+
+from scrapy import signals
+from scrapy.core.scheduler import Scheduler
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request
+from scrapy.utils.job import job_dir
+from scrapy.utils.misc import load_object
+
+from hemnet import errors
+
+logger = logging.getLogger(__name__)
+
+RECORD_TRAILER = struct.Struct('>I')
+
+# Sent by HemnetScheduler before it marks handled requests done; handlers
+# return a Deferred firing once the items handed to them so far are stored
+# (see HemnetPipeline.checkpoint).
+checkpoint = object()
+
+# The journal is rewritten with only the requests still in flight when it
+# grows past this many bytes.
+JOURNAL_COMPACT_SIZE = 16 * 1024 * 1024
+
+
+class SpillLifoDiskQueue(object):
+    """LIFO queue of picklable objects in a file, newest ``window`` cached.
+
+    Every push is appended to the file straight away and every pop
+    truncates it, so the file matches the queue whenever the process dies.
+    Pops are served from the window while it lasts and only read the file
+    when it has run dry. ``on_pop`` is called with the record being popped
+    before it leaves the file.
+    """
+
+    def __init__(self, path, window=1000, on_pop=None):
+        self.path = path
+        self.window = deque(maxlen=window) if window > 0 else None
+        self.on_pop = on_pop
+        self.f = open(path, 'a+b')
+        self.f.seek(0, os.SEEK_END)
+        self.end = self.f.tell()
+        self._drop_torn_record()
+        self.size = self._count()
+
+    def _drop_torn_record(self):
+        """Truncate the file after its last complete record.
+
+        A crash during ``push`` can leave part of a record at the end. The
+        end of the last complete one is the nearest offset whose trailer
+        points back at data that decompresses.
+        """
+        end = self.end
+        while end and not self._is_record_end(end):
+            end -= 1
+        if end < self.end:
+            logger.warning('Dropping %d bytes of an incomplete record at '
+                           'the end of %s', self.end - end, self.path)
+            self.f.truncate(end)
+            self.end = end
+
+    def _is_record_end(self, offset):
+        if offset < RECORD_TRAILER.size:
+            return False
+        self.f.seek(offset - RECORD_TRAILER.size)
+        length, = RECORD_TRAILER.unpack(self.f.read(RECORD_TRAILER.size))
+        if not length or length > offset - RECORD_TRAILER.size:
+            return False
+        self.f.seek(offset - RECORD_TRAILER.size - length)
+        try:
+            zlib.decompress(self.f.read(length))
+        except zlib.error:
+            return False
+        return True
+
+    def _count(self):
+        """Walk the record trailers from the end to count the records."""
+        count, offset = 0, self.end
+        while offset > 0:
+            self.f.seek(offset - RECORD_TRAILER.size)
+            length, = RECORD_TRAILER.unpack(
+                self.f.read(RECORD_TRAILER.size))
+            offset -= length + RECORD_TRAILER.size
+            count += 1
+        if offset < 0:
+            raise ValueError('Corrupt queue file %s' % self.path)
+        return count
+
+    def push(self, obj):
+        try:
+            data = zlib.compress(pickle.dumps(obj, protocol=2))
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            raise ValueError(str(e))
+        self.f.seek(0, os.SEEK_END)
+        self.f.write(data + RECORD_TRAILER.pack(len(data)))
+        self.f.flush()
+        self.end += len(data) + RECORD_TRAILER.size
+        self.size += 1
+        if self.window is not None:
+            self.window.append(data)
+
+    def pop(self):
+        if not self.size:
+            return None
+        if self.window:
+            data = self.window.pop()
+        else:
+            self.f.seek(self.end - RECORD_TRAILER.size)
+            length, = RECORD_TRAILER.unpack(
+                self.f.read(RECORD_TRAILER.size))
+            self.f.seek(self.end - RECORD_TRAILER.size - length)
+            data = self.f.read(length)
+        if self.on_pop is not None:
+            self.on_pop(data)
+        self.end -= len(data) + RECORD_TRAILER.size
+        self.f.truncate(self.end)
+        self.size -= 1
+        return pickle.loads(zlib.decompress(data))
+
+    def close(self):
+        self.f.close()
+        if not self.size:
+            os.remove(self.path)
+
+    def __len__(self):
+        return self.size
+
+
+class RequestJournal(SpillLifoDiskQueue):
+    """Log of the requests taken off the queue files.
+
+    Records are ``(ticket, data)`` when a request is taken, ``data`` being
+    its queue record, and ``(ticket, None)`` when it is done.
+    """
+
+    def __init__(self, path):
+        super(RequestJournal, self).__init__(path, window=0)
+
+    def __iter__(self):
+        """Read the records, newest first."""
+        offset = self.end
+        while offset > 0:
+            self.f.seek(offset - RECORD_TRAILER.size)
+            length, = RECORD_TRAILER.unpack(
+                self.f.read(RECORD_TRAILER.size))
+            offset -= length + RECORD_TRAILER.size
+            self.f.seek(offset)
+            yield pickle.loads(zlib.decompress(self.f.read(length)))
+
+    def pending(self):
+        """The queue records of the requests taken and not done, oldest
+        first."""
+        done = set()
+        pending = []
+        for ticket, data in self:
+            if data is None:
+                done.add(ticket)
+            elif ticket not in done:
+                pending.append(data)
+        pending.reverse()
+        return pending
+
+    def rewrite(self, records):
+        """Replace the file with ``records``."""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for record in records:
+                data = zlib.compress(pickle.dumps(record, protocol=2))
+                f.write(data + RECORD_TRAILER.pack(len(data)))
+        self.f.close()
+        os.rename(tmp, self.path)
+        self.f = open(self.path, 'a+b')
+        self.f.seek(0, os.SEEK_END)
+        self.end = self.f.tell()
+        self.size = len(records)
+
+
+class HemnetScheduler(Scheduler):
+    """Scheduler resuming every queue file left in ``JOBDIR``.
+
+    ``HEMNET_QUEUE_MEMORY_WINDOW`` is the number of requests each priority
+    queue keeps in memory. Requests taken off the queue files are kept in
+    the ``inflight`` journal until they are handled, see the module
+    docstring.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.window = kwargs.pop('window', 1000)
+        self.checkpoint_size = kwargs.pop('checkpoint_size', 500)
+        self.signals = kwargs.pop('signals', None)
+        super(HemnetScheduler, self).__init__(*args, **kwargs)
+        self.journal = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super(HemnetScheduler, cls).from_crawler(crawler)
+        settings = crawler.settings
+        scheduler.window = settings.getint('HEMNET_QUEUE_MEMORY_WINDOW', 1000)
+        scheduler.checkpoint_size = settings.getint(
+            'HEMNET_QUEUE_CHECKPOINT', 500)
+        scheduler.signals = crawler.signals
+        crawler.signals.connect(scheduler.request_failed,
+                                signal=errors.request_failed)
+        crawler.signals.connect(scheduler.spider_idle,
+                                signal=signals.spider_idle)
+        return scheduler
+
+    def open(self, spider):
+        result = super(HemnetScheduler, self).open(spider)
+        if self.dqs is not None and self._spills():
+            self._open_journal()
+        return result
+
+    def close(self, reason):
+        if self.journal is not None:
+            # the pipelines were closed, and wrote their items, before the
+            # scheduler
+            self._done(self.finished | self.checkpointing)
+            if not self.inflight:
+                self.journal.rewrite([])
+            self.journal.close()
+            self.journal = None
+        return super(HemnetScheduler, self).close(reason)
+
+    def enqueue_request(self, request):
+        ticket = request.meta.pop('queue_ticket', None)
+        parent = request.meta.pop('queue_parent', None)
+        queued = super(HemnetScheduler, self).enqueue_request(request)
+        if queued and self.journal is not None and \
+                getattr(self.df, 'file', None) is not None:
+            # RFPDupeFilter buffers requests.seen; written after the request
+            # is queued, a crash can only lose the fingerprint, never the
+            # request
+            self.df.file.flush()
+        if ticket is not None:
+            # a retry or a redirect took the place of the request
+            self._finish(ticket)
+        if parent is not None:
+            self._release(parent)
+        return queued
+
+    def hold(self, ticket):
+        """Keep ``ticket`` in flight until a request it returned is
+        queued."""
+        self.holds[ticket] += 1
+
+    def handled(self, ticket):
+        """The callback of the request with ``ticket`` ran to the end."""
+        if self.holds.get(ticket):
+            self.parsed.add(ticket)
+        else:
+            self._finish(ticket)
+
+    def request_failed(self, request, **kwargs):
+        ticket = request.meta.get('queue_ticket')
+        if ticket is not None:
+            self._finish(ticket)
+
+    def spider_idle(self, spider):
+        # Nothing is downloading or being parsed; whatever is still in
+        # flight finished without telling, e.g. a spider middleware dropped
+        # a request it returned.
+        if self.journal is not None and self.inflight:
+            self.finished.update(self.inflight)
+            self._checkpoint()
+
+    def _open_journal(self):
+        self.journal = RequestJournal(join(self.dqdir, 'inflight'))
+        self.tickets = count()
+        self.last_ticket = None
+        # ticket -> queue record of the requests not done yet
+        self.inflight = {}
+        self.holds = defaultdict(int)
+        self.parsed = set()
+        self.finished = set()
+        # finished, waiting for a checkpoint to complete
+        self.checkpointing = set()
+        pending = self.journal.pending()
+        for data in pending:
+            request = pickle.loads(zlib.decompress(data))
+            self.dqs.push(request, -request.get('priority', 0))
+        self.journal.rewrite([])
+        if pending:
+            logger.info('Queued again %(count)d requests that were being '
+                        'handled when the crawl stopped',
+                        {'count': len(pending)}, extra={'spider': self.spider})
+
+    def _taken(self, data):
+        if self.journal is None:
+            return
+        ticket = self.last_ticket = next(self.tickets)
+        self.journal.push((ticket, data))
+        self.inflight[ticket] = data
+
+    def _dqpop(self):
+        request = super(HemnetScheduler, self)._dqpop()
+        if request is not None and self.journal is not None:
+            request.meta['queue_ticket'] = self.last_ticket
+        return request
+
+    def _release(self, ticket):
+        self.holds[ticket] -= 1
+        if self.holds[ticket] <= 0:
+            del self.holds[ticket]
+            if ticket in self.parsed:
+                self._finish(ticket)
+
+    def _finish(self, ticket):
+        if self.journal is None or ticket not in self.inflight:
+            return
+        self.parsed.discard(ticket)
+        self.holds.pop(ticket, None)
+        self.finished.add(ticket)
+        if len(self.finished) >= self.checkpoint_size:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        tickets, self.finished = self.finished, set()
+        self.checkpointing |= tickets
+        d = self.signals.send_catch_log_deferred(signal=checkpoint)
+        d.addCallback(lambda _: self._done(tickets))
+        return d
+
+    def _done(self, tickets):
+        if self.journal is None:
+            return
+        self.checkpointing -= tickets
+        for ticket in tickets:
+            if self.inflight.pop(ticket, None) is not None:
+                self.journal.push((ticket, None))
+        if self.journal.end > JOURNAL_COMPACT_SIZE:
+            self.journal.rewrite(sorted(self.inflight.items()))
+
+    def _spills(self):
+        return issubclass(self.dqclass, SpillLifoDiskQueue)
+
+    def _newdq(self, priority):
+        if not self._spills():
+            return super(HemnetScheduler, self)._newdq(priority)
+        return self.dqclass(join(self.dqdir, 'p%s' % priority), self.window,
+                            on_pop=self._taken)
+
+    def _dq(self):
+        if not self._spills():
+            return super(HemnetScheduler, self)._dq()
+        # active.json is only written on a clean shutdown, the queue files
+        # are always there.
+        prios = []
+        for name in glob.glob(join(self.dqdir, 'p*')):
+            if not basename(name)[1:].lstrip('-').isdigit():
+                continue
+            if os.path.getsize(name):
+                prios.append(int(basename(name)[1:]))
+            else:
+                os.remove(name)
+        prios.sort()
+        q = self.pqclass(self._newdq, startprios=prios)
+        if q:
+            logger.info("Resuming crawl (%(queuesize)d requests scheduled)",
+                        {'queuesize': len(q)}, extra={'spider': self.spider})
+        return q
+
+
+class QueueTicketMiddleware(object):
+    """Tell ``HemnetScheduler`` when a request from its journal is handled.
+
+    The requests a callback returns carry the ticket of the response in
+    ``meta['queue_parent']``, and the response's request stays in flight
+    until they are queued; requests parked by ``TierMiddleware`` count as
+    not queued yet.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not job_dir(settings) or not issubclass(
+                load_object(settings['SCHEDULER']), HemnetScheduler):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider):
+        ticket = response.meta.get('queue_ticket')
+        scheduler = self.crawler.engine.slot.scheduler
+        for x in result:
+            if ticket is not None and isinstance(x, Request):
+                x.meta.pop('queue_ticket', None)
+                x.meta['queue_parent'] = ticket
+                scheduler.hold(ticket)
+            yield x
+        if ticket is not None:
+            scheduler.handled(ticket)
@@ -0,0 +1,73 @@
+import logging
+import sys
+import time
+from array import array
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+
+class SeenIds(object):
+    """Set of known hemnet ids held in memory.
+
+    Ids already stored in the database are kept in a sorted ``array`` of C
+    longs (8 bytes per id on 64-bit Linux) and looked up with a binary
+    search. Ids scheduled during the crawl go into a plain ``set`` so that
+    listings showing up in several overlapping searches are only fetched
+    once.
+    """
+
+    def __init__(self, ids=()):
+        self.stored = array('l', sorted(ids))
+        self.scheduled = set()
+
+    @classmethod
+    def from_query(cls, query, chunk_size=10000):
+        """Load the ids returned by a single-column ``query``.
+
+        The query should be ordered by id, otherwise the ids are sorted
+        after loading which briefly needs a list of all of them.
+        """
+        start = time.time()
+        ids = array('l')
+        ordered = True
+        for hemnet_id, in query.yield_per(chunk_size):
+            if hemnet_id is None:
+                continue
+            if ids and hemnet_id < ids[-1]:
+                ordered = False
+            ids.append(hemnet_id)
+        seen = cls()
+        seen.stored = ids if ordered else array('l', sorted(ids))
+        elapsed = time.time() - start
+
+        size = seen.memory_usage()
+        per_million = size * 1e6 / len(seen) if len(seen) else 0
+        logger.info('Loaded %d known hemnet ids in %.2fs '
+                    '(%.1f KiB, %.1f MiB per million ids)',
+                    len(seen), elapsed, size / 1024.0,
+                    per_million / (1024.0 * 1024.0))
+        return seen
+
+    def __len__(self):
+        return len(self.stored) + len(self.scheduled)
+
+    def __contains__(self, hemnet_id):
+        if hemnet_id in self.scheduled:
+            return True
+        i = bisect_left(self.stored, hemnet_id)
+        return i < len(self.stored) and self.stored[i] == hemnet_id
+
+    def add(self, hemnet_id):
+        """Mark ``hemnet_id`` as scheduled.
+
+        Returns False when the id was already known, True otherwise.
+        """
+        if hemnet_id in self:
+            return False
+        self.scheduled.add(hemnet_id)
+        return True
+
+    def memory_usage(self):
+        return (sys.getsizeof(self.stored) + sys.getsizeof(self.scheduled) +
+                sum(sys.getsizeof(i) for i in self.scheduled))
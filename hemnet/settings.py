@@ -14,6 +14,7 @@ BOT_NAME = 'hemnet'
 
 SPIDER_MODULES = ['hemnet.spiders']
 NEWSPIDER_MODULE = 'hemnet.spiders'
+COMMANDS_MODULE = 'hemnet.commands'
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -46,9 +47,39 @@ COOKIES_ENABLED = False
 
 # Enable or disable spider middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    'hemnet.middlewares.MyCustomSpiderMiddleware': 543,
-#}
+SPIDER_MIDDLEWARES = {
+    'hemnet.middlewares.CallbackTimingMiddleware': 950,
+    # below OffsiteMiddleware so it only counts requests that get scheduled
+    'hemnet.middlewares.TierMiddleware': 100,
+    # with JOBDIR; above the built-in middlewares, so it sees every request
+    # a callback returns
+    'hemnet.queues.QueueTicketMiddleware': 920,
+}
+
+# Request priority per meta['tier'] (detail pages first, new search
+# partitions last) and the most requests of a tier scheduled or downloading
+# at once. Capping partitions and next result pages keeps the backlog of
+# detail pages short, so items reach the database from the start.
+HEMNET_TIERS_ENABLED = True
+HEMNET_TIER_PRIORITIES = {
+    'detail': 30,
+    'prev': 20,
+    'next_page': 10,
+    'partition': 0,
+}
+HEMNET_TIER_CAPS = {
+    'next_page': 32,
+    'partition': 16,
+}
+
+# Most requests made per location in a crawl, 0 for no limit. Overridden by
+# -a budget=N and by the budget column of hemnet_locations.
+HEMNET_REGION_BUDGET = 0
+
+# Remember a fingerprint of every results page (its listings, ETag and
+# Last-Modified) and skip a page and the pages after it when it has not
+# changed since the last finished crawl.
+HEMNET_PAGE_FINGERPRINTS = True
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
@@ -58,9 +89,28 @@ COOKIES_ENABLED = False
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    'scrapy.telnet.TelnetConsole': None,
-#}
+EXTENSIONS = {
+    'hemnet.metrics.MetricsExtension': 500,
+    'hemnet.analytics.AnalyticsRefresh': 510,
+    'hemnet.comparables.ComparablesRefresh': 520,
+}
+
+# Refresh hemnet_broker_area_month when a spider closes, see
+# hemnet/analytics.py and `scrapy analytics`.
+HEMNET_ANALYTICS_REFRESH = True
+
+# Path of the comparables index (e.g. 'comparables.npz') to refresh when a
+# spider closes; off when unset. Needs numpy, see hemnet/comparables.py and
+# `scrapy comparables`. The grid cells are about this many metres wide.
+HEMNET_COMPARABLES_INDEX = None
+HEMNET_COMPARABLES_CELL_SIZE = 500
+
+# Callback, database and queue metrics, see hemnet/metrics.py. Set
+# HEMNET_METRICS_TEXTFILE (may contain %(name)s) to also write them in the
+# Prometheus text format every interval.
+HEMNET_METRICS_ENABLED = True
+HEMNET_METRICS_INTERVAL = 30
+HEMNET_METRICS_TEXTFILE = None
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
@@ -68,10 +118,60 @@ ITEM_PIPELINES = {
    'hemnet.pipelines.HemnetPipeline': 300,
 }
 
+# Buffer items and write them with one INSERT per batch.
+# A batch is flushed when it is full, every HEMNET_PIPELINE_FLUSH_INTERVAL
+# seconds and when the spider closes. Set the batch size to 1 to commit
+# every item on its own.
+HEMNET_PIPELINE_BATCH_SIZE = 500
+HEMNET_PIPELINE_FLUSH_INTERVAL = 30
+# 'upsert' keeps one row per hemnet id (salda id for comps) and skips rows
+# whose content did not change; 'insert' writes every item whose id is not
+# stored yet and skips the others. Both need the unique ids added by the
+# migration at the end of queries.sql on databases created before them.
+HEMNET_PIPELINE_WRITE_MODE = 'upsert'
+
+# Spider lookups, pipeline writes and the analytics refresh run in this many
+# threads, off the reactor thread, on one engine per process whose pool
+# holds HEMNET_DB_POOL_SIZE connections and HEMNET_DB_MAX_OVERFLOW more when
+# busy. See hemnet/db.py.
+HEMNET_DB_THREADS = 4
+HEMNET_DB_POOL_SIZE = 5
+HEMNET_DB_MAX_OVERFLOW = 5
+
+# Failed requests are appended to this JSON lines file, which is also the
+# queue drained by `scrapy crawl <spider> -a retry_errors=1`. An entry is
+# retried HEMNET_ERROR_BACKOFF * 2 ** (attempt - 1) seconds after it failed
+# and given up after HEMNET_ERROR_MAX_ATTEMPTS attempts.
+HEMNET_ERROR_QUEUE = '%(name)s_err.jsonl'
+HEMNET_ERROR_BUFFER = 100
+HEMNET_ERROR_BACKOFF = 60
+HEMNET_ERROR_MAX_ATTEMPTS = 5
+
+# With JOBDIR set, queued requests are kept in crash-safe files under it and
+# only the next HEMNET_QUEUE_MEMORY_WINDOW requests per priority in memory.
+# Requests being handled are journaled and marked done after the pipeline
+# wrote their items, every HEMNET_QUEUE_CHECKPOINT handled requests.
+SCHEDULER = 'hemnet.queues.HemnetScheduler'
+SCHEDULER_DISK_QUEUE = 'hemnet.queues.SpillLifoDiskQueue'
+HEMNET_QUEUE_MEMORY_WINDOW = 1000
+HEMNET_QUEUE_CHECKPOINT = 500
+
+# Shared request frontier for crawls spread over several workers, used with
+# SCHEDULER = 'hemnet.frontier.FrontierScheduler'. Workers started with the
+# same HEMNET_FRONTIER_CRAWL share one crawl (default: per spider and day).
+HEMNET_FRONTIER_CRAWL = '%(name)s-%(date)s'
+HEMNET_FRONTIER_LEASE_SIZE = 32
+HEMNET_FRONTIER_INSERT_BATCH = 100
+HEMNET_FRONTIER_VISIBILITY_TIMEOUT = 300
+HEMNET_FRONTIER_MAX_ATTEMPTS = 3
+HEMNET_FRONTIER_POLL_INTERVAL = 5
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
 # NOTE: AutoThrottle will honour the standard settings for concurrency and delay
-AUTOTHROTTLE_ENABLED = True
+# Replaced by hemnet.middlewares.AdaptiveThrottleMiddleware, which also backs
+# off on 429/503 responses and Cloudflare challenges.
+AUTOTHROTTLE_ENABLED = False
 # The initial download delay
 AUTOTHROTTLE_START_DELAY = 5
 # The maximum download delay to be set in case of high latencies
@@ -79,19 +179,45 @@ AUTOTHROTTLE_MAX_DELAY = 60
 # Enable showing throttling stats for every response received:
 AUTOTHROTTLE_DEBUG = False
 
+# Per-slot AIMD throttle, see hemnet.middlewares.AdaptiveThrottleMiddleware.
+# DOWNLOAD_DELAY is the starting delay.
+HEMNET_THROTTLE_ENABLED = True
+HEMNET_THROTTLE_TARGET_LATENCY = 2.0
+HEMNET_THROTTLE_MIN_DELAY = 0.5
+HEMNET_THROTTLE_MAX_DELAY = 60
+HEMNET_THROTTLE_DELAY_STEP = 0.1
+HEMNET_THROTTLE_MAX_CONCURRENCY = 8
+HEMNET_THROTTLE_WINDOW = 50
+HEMNET_THROTTLE_ERROR_RATE = 0.2
+
 # Enable and configure HTTP caching (disabled by default)
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
 
 # HTTPCACHE_ENABLED = bool(os.environ.get('SCRAPY_HTTP_CACHE', True))
-HTTPCACHE_ENABLED = False
+HTTPCACHE_ENABLED = True
 HTTPCACHE_EXPIRATION_SECS = 0
 HTTPCACHE_DIR = 'httpcache'
-HTTPCACHE_IGNORE_HTTP_CODES = []
-HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+# Do not cache errors, rate limiting or challenge pages, nor the answers to
+# conditional requests for results pages.
+HTTPCACHE_IGNORE_HTTP_CODES = [304, 403, 429, 500, 502, 503, 504]
+HTTPCACHE_STORAGE = 'hemnet.httpcache.SegmentCacheStorage'
+
+# Expiry in seconds per page type, 0 means never. Sold pages do not change,
+# listing and result pages do.
+HEMNET_HTTPCACHE_EXPIRATION = {
+    'sold': 0,
+    'listing': 24 * 60 * 60,
+    'results': 30 * 60,
+    'other': 60 * 60,
+}
+HEMNET_HTTPCACHE_SEGMENT_SIZE = 256 * 1024 * 1024
+# Compact the cache on close when more than this share of it is dead.
+HEMNET_HTTPCACHE_COMPACT_RATIO = 0.5
 
 
 DOWNLOADER_MIDDLEWARES = {
     'hemnet.middlewares.RotateUserAgentMiddleware': 110,
+    'hemnet.middlewares.AdaptiveThrottleMiddleware': 950,
     'scrapy.downloadermiddlewares.httpproxy.HttpProxyMiddleware': 110
 }
 
@@ -141,6 +267,9 @@ USER_AGENT_CHOICES = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36',
 ]
 
+# Set the HEMNET_DATABASE_URL environment variable (e.g. sqlite:///hemnet.db)
+# to use another database; SQLite runs in WAL mode, see hemnet/models.py. The
+# frontier scheduler, analytics and export commands need Postgres.
 DATABASE = {
     'drivername': 'postgres',
     'host': 'postgres',
@@ -1,119 +1,178 @@
 # -*- coding: utf-8 -*-
 
-import re
-import json
+from collections import deque
+
 import scrapy
-from scrapy.spidermiddlewares.httperror import HttpError
-from twisted.internet.error import TimeoutError, TCPTimedOutError
 
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.log import failure_to_exc_info
 from sqlalchemy.orm import sessionmaker
 
+from hemnet.db import shared_pool
+from hemnet.errors import ErrorQueueMixin
+from hemnet.extractors import (
+    ExtractError,
+    comp_item,
+    extract_listing_page,
+    extract_sold_page,
+)
 from hemnet.models import (
     HemnetItem as HemnetSQL,
     HemnetCompItem as HemnetCompSQL,
-    db_connect,
-    create_hemnet_table
 )
 
 
-class HemnetSpider(scrapy.Spider):
+class HemnetSpider(ErrorQueueMixin, scrapy.Spider):
     name = 'hemnetcompspider'
     rotate_user_agent = True
+    retry_priorities = {
+        'parse_detail_page': 20,
+        'parse_salda': 10,
+    }
 
-    def __init__(self, *args, **kwargs):
+    # Sold items without a comp item are read this many at a time.
+    batch_size = 1000
+
+    def __init__(self, limit=None, since=None, *args, **kwargs):
         super(HemnetSpider, self).__init__(*args, **kwargs)
-        engine = db_connect()
-        create_hemnet_table(engine)
-        self.session = sessionmaker(bind=engine)()
-
-    def _write_err(self, code, url):
-        with open(self.name + '_err.txt', 'a') as f:
-            f.write('{}: {}\n'.format(code, url))
-
-    def download_err_back(self, failure):
-        if failure.check(HttpError):
-            response = failure.value.response
-            self._write_err(response.status, response.url)
-        elif failure.check(TimeoutError, TCPTimedOutError):
-            request = failure.request
-            self._write_err('TimeoutError', request.url)
-        else:
-            request = failure.request
-            self._write_err('Other', request.url)
+        self.limit = int(limit) if limit else None
+        self.since = since
+        self.missing = deque()
+        self.after_id = None
+        self.exhausted = False
+        self.loading = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(HemnetSpider, cls).from_crawler(crawler, *args,
+                                                       **kwargs)
+        spider.db = shared_pool(crawler.settings)
+        crawler.signals.connect(spider.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(spider.spider_idle,
+                                signal=signals.spider_idle)
+        return spider
+
+    def spider_opened(self, spider):
+        if self.retry_errors in (False, '0', 'false', ''):
+            return self._load_more()
+
+    def _missing_comps(self, after_id, limit):
+        """Sold items after ``after_id`` that have no comp item yet.
+
+        Runs in a database thread. The anti-join runs in the database and
+        walks the hemnet_id index, one batch at a time.
+        """
+        session = sessionmaker(bind=self.db.engine)()
+        try:
+            has_comp = session.query(HemnetCompSQL.id)\
+                .filter(HemnetCompSQL.salda_id == HemnetSQL.hemnet_id)\
+                .exists()
+            q = session.query(HemnetSQL.hemnet_id, HemnetSQL.url,
+                              HemnetSQL.listing_url, HemnetSQL.lat,
+                              HemnetSQL.lon)\
+                .filter(~has_comp)\
+                .filter(HemnetSQL.hemnet_id.isnot(None))
+            if after_id is not None:
+                q = q.filter(HemnetSQL.hemnet_id > after_id)
+            if self.since:
+                q = q.filter(HemnetSQL.sold_date >= self.since)
+            return q.order_by(HemnetSQL.hemnet_id).limit(limit).all()
+        finally:
+            session.close()
+
+    def _load_more(self):
+        """Read the next batch of sold items in the background."""
+        limit = self.batch_size
+        if self.limit:
+            limit = min(limit, self.limit)
+        self.loading = self.db.run(self._missing_comps, self.after_id, limit)
+        self.loading.addCallbacks(self._loaded, self._load_failed,
+                                  callbackArgs=(limit,))
+        return self.loading
+
+    def _loaded(self, rows, limit):
+        self.loading = None
+        self.missing.extend(rows)
+        if rows:
+            self.after_id = rows[-1][0]
+        if self.limit:
+            self.limit -= len(rows)
+        if len(rows) < limit or self.limit == 0:
+            self.exhausted = True
+
+    def _load_failed(self, failure):
+        # Stop reading; the spider closes once the requests it has made
+        # are done instead of waiting for a batch that never comes.
+        self.loading = None
+        self.exhausted = True
+        self.logger.error('Failed to read sold items without comps after '
+                          'hemnet id %s, not reading more', self.after_id,
+                          exc_info=failure_to_exc_info(failure))
+
+    def _next_requests(self):
+        """Requests for the batches read so far.
+
+        The next batch is read while the current one is half done; if it
+        is not there yet when this one runs out, ``spider_idle`` schedules
+        it.
+        """
+        while True:
+            if not self.exhausted and self.loading is None and \
+                    len(self.missing) <= self.batch_size // 2:
+                self._load_more()
+            if not self.missing:
+                return
+            yield self._comp_request(*self.missing.popleft())
+
+    def _comp_request(self, salda_id, url, listing_url, lat, lon):
+        if listing_url:
+            # stored with the sold item, no need to fetch the sold page
+            return scrapy.Request(listing_url, self.parse_detail_page,
+                                  meta={'lat': lat, 'lon': lon,
+                                        'salda_id': salda_id,
+                                        'tier': 'prev'},
+                                  errback=self.download_err_back)
+        return scrapy.Request(url, self.parse_salda,
+                              errback=self.download_err_back,
+                              meta={'salda_id': salda_id})
 
     def start_requests(self):
-        session = self.session
-        salda_items = session.query(HemnetSQL.hemnet_id, HemnetSQL.url).all()
-        comp_ids = [i for i, in session.query(HemnetCompSQL.salda_id).all()]
-        for salda_id, url in salda_items:
-            if salda_id not in comp_ids:
-                yield scrapy.Request(url, self.parse_salda,
-                                     errback=self.download_err_back,
-                    meta={'salda_id': salda_id})
+        if self.retry_errors not in (False, '0', 'false', ''):
+            for request in self.retry_requests():
+                yield request
+            return
+
+        for request in self._next_requests():
+            yield request
+
+    def spider_idle(self, spider):
+        if self.loading is None and not self.missing:
+            return
+        if self.loading is None:
+            for request in self._next_requests():
+                self.crawler.engine.crawl(request, self)
+        raise DontCloseSpider
 
     def parse_salda(self, response):
-        prev_page_url = response.css('link[rel=prev]::attr(href)')\
-            .extract_first()
-        pattern = 'coordinate.*\[(\d{2}\.\d+\,\d{2}\.\d+)\]'
-        g = re.search(pattern, response.body)
-        salda_id = response.meta['salda_id']
-        try:
-            lat, lon = map(float, g.group(1).split(','))
-        except:
-            lat, lon = None, None
-        yield scrapy.Request(prev_page_url, self.parse_detail_page,
-            meta={'lat': lat, 'lon': lon, 'salda_id': salda_id},
-            errback=self.download_err_back)
+        page = extract_sold_page(response)
+        if page.prev_url:
+            yield scrapy.Request(page.prev_url, self.parse_detail_page,
+                                 meta={'lat': page.lat, 'lon': page.lon,
+                                       'salda_id': response.meta['salda_id'],
+                                       'tier': 'prev'},
+                                 errback=self.download_err_back)
 
     def parse_detail_page(self, response):
-        pattern = 'dataLayer\s*=\s*(\[.*\]);'
-        g = re.search(pattern, response.body)
         try:
-            d = json.loads(g.group(1))
-        except:
-            self._write_err('JSONError', response.url)
+            listing = extract_listing_page(response)
+        except ExtractError:
+            self._write_err('JSONError', response.request)
         else:
-            prop = next((el for el in d if u'property' in el), None)['property']
-
-            item = HemnetCompItem()
-
-            item['url'] = response.url
-
-            item['lattitude'] = response.meta['lat']
-            item['longitude'] = response.meta['lon']
-
-            item['salda_id'] = response.meta['salda_id']
-
-            locations = prop.get('locations', {})
-
-            item['city'] = locations.get('city')
-            item['postal_city'] = locations.get('postal_city')
-            item['district'] = locations.get('district')
-            item['country'] = locations.get('country')
-            item['region'] = locations.get('region')
-            item['municipality'] = locations.get('municipality')
-            item['street'] = locations.get('street')
-
-            item['offers_selling_price'] = prop.get('offers_selling_price')
-            item['living_area'] = prop.get('living_area')
-            item['rooms'] = prop.get('rooms')
-            item['hemnet_id'] = prop.get('id')
-            item['cost_per_year'] = prop.get('driftkostnad')
-            item['new_production'] = prop.get('new_production')
-            item['broker_firm'] = prop.get('broker_firm')
-            item['upcoming_open_houses'] = prop.get('upcoming_open_houses')
-            item['location'] = prop.get('location')
-            item['home_swapping'] = prop.get('home_swapping')
-            item['has_price_change'] = prop.get('has_price_change')
-            item['status'] = prop.get('status')
-            item['price'] = prop.get('price')
-            item['monthly_fee'] = prop.get('borattavgift')
-            item['main_location'] = prop.get('main_location')
-            item['publication_date'] = prop.get('publication_date')
-            item['has_active_toplisting'] = prop.get('has_active_toplisting')
-            item['images_count'] = prop.get('images_count')
-            item['item_type'] = prop.get('item_type')
-            item['price_per_m2'] = prop.get('price_per_m2')
-            item['street_address'] = prop.get('street_address')
-
-            yield item
+            yield comp_item(listing, response.url,
+                            response.meta['lat'], response.meta['lon'],
+                            response.meta['salda_id'])
+
+    def closed(self, reason):
+        self.error_sink.close()
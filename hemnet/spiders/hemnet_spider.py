@@ -1,303 +1,450 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import re
-import json
 import scrapy
 
+from collections import defaultdict
+from datetime import date, datetime
 from urlparse import urlparse, urljoin
-from urllib import urlencode
-from itertools import product
 
-from scrapy import Selector
-from scrapy.spidermiddlewares.httperror import HttpError
-from twisted.internet.error import TimeoutError, TCPTimedOutError
+from scrapy import signals
+from scrapy.utils.python import to_native_str
 from sqlalchemy.orm import sessionmaker
 
-from hemnet.items import HemnetItem, HemnetCompItem
+from hemnet.db import shared_pool
+from hemnet.errors import ErrorQueueMixin
+from hemnet.extractors import (
+    ExtractError,
+    comp_item,
+    extract_listing_page,
+    extract_sold_page,
+    sold_item,
+)
+from hemnet.planner import Partition, coarse_partitions
+from hemnet.seen import SeenIds
 from hemnet.models import (
     HemnetItem as HemnetSQL,
-    db_connect,
-    create_hemnet_table
+    HemnetCrawlState,
+    HemnetLocation,
+    HemnetPageFingerprint,
 )
 
 
 BASE_URL = 'http://www.hemnet.se/salda/bostader?'
+NEWEST_FIRST = 'order_by=sale_date&order=desc'
+
+# Search windows offered by Hemnet, narrowest first, with their length in
+# days. Incremental runs pick the narrowest one covering the watermark.
+SOLD_AGES = [('1w', 7), ('1m', 30), ('3m', 91), ('6m', 182), ('12m', 365)]
 
+# Crawled when neither -a locations nor -a location_set is given.
 location_ids = [17744]
 item_types = ['radhus', 'bostadsratt', 'villa']
-rooms = [None, 1, 1.5, 2, 2.5, 3, 3.5, 4, 5, 100]
-living_area = [None, 20, 25, 30, 35, 40, 45, 50, 60, 70, 80, 500]
-fee = [None, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 5000, 7000, 30000]
-
-
-def url_queries(sold_age):
-    d_ = {
-        'location_ids': location_ids,
-        'item_types': item_types,
-        'rooms': rooms,
-        'living_area': zip(living_area, living_area[1:]),
-        'fee': zip(fee, fee[1:]),
-    }
 
-    def _encode_query(params):
-        url_query = {
-            'location_ids[]': params['location_ids'],
-            'item_types[]': params['item_types'],
-            'rooms_min': params['rooms'],
-            'rooms_max': params['rooms'],
-            'living_area_min': params['living_area'][0],
-            'living_area_max': params['living_area'][1],
-            'fee_min': params['fee'][0],
-            'fee_max': params['fee'][1],
-            'sold_age': sold_age
-        }
-        return urlencode(url_query)
 
-    param_list = [dict(zip(d_, v)) for v in product(*d_.values())]
-    return [_encode_query(p) for p in param_list]
+def start_partitions(locations=None):
+    if locations is None:
+        locations = location_ids
+    return coarse_partitions(locations, item_types)
 
 
-def start_urls(sold_age):
-    return [BASE_URL + qry for qry in url_queries(sold_age)]
+def start_urls(sold_age, locations=None):
+    return [BASE_URL + p.query(sold_age)
+            for p in start_partitions(locations)]
 
 
-class HemnetSpider(scrapy.Spider):
-    name = 'hemnetspider'
-    rotate_user_agent = True
+def parse_locations(value):
+    """Parse ``-a locations=17744,17755:5000`` into ids and budgets.
 
-    def __init__(self, sold_age='1m', *args, **kwargs):
-        super(HemnetSpider, self).__init__(*args, **kwargs)
-        self.sold_age = sold_age
-        engine = db_connect()
-        create_hemnet_table(engine)
-        self.session = sessionmaker(bind=engine)()
+    A location may carry its request budget after a colon, 0 for no
+    limit.
+    """
+    locations, budgets = [], {}
+    for part in value.split(','):
+        location_id, _, budget = part.strip().partition(':')
+        locations.append(int(location_id))
+        if budget:
+            budgets[int(location_id)] = int(budget)
+    return locations, budgets
 
-    def start_requests(self):
-        for url in start_urls(self.sold_age):
-            yield scrapy.Request(url, self.parse,
-                                 errback=self.download_err_back)
 
-    def _write_err(self, code, url):
-        with open(self.name + '_err.txt', 'a') as f:
-            f.write('{}: {}\n'.format(code, url))
-
-    def download_err_back(self, failure):
-        if failure.check(HttpError):
-            response = failure.value.response
-            self._write_err(response.status, response.url)
-        elif failure.check(TimeoutError, TCPTimedOutError):
-            request = failure.request
-            self._write_err('TimeoutError', request.url)
-        else:
-            request = failure.request
-            self._write_err('Other', request.url)
+def listings_hash(hemnet_ids):
+    """Fingerprint of the ordered listings of a results page."""
+    return hashlib.sha1(','.join(str(hemnet_id) for hemnet_id in hemnet_ids)
+                        .encode('ascii')).hexdigest()
 
-    def parse(self, response):
-        urls = response.css('#search-results li > div > a::attr("href")')
-        for url in urls.extract():
-            session = self.session
-            q = session.query(HemnetSQL)\
-                .filter(HemnetSQL.hemnet_id == get_hemnet_id(url))
-            if not session.query(q.exists()).scalar():
-                yield scrapy.Request(url, self.parse_detail_page,
-                                     errback=self.download_err_back)
 
-        next_href = response.css('a.next_page::attr("href")').extract_first()
-        if next_href:
-            next_url = urljoin(response.url, next_href)
-            scrapy.Request(next_url, self.parse_detail_page,
-                           errback=self.download_err_back)
-
-    @staticmethod
-    def _get_layer_data(response):
-        pattern = 'dataLayer\s*=\s*(\[.*\]);'
-        g = re.search(pattern, response.body)
-        d = json.loads(g.group(1))
-        return d
-
-    def parse_detail_page(self, response):
-
-        props = {}
-        try:
-            layer_data = self._get_layer_data(response)
-        except:
-            self._write_err('JSONError', response.url)
-        else:
-            props = next((el for el in layer_data if u'sold_property' in el),
-                         {}).get('sold_property', {})
-
-        item = HemnetItem()
+class HemnetSpider(ErrorQueueMixin, scrapy.Spider):
+    name = 'hemnetspider'
+    rotate_user_agent = True
+    retry_priorities = {
+        'parse_detail_page': 30,
+        'parse_prev_page': 20,
+        'parse': 10,
+    }
 
-        # type: Selector
-        broker_sel = response.css('.broker-contact-card__information')[0]
-        property_attributes = get_property_attributes(response)
+    # Hemnet stops paginating a search after this many results.
+    max_results = 2500
 
-        item['url'] = response.url
-        slug = urlparse(response.url).path.split('/')[-1]
-        item['hemnet_id'] = props.get('id')
-        item['type'] = slug.split('-')[0]
+    # Skip results pages listing the same sales as in the last crawl, see
+    # HEMNET_PAGE_FINGERPRINTS.
+    fingerprint_pages = False
 
-        raw_rooms = props.get('rooms')
-        try:
-            item['rooms'] = float(raw_rooms)
-        except Exception:
-            pass
+    def __init__(self, sold_age='1m', incremental=False, locations=None,
+                 location_set=None, budget=None, *args, **kwargs):
+        super(HemnetSpider, self).__init__(*args, **kwargs)
+        self.sold_age = sold_age
+        self.incremental = incremental not in (False, '0', 'false', '')
+        self.seen_ids = SeenIds()
+        self.watermarks = {}
+        # Locations are regions: each has its own request budget and the
+        # capped tiers take turns between them (see TierMiddleware).
+        self.location_ids, self.budgets = None, {}
+        if locations:
+            self.location_ids, self.budgets = parse_locations(locations)
+        self.location_set = location_set
+        self.default_budget = int(budget) if budget else None
+        self.spent = defaultdict(int)
+        self.over_budget = set()
+        # Results page fingerprints by url, from the last crawl and this one.
+        self.fingerprints = {}
+        self.new_fingerprints = {}
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(HemnetSpider, cls).from_crawler(crawler, *args,
+                                                       **kwargs)
+        spider.db = shared_pool(crawler.settings)
+        if spider.default_budget is None:
+            spider.default_budget = \
+                crawler.settings.getint('HEMNET_REGION_BUDGET') or None
+        spider.fingerprint_pages = crawler.settings.getbool(
+            'HEMNET_PAGE_FINGERPRINTS', True)
+        crawler.signals.connect(spider.spider_opened,
+                                signal=signals.spider_opened)
+        return spider
+
+    def spider_opened(self, spider):
+        """Load the known ids, watermarks, page fingerprints and locations
+        before the first request."""
+        d = self.db.run(self._load_state)
+        d.addCallback(self._state_loaded)
+        if self.location_set:
+            d.addCallback(lambda _: self.db.run(self._load_locations))
+            d.addCallback(self._locations_loaded)
+        return d
 
+    def _load_locations(self):
+        session = sessionmaker(bind=self.db.engine)()
         try:
-            fee = int(property_attributes.get(u'Avgift/månad', '')
-                      .replace(u' kr/m\xe5n', '').replace(u'\xa0', u''))
-        except ValueError:
-            fee = None
-        item['monthly_fee'] = fee
-
+            return session.query(HemnetLocation.location_id,
+                                 HemnetLocation.budget)\
+                .filter(HemnetLocation.location_set == self.location_set)\
+                .filter(HemnetLocation.enabled.is_(True))\
+                .order_by(HemnetLocation.id).all()
+        finally:
+            session.close()
+
+    def _locations_loaded(self, rows):
+        if not rows:
+            self.logger.error('No enabled locations in location set %r',
+                              self.location_set)
+        self.location_ids = [location_id for location_id, _ in rows]
+        self.budgets = dict((location_id, budget)
+                            for location_id, budget in rows
+                            if budget is not None)
+        self.logger.info('Crawling %d locations of set %r',
+                         len(self.location_ids), self.location_set)
+
+    def _load_state(self):
+        session = sessionmaker(bind=self.db.engine)()
         try:
-            item['square_meters'] = float(props.get('living_area'))
-        except ValueError:
-            pass
+            seen_ids = SeenIds.from_query(
+                session.query(HemnetSQL.hemnet_id)
+                .order_by(HemnetSQL.hemnet_id))
+            watermarks = {}
+            # hemnet.analytics keeps its refresh marker in the same table
+            states = session.query(HemnetCrawlState).filter(
+                ~HemnetCrawlState.scope.startswith('analytics:'))
+            for state in states:
+                watermarks[state.scope] = (state.newest_sold_date,
+                                           state.newest_hemnet_id)
+            fingerprints = {}
+            if self.fingerprint_pages:
+                for url, digest, etag, last_modified in session.query(
+                        HemnetPageFingerprint.url,
+                        HemnetPageFingerprint.listings_hash,
+                        HemnetPageFingerprint.etag,
+                        HemnetPageFingerprint.last_modified):
+                    fingerprints[url] = (digest, etag, last_modified)
+        finally:
+            session.close()
+        return seen_ids, watermarks, fingerprints
+
+    def _state_loaded(self, result):
+        self.seen_ids, self.watermarks, self.fingerprints = result
+
+    def retry_meta(self, meta):
+        meta = dict(meta)
+        if isinstance(meta.get('partition'), dict):
+            meta['partition'] = Partition.from_dict(meta['partition'])
+        return meta
 
-        try:
-            cost = int(property_attributes.get(u'Driftskostnad', '')
-                       .replace(u' kr/\xe5r', '').replace(u'\xa0', u''))
-        except Exception:
-            cost = None
-        item['cost_per_year'] = cost
+    def start_requests(self):
+        if self.retry_errors not in (False, '0', 'false', ''):
+            for request in self.retry_requests():
+                yield request
+            return
+
+        for partition in start_partitions(self.location_ids):
+            if not self._spend(partition.location_id):
+                continue
+            sold_age = self.sold_age
+            if self.incremental:
+                newest_sold_date, _ = self.watermarks.get(
+                    partition.scope, (None, None))
+                sold_age = sold_age_covering(newest_sold_date, sold_age)
+            yield self._partition_request(partition, sold_age)
+
+    def _partition_request(self, partition, sold_age):
+        url = BASE_URL + partition.query(sold_age) + '&' + NEWEST_FIRST
+        return self._results_request(url, {'partition': partition,
+                                           'sold_age': sold_age,
+                                           'page': 1,
+                                           'region': partition.location_id,
+                                           'tier': 'partition'})
+
+    def _results_request(self, url, meta):
+        """Request a results page, conditionally when it was seen before.
+
+        ``meta['results_url']`` keeps the url the fingerprint is stored
+        under through redirects.
+        """
+        meta['results_url'] = url
+        headers = {}
+        _, etag, last_modified = self.fingerprints.get(url, (None,) * 3)
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        if headers:
+            meta['handle_httpstatus_list'] = [304]
+        return scrapy.Request(url, self.parse, headers=headers, meta=meta,
+                              errback=self.download_err_back)
 
-        # can be '2008-2009'
-        item['year'] = property_attributes.get(u'Byggår', '')
+    def parse(self, response):
+        partition = response.meta.get('partition')
+        sold_age = response.meta.get('sold_age', self.sold_age)
+        page = response.meta.get('page', 1)
+        region = response.meta.get('region')
+        # Nothing new on an unchanged page means nothing new on the pages
+        # after it either, so its pagination is not followed.
+        if response.status == 304:
+            self._inc_stat('hemnet/results/not_modified')
+            return
+        if page == 1 and partition is not None and partition.splittable:
+            count = get_result_count(response)
+            if count is not None and count > self.max_results:
+                self.logger.debug('Splitting %s with %d results',
+                                  partition.key, count)
+                for child in partition.split():
+                    if self._spend(region):
+                        yield self._partition_request(child, sold_age)
+                return
+
+        scope = partition.scope if partition is not None else None
+        new_ids = 0
+        urls = response.css('#search-results li > div > a::attr("href")')\
+            .extract()
+        if self.fingerprint_pages and self._page_unchanged(response, urls):
+            self._inc_stat('hemnet/results/unchanged')
+            return
+
+        for url in urls:
+            if self.seen_ids.add(get_hemnet_id(url)):
+                new_ids += 1
+                if not self._spend(region):
+                    continue
+                yield scrapy.Request(url, self.parse_detail_page,
+                                     meta={'scope': scope, 'region': region,
+                                           'tier': 'detail'},
+                                     errback=self.download_err_back)
 
-        try:
-            association = property_attributes.get(u'Förening').strip()
-        except:
-            association = None
-        item['association'] = association
+        # Results are newest first, so once a page holds nothing new the
+        # rest of the partition was collected by an earlier run.
+        if self.incremental and not new_ids:
+            self.logger.debug('No new listings on page %d of %s, stopping',
+                              page, partition.key if partition else
+                              response.url)
+            return
 
-        try:
-            lot_size = int(property_attributes.get(u'Tomtarea')
-                           .strip().rsplit(' ')[0].replace(u'\xa0', ''))
-        except:
-            lot_size = None
-        item['lot_size'] = lot_size
+        next_href = response.css('a.next_page::attr("href")').extract_first()
+        if next_href and self._spend(region):
+            next_url = urljoin(response.url, next_href)
+            yield self._results_request(next_url, {'partition': partition,
+                                                   'sold_age': sold_age,
+                                                   'page': page + 1,
+                                                   'region': region,
+                                                   'tier': 'next_page'})
+
+    def _page_unchanged(self, response, urls):
+        """Fingerprint a results page; True if it lists what it did in the
+        last crawl."""
+        url = response.meta.get('results_url', response.url)
+        digest = listings_hash(get_hemnet_id(href) for href in urls)
+        self.new_fingerprints[url] = (
+            response.meta.get('region'), digest,
+            _header(response, 'ETag'), _header(response, 'Last-Modified'))
+        known = self.fingerprints.get(url)
+        return known is not None and known[0] == digest
+
+    def _update_watermark(self, scope, sold_date, hemnet_id):
+        if scope is None or not sold_date or hemnet_id is None:
+            return
+        sold_date = datetime.strptime(sold_date, '%Y-%m-%d').date()
+        newest = self.watermarks.get(scope)
+        if newest is None or (sold_date, hemnet_id) > newest:
+            self.watermarks[scope] = (sold_date, hemnet_id)
+
+    def _spend(self, region):
+        """Count a request against the budget of ``region``.
+
+        Returns False once the region has spent its budget; the request is
+        not made and the region is remembered as cut short.
+        """
+        budget = self.budgets.get(region, self.default_budget)
+        # 0 is no limit, as for HEMNET_REGION_BUDGET
+        if budget and self.spent[region] >= budget:
+            if region not in self.over_budget:
+                self.over_budget.add(region)
+                self.logger.info('Location %s spent its budget of %d '
+                                 'requests', region, budget)
+            self._inc_stat('hemnet/region/%s/over_budget' % region)
+            return False
+        self.spent[region] += 1
+        self._inc_stat('hemnet/region/%s/requests' % region)
+        return True
+
+    def _inc_stat(self, key):
+        crawler = getattr(self, 'crawler', None)
+        if crawler is not None:
+            crawler.stats.inc_value(key)
+
+    def closed(self, reason):
+        self.error_sink.close()
+        for region in sorted(self.spent):
+            self.logger.info('Location %s: %d requests%s', region,
+                             self.spent[region],
+                             ' (over budget)' if region in self.over_budget
+                             else '')
+        # The watermark of a location cut short would skip the sales its
+        # unmade requests would have found, so it stays where it was.
+        cut_short = set(str(region) for region in self.over_budget)
+        watermarks = dict((scope, mark)
+                          for scope, mark in self.watermarks.items()
+                          if scope.split(':')[0] not in cut_short)
+        crawled = []
+        if self.location_set and reason == 'finished':
+            crawled = [location_id for location_id in self.location_ids or ()
+                       if location_id not in self.over_budget]
+        # Likewise a fingerprint is only kept once the listings of its page
+        # were requested, by a crawl that was not cut short.
+        fingerprints = {}
+        if reason == 'finished':
+            fingerprints = dict(
+                (url, fingerprint[1:])
+                for url, fingerprint in self.new_fingerprints.items()
+                if fingerprint[0] not in self.over_budget)
+        d = self.db.run(self._save_watermarks, watermarks, crawled)
+        d.addCallback(lambda _: self.db.run(self._save_fingerprints,
+                                            fingerprints))
+        return d
 
+    def _save_watermarks(self, watermarks, crawled=()):
+        session = sessionmaker(bind=self.db.engine)()
         try:
-            biarea = int(property_attributes.get(u'Biarea').strip()
-                         .rsplit(' ')[0].replace(u'\xa0', ''))
-        except:
-            biarea = None
-        item['biarea'] = biarea
-
-        item['broker_name'] = broker_sel.css('strong::text')\
-            .extract_first().strip()
-        phone, encoded_email = broker_sel.\
-            css('a.broker-contact__link::attr("href")').extract()
-        item['broker_phone'] = strip_phone(phone)
-
+            if crawled:
+                session.query(HemnetLocation)\
+                    .filter(HemnetLocation.location_set == self.location_set)\
+                    .filter(HemnetLocation.location_id.in_(crawled))\
+                    .update({'last_crawled_at': datetime.now()},
+                            synchronize_session=False)
+            for scope, (sold_date, hemnet_id) in watermarks.items():
+                state = session.query(HemnetCrawlState)\
+                    .filter(HemnetCrawlState.scope == scope).first()
+                if state is None:
+                    state = HemnetCrawlState(scope=scope)
+                    session.add(state)
+                state.newest_sold_date = sold_date
+                state.newest_hemnet_id = hemnet_id
+                state.updated_at = datetime.now()
+            session.commit()
+        finally:
+            session.close()
+
+    def _save_fingerprints(self, fingerprints, chunk_size=500):
+        urls = sorted(fingerprints)
+        session = sessionmaker(bind=self.db.engine)()
         try:
-            item['broker_email'] = decode_email(encoded_email).split('?')[0]
-        except:
-            pass
-
-        item['broker_firm'] = props.get('broker_agency')
+            for i in range(0, len(urls), chunk_size):
+                chunk = urls[i:i + chunk_size]
+                known = dict(
+                    (row.url, row) for row in
+                    session.query(HemnetPageFingerprint)
+                    .filter(HemnetPageFingerprint.url.in_(chunk)))
+                for url in chunk:
+                    row = known.get(url)
+                    if row is None:
+                        row = HemnetPageFingerprint(url=url)
+                        session.add(row)
+                    row.listings_hash, row.etag, row.last_modified = \
+                        fingerprints[url]
+                    row.updated_at = datetime.now()
+            session.commit()
+        finally:
+            session.close()
 
-        try:
-            firm_phone = (broker_sel.css('.phone-number::attr("href")')[1])\
-                .extract()
-            broker_firm_phone = strip_phone(firm_phone)
-        except:
-            broker_firm_phone = None
-        item['broker_firm_phone'] = broker_firm_phone
-        item['price'] = props.get('selling_price')
-        item['asked_price'] = props.get('price')
-        item['sold_date'] = props.get('sold_at_date')
-        item['address'] = props.get('street_address')
-        item['geographic_area'] = props.get('location')
+    def parse_detail_page(self, response):
+        page = extract_sold_page(response)
+        if page.sold_property is None:
+            self._write_err('JSONError', response.request)
+            return
+
+        item = sold_item(page, response.url)
+        self._update_watermark(response.meta.get('scope'),
+                               item['sold_date'], item['hemnet_id'])
+        region = response.meta.get('region')
+        self._inc_stat('hemnet/region/%s/items' % region)
         yield item
 
-        prev_page_url = response.css('link[rel=prev]::attr(href)')\
-            .extract_first()
-        lat, lon = extract_coords(response)
-
-        yield scrapy.Request(prev_page_url, self.parse_prev_page,
-                             meta={'lat': lat, 'lon': lon,
-                                   'salda_id': props['id']},
-                             errback=self.download_err_back)
+        if page.prev_url and self._spend(region):
+            yield scrapy.Request(page.prev_url, self.parse_prev_page,
+                                 meta={'lat': page.lat, 'lon': page.lon,
+                                       'salda_id': item['hemnet_id'],
+                                       'region': region, 'tier': 'prev'},
+                                 errback=self.download_err_back)
 
     def parse_prev_page(self, response):
         try:
-            layer_data = self._get_layer_data(response)
-        except:
-            self._write_err('JSONError', response.url)
+            listing = extract_listing_page(response)
+        except ExtractError:
+            self._write_err('JSONError', response.request)
         else:
-            prop = next((e for e in layer_data if u'property' in e),
-                        {}).get('property', {})
-
-            item = HemnetCompItem()
-
-            item['url'] = response.url
-
-            item['lattitude'] = response.meta['lat']
-            item['longitude'] = response.meta['lon']
-
-            item['salda_id'] = response.meta['salda_id']
-
-            locations = prop.get('locations', {})
-
-            item['city'] = locations.get('city')
-            item['district'] = locations.get('district')
-            item['postal_city'] = locations.get('postal_city')
-            item['country'] = locations.get('country')
-            item['municipality'] = locations.get('municipality')
-            item['region'] = locations.get('county')
-            item['street'] = locations.get('street')
-
-            item['offers_selling_price'] = prop.get('offers_selling_price')
-            item['living_area'] = prop.get('living_area')
-            item['rooms'] = prop.get('rooms')
-            item['hemnet_id'] = prop.get('id')
-            item['cost_per_year'] = prop.get('driftkostnad')
-            item['new_production'] = prop.get('new_production')
-            item['broker_firm'] = prop.get('broker_firm')
-            item['upcoming_open_houses'] = prop.get('upcoming_open_houses')
-            item['location'] = prop.get('location')
-            item['home_swapping'] = prop.get('home_swapping')
-            item['has_price_change'] = prop.get('has_price_change')
-            item['status'] = prop.get('status')
-            item['price'] = prop.get('price')
-            item['monthly_fee'] = prop.get('borattavgift')
-            item['main_location'] = prop.get('main_location')
-            item['publication_date'] = prop.get('publication_date')
-            item['has_active_toplisting'] = prop.get('has_active_toplisting')
-            item['images_count'] = prop.get('images_count')
-            item['item_type'] = prop.get('item_type')
-            item['price_per_m2'] = prop.get('price_per_m2')
-            item['street_address'] = prop.get('street_address')
-
-            yield item
-
-
-def extract_coords(response):
-    coord_pattern = 'coordinate.*\[(\d{2}\.\d+\,\d{2}\.\d+)\]'
-    g = re.search(coord_pattern, response.body)
-    try:
-        lat, lon = map(float, g.group(1).split(','))
-    except:
-        lat, lon = None, None
-    return lat, lon
-
-
-def cfDecodeEmail(encodedString):
-    r = int(encodedString[:2],16)
-    email = ''.join([chr(int(encodedString[i:i+2], 16) ^ r) for i in
-                     range(2, len(encodedString), 2)])
-    return email
-
-
-def decode_email(encoded_str):
-    # u'/cdn-cgi/l/email-protection#b2d8d7c1c2d7c09cdead...'
-    try:
-        decoded = cfDecodeEmail(encoded_str.split('#')[-1])
-    except:
-        decoded = None
-    return decoded
+            yield comp_item(listing, response.url,
+                            response.meta['lat'], response.meta['lon'],
+                            response.meta['salda_id'])
+
+
+def sold_age_covering(newest_sold_date, default, today=None):
+    """Narrowest ``sold_age`` reaching back to ``newest_sold_date``."""
+    if newest_sold_date is None:
+        return default
+    days = ((today or date.today()) - newest_sold_date).days
+    for sold_age, window in SOLD_AGES:
+        if days < window:
+            return sold_age
+    return 'all'
 
 
 def get_hemnet_id(url):
@@ -305,16 +452,13 @@ def get_hemnet_id(url):
     return int(slug.split('-')[-1])
 
 
-def get_property_attributes(response):
-    a = response.css('.sold-property__attributes > dt::text').extract()
-    x = [x.strip() for x in a]
-    b = response.css('.sold-property__attributes > dd::text').extract()
-
-    return dict(zip(x, b))
+def _header(response, name):
+    value = response.headers.get(name)
+    return to_native_str(value) if value else None
 
 
-def strip_phone(phone_text):
-    if phone_text:
-        return phone_text.replace(u'tel:', u'')
-    else:
-        return u''
+def get_result_count(response):
+    text = response.css('.result-type-toggle__sold-count::text')\
+        .extract_first()
+    digits = re.sub(r'\D', '', text or '')
+    return int(digits) if digits else None
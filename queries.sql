@@ -62,3 +62,82 @@ SELECT COUNT(*) FROM hemnet_items WHERE geographic_area LIKE '%Stockholm%';
 SELECT COUNT(*) FROM hemnet_items;
 
 SELECT DISTINCT type FROM hemnet_items;
+
+
+-- Migration for HEMNET_PIPELINE_WRITE_MODE = 'upsert' on a database created
+-- before it: keep the newest row per hemnet id (salda id for comps), make the
+-- keys unique and add the content hash column.
+BEGIN;
+
+DELETE FROM hemnet_items a
+USING hemnet_items b
+WHERE a.hemnet_id = b.hemnet_id AND a.id < b.id;
+
+DROP INDEX IF EXISTS ix_hemnet_items_hemnet_id;
+CREATE UNIQUE INDEX ix_hemnet_items_hemnet_id ON hemnet_items (hemnet_id);
+ALTER TABLE hemnet_items ADD COLUMN content_hash VARCHAR;
+
+DELETE FROM hemnet_comp_items a
+USING hemnet_comp_items b
+WHERE a.salda_id = b.salda_id AND a.id < b.id;
+
+DROP INDEX IF EXISTS ix_hemnet_comp_items_salda_id;
+CREATE UNIQUE INDEX ix_hemnet_comp_items_salda_id ON hemnet_comp_items (salda_id);
+ALTER TABLE hemnet_comp_items ADD COLUMN content_hash VARCHAR;
+
+COMMIT;
+
+-- Space reclaimed by the deduplication.
+VACUUM FULL ANALYZE hemnet_items;
+VACUUM FULL ANALYZE hemnet_comp_items;
+
+
+-- The queries below read hemnet_broker_area_month, refreshed after every
+-- crawl (see hemnet/analytics.py and `scrapy analytics`), instead of
+-- aggregating hemnet_items. The LIKE filters on geographic_area and address
+-- above use the trigram indexes created by `scrapy analytics`.
+
+-- Top seller
+SELECT broker_email, max(broker_name) AS broker_name,
+       sum(total_price) AS total, sum(sales) AS objects_sold
+FROM hemnet_broker_area_month
+GROUP BY broker_email
+ORDER BY total DESC;
+
+-- Sales and price per m2 per month in an area
+SELECT month, sum(sales) AS sales,
+       sum(priced_total_price) / nullif(sum(priced_square_meters), 0)
+           AS price_per_m2
+FROM hemnet_broker_area_month
+WHERE geographic_area LIKE '%Göteborg%'
+GROUP BY month
+ORDER BY month DESC;
+
+-- Top brokers in an area over the last year
+SELECT broker_email, max(broker_name) AS broker_name, sum(sales) AS sales
+FROM hemnet_broker_area_month
+WHERE geographic_area LIKE '%Guldheden%'
+  AND month >= date_trunc('month', now()) - interval '12 months'
+GROUP BY broker_email
+ORDER BY sales DESC
+LIMIT 20;
+
+
+-- Migration for the coordinates and listing url stored with sold items;
+-- hemnetcompspider goes straight to the listing page when they are set.
+ALTER TABLE hemnet_items ADD COLUMN lat DOUBLE PRECISION;
+ALTER TABLE hemnet_items ADD COLUMN lon DOUBLE PRECISION;
+ALTER TABLE hemnet_items ADD COLUMN listing_url VARCHAR;
+
+
+-- Migration for the time a row was last inserted or changed by the
+-- pipeline; the analytics and comparables refreshes read the rows changed
+-- since their previous run. Old rows count as changed on their collection
+-- date.
+ALTER TABLE hemnet_items ADD COLUMN updated_at TIMESTAMP;
+ALTER TABLE hemnet_comp_items ADD COLUMN updated_at TIMESTAMP;
+UPDATE hemnet_items SET updated_at = collected_at WHERE updated_at IS NULL;
+UPDATE hemnet_comp_items SET updated_at = collected_at
+WHERE updated_at IS NULL;
+CREATE INDEX ix_hemnet_items_updated_at ON hemnet_items (updated_at);
+CREATE INDEX ix_hemnet_comp_items_updated_at ON hemnet_comp_items (updated_at);